@@ -0,0 +1,184 @@
+"""Handles caching decoded images and fonts used in image generation.
+
+Images are kept decoded and already resized, so drawing the same icon or
+backdrop again costs nothing but the paste. Cached images are shared, so
+copy() one before drawing on it.
+
+Big images like ship CGs go through scaled_image instead, which only
+keeps the resized copy and also saves it to the mip folder, so it's made
+once per size rather than once per process.
+
+e.g.
+    ring = assetcache.image(RING_PATH, (60, 60))
+    cg = assetcache.scaled_image(CG_PATH, (300, 500), Image.BICUBIC)
+    font = assetcache.font("fonts/trebucbd.ttf", 20)
+"""
+from PIL import Image, ImageFont
+import hashlib
+import lrucache
+import os
+import threading
+from settings import setting
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+MIP_DIR = os.path.join(DIR_PATH, setting('assets.mip_folder'))
+
+
+def image_bytes(img):
+    """Return roughly how much memory a decoded image takes up."""
+    return img.size[0] * img.size[1] * len(img.getbands())
+
+
+# (path, size, resample) -> decoded image
+image_cache = lrucache.LRUCache(setting('assets.image_cache_bytes'),
+                                weigh=image_bytes)
+# (path, size) -> font
+font_cache = lrucache.LRUCache(setting('assets.font_cache_size'))
+# (path, modified time) -> image size
+_size_cache = {}
+
+
+def image(path, size=None, resample=None):
+    """Return a decoded image, resized to the given size.
+
+    Parameters
+    ----------
+    path : str
+        Location of the image file.
+    size : tuple
+        2-tuple of the size to resize to, or None for the original size.
+    resample : int
+        The PIL resampling filter to resize with, None for PIL's default.
+
+    Returns
+    -------
+    PIL.Image
+        The shared cached image, don't draw on it.
+    """
+    key = (path, size, resample)
+    img = image_cache.get(key)
+    if (img is None):
+        if (size is None):
+            img = Image.open(path)
+            img.load()
+        else:
+            img = image(path).resize(size, resample)
+        image_cache.put(key, img)
+    return img
+
+
+def image_size(path):
+    """Return the size of an image file without decoding it."""
+    key = (path, os.path.getmtime(path))
+    size = _size_cache.get(key)
+    if (size is None):
+        with Image.open(path) as img:
+            size = img.size
+        _size_cache[key] = size
+    return size
+
+
+def _mip_path(path, size, resample):
+    """Return where the resized copy of an image is kept on disk."""
+    name = os.path.splitext(os.path.basename(path))[0]
+    # the folder is hashed in so e.g. a CG and an icon can share a name
+    folder = hashlib.sha1(os.path.dirname(os.path.realpath(path))
+                          .encode('utf-8')).hexdigest()[:8]
+    return os.path.join(MIP_DIR, "%s-%s-%dx%d-%s.png" % (
+        name, folder, size[0], size[1],
+        "default" if resample is None else int(resample)))
+
+
+def _load_mip(path, size, resample, src_mtime):
+    """Return the resized image from the mip folder, making it if needed.
+
+    A saved copy older than the original is made again.
+    """
+    mip_path = _mip_path(path, size, resample)
+    try:
+        if (os.path.getmtime(mip_path) >= src_mtime):
+            img = Image.open(mip_path)
+            img.load()
+            return img
+    except OSError:
+        pass
+    with Image.open(path) as src:
+        img = src.resize(size, resample)
+    os.makedirs(MIP_DIR, exist_ok=True)
+    tmp_path = "%s.%d-%d.tmp" % (mip_path, os.getpid(), threading.get_ident())
+    img.save(tmp_path, format="PNG", compress_level=1)
+    os.replace(tmp_path, mip_path)
+    return img
+
+
+def scaled_image(path, size, resample=None):
+    """Return an image resized to the given size, cached in memory and on disk.
+
+    Parameters
+    ----------
+    path : str
+        Location of the image file.
+    size : tuple
+        2-tuple of the size to resize to.
+    resample : int
+        The PIL resampling filter to resize with, None for PIL's default.
+
+    Returns
+    -------
+    PIL.Image
+        The shared cached image, don't draw on it.
+    """
+    src_mtime = os.path.getmtime(path)
+    key = ("mip", path, size, resample, src_mtime)
+    img = image_cache.get(key)
+    if (img is None):
+        img = _load_mip(path, size, resample, src_mtime)
+        image_cache.put(key, img)
+    return img
+
+
+def prune_mips(keep):
+    """Delete saved resized images that aren't in keep.
+
+    Parameters
+    ----------
+    keep : iterable
+        (path, size, resample) of each resized image still in use.
+
+    Returns
+    -------
+    int
+        The number of files deleted.
+    """
+    if (not os.path.isdir(MIP_DIR)):
+        return 0
+    keep = set(os.path.basename(_mip_path(*x)) for x in keep)
+    removed = 0
+    for name in os.listdir(MIP_DIR):
+        if (name not in keep):
+            os.remove(os.path.join(MIP_DIR, name))
+            removed += 1
+    return removed
+
+
+def font(path, size):
+    """Return a TrueType font at the given size."""
+    key = (path, size)
+    fnt = font_cache.get(key)
+    if (fnt is None):
+        fnt = ImageFont.truetype(path, size)
+        font_cache.put(key, fnt)
+    return fnt
+
+
+def clear():
+    """Empty all in-memory asset caches, e.g. after the files have changed."""
+    image_cache.clear()
+    font_cache.clear()
+    _size_cache.clear()
+
+
+def format_stats():
+    """Return a list of one line summaries of the asset caches."""
+    return [image_cache.format_stats("Images"),
+            font_cache.format_stats("Fonts")]
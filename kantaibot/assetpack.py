@@ -0,0 +1,186 @@
+"""Handles reading ship CGs from a single memory-mapped pack file.
+
+The pack holds every CG and icon so they don't have to be opened one loose
+file at a time. It's mapped read-only, so every bot process shares the same
+pages of the OS's file cache instead of each reading its own copy. Entries
+are either the original PNG bytes or pre-decoded pixels; a pre-decoded
+entry is used straight out of the mapping without decoding or copying.
+
+Packs are made with tools/build_asset_pack.py. A running bot keeps using
+the pack it opened, so restart it after building a new one.
+
+File layout, little endian:
+    header  b"KCPK", u32 version, u64 index offset, u64 index length
+    payloads, one after another
+    index   UTF-8 JSON of key -> {offset, length, encoding, mode, size},
+            where encoding is "file" for the original PNG or "raw"
+
+e.g.
+    key = assetpack.make_key(ship.sid, "full")
+    if (assetpack.pack is not None and key in assetpack.pack):
+        img = assetpack.pack.image(key)
+"""
+import assetcache
+import io
+import json
+import mmap
+import os
+import struct
+from PIL import Image
+from settings import setting
+
+DIR_PATH = os.path.dirname(os.path.realpath(__file__))
+
+MAGIC = b"KCPK"
+VERSION = 1
+_HEADER = struct.Struct("<4sIQQ")
+
+# modes whose raw bytes can be read back with Image.frombuffer
+RAW_MODES = ("RGBA", "RGB", "LA", "L")
+
+
+def make_key(ident, variant):
+    """Return the key of an image in the pack.
+
+    Parameters
+    ----------
+    ident : int
+        The ship ID, or the KC3 ID for icons.
+    variant : str
+        Which image of the ship, e.g. "full" or "small_damaged".
+    """
+    return "%s:%s" % (ident, variant)
+
+
+class AssetPack:
+    """A read-only, memory-mapped pack of images."""
+
+    def __init__(self, path):
+        """Open the pack.
+
+        Parameters
+        ----------
+        path : str
+            Location of the pack file.
+        """
+        self.path = path
+        # part of scaled image cache keys, so a rebuilt pack isn't mixed up
+        # with the one before it
+        self.stamp = os.path.getmtime(path)
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_offset, index_length = _HEADER.unpack_from(
+            self._map, 0)
+        if (magic != MAGIC or version != VERSION):
+            raise ValueError("%s isn't a version %d asset pack"
+                             % (path, VERSION))
+        self.index = json.loads(
+            self._map[index_offset:index_offset + index_length]
+            .decode('utf-8'))
+
+    def __contains__(self, key):
+        """Return True if the pack has an image with the given key."""
+        return key in self.index
+
+    def __len__(self):
+        """Return the number of images in the pack."""
+        return len(self.index)
+
+    def size(self, key):
+        """Return the size of an image without decoding it."""
+        return tuple(self.index[key]['size'])
+
+    def image(self, key):
+        """Return an image from the pack.
+
+        Pre-decoded images point straight into the mapping, so they're
+        read-only; copy() one before drawing on it.
+        """
+        entry = self.index[key]
+        data = memoryview(self._map)[
+            entry['offset']:entry['offset'] + entry['length']]
+        if (entry['encoding'] == "raw"):
+            return Image.frombuffer(entry['mode'], tuple(entry['size']), data,
+                                    "raw", entry['mode'], 0, 1)
+        img = Image.open(io.BytesIO(data))
+        img.load()
+        return img
+
+    def scaled_image(self, key, size, resample=None):
+        """Return an image from the pack resized, cached in the asset cache.
+
+        Returns
+        -------
+        PIL.Image
+            The shared cached image, don't draw on it.
+        """
+        cache_key = ("pack", self.path, self.stamp, key, size, resample)
+        img = assetcache.image_cache.get(cache_key)
+        if (img is None):
+            img = self.image(key).resize(size, resample)
+            assetcache.image_cache.put(cache_key, img)
+        return img
+
+
+class PackWriter:
+    """Writes a new pack, replacing the file only once it's complete."""
+
+    def __init__(self, path):
+        """Start writing a pack.
+
+        Parameters
+        ----------
+        path : str
+            Location to write the pack to.
+        """
+        self.path = path
+        self.tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        self.index = {}
+        self._file = open(self.tmp_path, 'wb')
+        self._file.write(_HEADER.pack(MAGIC, VERSION, 0, 0))
+
+    def add(self, key, path, raw=False):
+        """Add an image file to the pack.
+
+        Parameters
+        ----------
+        key : str
+            The key to store it under, see make_key.
+        path : str
+            Location of the image file.
+        raw : bool
+            If True, store the decoded pixels rather than the file, when
+            the image's mode allows it.
+        """
+        with Image.open(path) as img:
+            size, mode = img.size, img.mode
+            if (raw and mode in RAW_MODES):
+                payload = img.tobytes()
+                encoding = "raw"
+            else:
+                with open(path, 'rb') as f:
+                    payload = f.read()
+                encoding = "file"
+        self.index[key] = {'offset': self._file.tell(),
+                           'length': len(payload), 'encoding': encoding,
+                           'mode': mode, 'size': list(size)}
+        self._file.write(payload)
+
+    def close(self):
+        """Write the index and move the pack into place."""
+        index = json.dumps(self.index, sort_keys=True).encode('utf-8')
+        index_offset = self._file.tell()
+        self._file.write(index)
+        self._file.seek(0)
+        self._file.write(_HEADER.pack(MAGIC, VERSION, index_offset,
+                                      len(index)))
+        self._file.close()
+        os.replace(self.tmp_path, self.path)
+
+
+# where the builder writes the pack by default, None if packs are disabled
+PACK_FILE = (os.path.join(DIR_PATH, setting('assets.pack_file'))
+             if setting('assets.pack_file') else None)
+# the pack CGs are read from before the loose files, None if there isn't one
+pack = (AssetPack(PACK_FILE) if PACK_FILE and os.path.exists(PACK_FILE)
+        else None)
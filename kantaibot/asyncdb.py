@@ -0,0 +1,199 @@
+"""Handles running user database work away from the event loop.
+
+Every call is sent to one of a few single-threaded lanes picked by Discord
+ID, so work for one user always runs in the order it was requested while a
+slow disk never blocks the bot itself. Each lane only ever works on one
+database shard, so lanes for different shards never wait on each other.
+
+e.g.
+    user = await asyncdb.users.get(did)
+    await asyncdb.inventories.add(ship)
+"""
+import asyncio
+import database
+import functools
+import userinfo
+from concurrent.futures import ThreadPoolExecutor
+from settings import setting
+
+
+class DatabaseLanes:
+    """A set of single-threaded executors for database work."""
+
+    def __init__(self, count, shard_count=1):
+        """Initialize the lanes.
+
+        Parameters
+        ----------
+        count : int
+            The number of lanes (threads) to run, rounded up to a multiple
+            of shard_count.
+        shard_count : int
+            The number of database shards.
+        """
+        self.shard_count = shard_count
+        per_shard = -(-max(1, count) // shard_count)
+        self.executors = [ThreadPoolExecutor(max_workers=1,
+                                             thread_name_prefix="userdb-%d"
+                                             % i)
+                          for i in range(per_shard * shard_count)]
+
+    def lane(self, did):
+        """Return the executor that runs work for the given Discord ID.
+
+        Work that isn't tied to a user runs on lane 0. It mustn't write to
+        any shard but the first, see shard_lane.
+        """
+        if (did is None):
+            return self.executors[0]
+        # lane i only runs work for shard i % shard_count
+        per_shard = len(self.executors) // self.shard_count
+        shard = database.shard_index(did, self.shard_count)
+        return self.executors[shard + self.shard_count
+                              * (int(did) % per_shard)]
+
+    def shard_lane(self, shard):
+        """Return an executor that only runs work for the given shard."""
+        return self.executors[shard]
+
+    async def run(self, did, func, *args, **kwargs):
+        """Run a function on the given user's lane and return its result."""
+        return await self._submit(self.lane(did), func, *args, **kwargs)
+
+    async def run_on_shard(self, shard, func, *args, **kwargs):
+        """Run a function on a lane of the given shard, see shard_lane."""
+        return await self._submit(self.shard_lane(shard), func, *args,
+                                  **kwargs)
+
+    async def _submit(self, executor, func, *args, **kwargs):
+        """Run a function on an executor and return its result."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            executor, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self):
+        """Wait for all queued work to finish and stop the lanes."""
+        for executor in self.executors:
+            executor.shutdown(wait=True)
+
+
+lanes = DatabaseLanes(setting('database.threads'), len(userinfo.db))
+
+
+async def run(did, func, *args, **kwargs):
+    """Run any blocking userinfo code on the given user's lane.
+
+    Parameters
+    ----------
+    did : int
+        The Discord ID the work is for, or None for work that isn't tied to
+        a single user.
+    func : function
+        The function to run.
+    """
+    return await lanes.run(did, func, *args, **kwargs)
+
+
+async def apply(did, unit):
+    """Apply a userinfo.UnitOfWork in one transaction.
+
+    Returns
+    -------
+    bool
+        False if one of the unit's checks failed and nothing was written.
+    """
+    return await run(did, unit.apply)
+
+
+async def flush():
+    """Write all buffered passive gains, each shard's on one of its lanes.
+
+    Returns
+    -------
+    int
+        The number of entries written.
+    """
+    counts = await asyncio.gather(*(
+        lanes.run_on_shard(i, userinfo.flush_pending, i)
+        for i in range(lanes.shard_count)))
+    return sum(counts)
+
+
+class _Users:
+    """Async access to User rows and cooldowns."""
+
+    async def get(self, did):
+        """Return the User for the given Discord ID."""
+        return await run(did, userinfo.get_user, did)
+
+    async def has_space(self, did, ship_amount=1):
+        """Return true if the user has space in their inventory."""
+        return await run(did, userinfo.has_space_in_inventory, did,
+                         ship_amount)
+
+    async def cooldown(self, did, colname, cooldown_amount, set_if_off=True,
+                       deferred=False):
+        """Return the seconds left on a cooldown, see check_cooldown."""
+        return await run(did, userinfo.check_cooldown, did, colname,
+                         cooldown_amount, set_if_off, deferred)
+
+
+class _Inventories:
+    """Async access to user inventories and their ships."""
+
+    async def get(self, did):
+        """Return the UserInventory for the given Discord ID."""
+        return await run(did, userinfo.get_user_inventory, did)
+
+    async def add(self, ship_instance, inventory=None):
+        """Add a new ship to its owner's inventory.
+
+        Parameters
+        ----------
+        ship_instance : ShipInstance
+            The ship to add, its invid is set once it has been added.
+        inventory : UserInventory
+            The owner's loaded inventory to keep up to date, if any.
+        """
+        if (inventory is None):
+            inventory = userinfo.UserInventory(ship_instance.owner)
+        await run(ship_instance.owner, inventory.add_to_inventory,
+                  ship_instance)
+
+    async def add_many(self, did, ship_instances, inventory=None):
+        """Add several new ships to one user's inventory in one batch.
+
+        Returns
+        -------
+        list
+            The inventory IDs given to the ships.
+        """
+        if (inventory is None):
+            inventory = userinfo.UserInventory(did)
+        return await run(did, inventory.add_many, ship_instances)
+
+    async def update_sid(self, ship_instance):
+        """Save a ship's new ship ID, used for remodels."""
+        await run(ship_instance.owner, userinfo.update_ship_sid,
+                  ship_instance)
+
+
+class _Fleets:
+    """Async access to user fleets."""
+
+    async def get(self, did, fid=1):
+        """Return the UserFleet with the given ID."""
+        return await run(did, userinfo.UserFleet.instance, fid, did)
+
+    async def update(self, fleet):
+        """Save a fleet's ships."""
+        await run(fleet.owner, fleet.update)
+
+    async def ships(self, fleet):
+        """Return the ShipInstances in a fleet."""
+        return await run(fleet.owner, fleet.get_ship_instances)
+
+
+users = _Users()
+inventories = _Inventories()
+fleets = _Fleets()
@@ -0,0 +1,180 @@
+"""Handles online backups of the user database.
+
+Backups are taken with SQLite's backup API on a separate read connection
+in a worker thread, so the bot keeps running (and writing) while a backup
+is copied. Each backup is gzipped and old ones are pruned by a rotation
+that keeps the newest backup of each recent hour, day and week.
+"""
+import asyncio
+import datetime
+import gzip
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import time
+
+# e.g. usersdb-backup-19-01-31.12-00-00.db.gz
+BACKUP_NAME = "%s-backup-%s.db.gz"
+TIME_FORMAT = "%y-%m-%d.%H-%M-%S"
+# also matches the uncompressed backups made by older versions
+BACKUP_PATTERN = re.compile(
+    r"^(.+)-backup-(\d\d-\d\d-\d\d\.\d\d-\d\d-\d\d)\.db(\.gz)?$")
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def _copy_database(db_path, dest_path, pages_per_step, step_sleep):
+    """Copy a live database to a new file, a few pages at a time.
+
+    SQLite only locks the source while a step is being copied, so writes
+    made by the bot between steps go through and are picked up by the
+    backup.
+    """
+    src = sqlite3.connect(db_path)
+    dst = sqlite3.connect(dest_path)
+    try:
+        src.backup(dst, pages=pages_per_step, sleep=step_sleep)
+    finally:
+        dst.close()
+        src.close()
+
+
+def _compress(src_path, dest_path, compression_level):
+    """Stream a file through gzip into dest_path."""
+    with open(src_path, 'rb') as src, \
+            gzip.open(dest_path, 'wb', compresslevel=compression_level) as dst:
+        shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+
+
+def _write_backup(db_path, backup_path, pages_per_step, step_sleep,
+                  compression_level):
+    """Copy and compress the database to backup_path."""
+    raw_path = backup_path + ".tmp.db"
+    gz_path = backup_path + ".tmp"
+    try:
+        _copy_database(db_path, raw_path, pages_per_step, step_sleep)
+        _compress(raw_path, gz_path, compression_level)
+        # only show up as a finished backup once fully written
+        os.replace(gz_path, backup_path)
+    finally:
+        for path in (raw_path, gz_path):
+            if (os.path.exists(path)):
+                os.remove(path)
+
+
+async def create_backup(db_path, backup_dir, pages_per_step=256,
+                        step_sleep=0.005, compression_level=6):
+    """Create a new compressed backup of the database.
+
+    Parameters
+    ----------
+    db_path : str
+        Location of the database to back up.
+    backup_dir : str
+        Folder to put the backup in, created if missing.
+    pages_per_step : int
+        Number of database pages copied between each release of the lock.
+    step_sleep : float
+        Seconds to wait between each step of the copy.
+    compression_level : int
+        gzip compression level from 1 (fastest) to 9 (smallest).
+
+    Returns
+    -------
+    str
+        The location of the new backup.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    db_name = os.path.splitext(os.path.basename(db_path))[0]
+    name = BACKUP_NAME % (db_name,
+                          datetime.datetime.now().strftime(TIME_FORMAT))
+    backup_path = os.path.join(backup_dir, name)
+    start = time.monotonic()
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, _write_backup, db_path, backup_path,
+                               pages_per_step, step_sleep, compression_level)
+    logging.info("[Backup] Created %s (%d KiB from %d KiB) in %.2fs" % (
+        name, os.path.getsize(backup_path) // 1024,
+        os.path.getsize(db_path) // 1024, time.monotonic() - start))
+    return backup_path
+
+
+def list_backups(backup_dir):
+    """Return a dict of database name to its backups.
+
+    Returns
+    -------
+    dict
+        Maps the name of each backed up database, e.g. usersdb, to a list of
+        (time, file name) of its backups, newest first.
+    """
+    backups = {}
+    if (not os.path.isdir(backup_dir)):
+        return backups
+    for name in os.listdir(backup_dir):
+        match = BACKUP_PATTERN.match(name)
+        if (match):
+            taken = datetime.datetime.strptime(match.group(2), TIME_FORMAT)
+            backups.setdefault(match.group(1), []).append((taken, name))
+    for db_backups in backups.values():
+        db_backups.sort(reverse=True)
+    return backups
+
+
+def backups_to_keep(backups, keep_hourly, keep_daily, keep_weekly):
+    """Return the set of backup names kept by the rotation.
+
+    The newest backup of each of the last keep_hourly hours, keep_daily
+    days and keep_weekly weeks that have a backup is kept, along with the
+    newest backup overall.
+
+    Parameters
+    ----------
+    backups : list
+        List of (time, file name) of one database's backups, newest first.
+    keep_hourly, keep_daily, keep_weekly : int
+        Number of hours, days and weeks to keep a backup for.
+    """
+    keep = set()
+    if (len(backups) > 0):
+        keep.add(backups[0][1])
+    periods = ((keep_hourly, lambda t: t.strftime("%Y-%m-%d %H")),
+               (keep_daily, lambda t: t.date()),
+               (keep_weekly, lambda t: t.isocalendar()[:2]))
+    for amount, period_of in periods:
+        seen = set()
+        for taken, name in backups:
+            if (len(seen) >= amount):
+                break
+            period = period_of(taken)
+            if (period not in seen):
+                seen.add(period)
+                keep.add(name)
+    return keep
+
+
+def rotate_backups(backup_dir, keep_hourly, keep_daily, keep_weekly):
+    """Delete backups that fall outside of the rotation.
+
+    Each database (e.g. each shard) is rotated separately.
+
+    Returns
+    -------
+    int
+        The number of backups deleted.
+    """
+    removed = 0
+    kept = 0
+    for backups in list_backups(backup_dir).values():
+        keep = backups_to_keep(backups, keep_hourly, keep_daily,
+                               keep_weekly)
+        kept += len(keep)
+        for _taken, name in backups:
+            if (name not in keep):
+                os.remove(os.path.join(backup_dir, name))
+                removed += 1
+    if (removed > 0):
+        logging.info("[Backup] Removed %s old backups, %s left" % (
+            removed, kept))
+    return removed
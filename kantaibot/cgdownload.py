@@ -0,0 +1,157 @@
+"""Handles downloading missing ship CGs in the background.
+
+A missing CG used to be downloaded in the middle of a render, holding up
+that render (and, on the event loop, the whole bot) for as long as the
+download took. Now it's queued here and the render draws a placeholder.
+The next render after the download finishes gets the real CG.
+
+Downloads run on a few threads, each file is only downloaded once at a
+time, failures are retried with a growing delay, and a file is only
+written once it's complete. A file that couldn't be downloaded isn't
+tried again until its failure cooldown is up.
+
+e.g.
+    future = cgdownload.downloads.request(url, path)
+    future.result()  # only to wait for it, e.g. in a tool
+"""
+import logging
+import os
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from PIL import Image
+from settings import setting
+
+
+class DownloadManager:
+    """A pool of threads downloading images to files."""
+
+    def __init__(self, workers, timeout, retries, backoff,
+                 failure_cooldown=0, urlopen=urllib.request.urlopen):
+        """Initialize the manager.
+
+        Parameters
+        ----------
+        workers : int
+            The most downloads to run at once.
+        timeout : float
+            Seconds to wait on the server before giving up on an attempt.
+        retries : int
+            The number of times to try again after a failed attempt.
+        backoff : float
+            Seconds to wait before the first retry, doubled for each one
+            after it.
+        failure_cooldown : float
+            Seconds before a file whose download failed is tried again.
+        urlopen : function
+            Opens a URL with a timeout, urllib's by default.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers),
+                                           thread_name_prefix="cgdownload")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.failure_cooldown = failure_cooldown
+        self.urlopen = urlopen
+        # path -> future of the download writing it
+        self.in_flight = {}
+        # path -> (time it failed, future of the failed download)
+        self.failures = {}
+        # reentrant, a download that already finished calls _finished
+        # from inside request
+        self._lock = threading.RLock()
+        self.downloaded = 0
+        self.failed = 0
+        self.retried = 0
+
+    def request(self, url, path):
+        """Queue downloading the image at url to path.
+
+        Asking for a path that's already being downloaded returns the same
+        download rather than starting another, and asking for one that
+        failed within the cooldown returns the failed download.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to path once written, or raises the last error if
+            every attempt failed.
+        """
+        with self._lock:
+            future = self.in_flight.get(path)
+            failure = self.failures.get(path)
+            if (future is None and failure is not None
+                    and time.monotonic() - failure[0] < self.failure_cooldown):
+                future = failure[1]
+            if (future is None):
+                future = self.executor.submit(self._download, url, path)
+                self.in_flight[path] = future
+                future.add_done_callback(
+                    lambda f: self._finished(path, f))
+            return future
+
+    def is_downloading(self, path):
+        """Return True if the path is queued or being downloaded."""
+        return path in self.in_flight
+
+    def _finished(self, path, future):
+        """Forget a finished download, remembering it if it failed."""
+        with self._lock:
+            if (self.in_flight.get(path) is future):
+                del self.in_flight[path]
+            if (future.cancelled() or future.exception() is not None):
+                self.failures[path] = (time.monotonic(), future)
+            else:
+                self.failures.pop(path, None)
+
+    def _download(self, url, path):
+        """Download, check and write one image, retrying on failure."""
+        for attempt in range(self.retries + 1):
+            if (attempt > 0):
+                self.retried += 1
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                with self.urlopen(url, timeout=self.timeout) as req:
+                    data = req.read()
+                # fails on a truncated or non-image response
+                img = Image.open(BytesIO(data)).convert('RGBA')
+                self._write(img, path)
+                self.downloaded += 1
+                return path
+            except (OSError, ValueError) as e:
+                error = e
+                logging.warning("[CGDownload] Attempt %d of %d for %s "
+                                "failed: %s" % (attempt + 1,
+                                                self.retries + 1, url, e))
+        self.failed += 1
+        raise error
+
+    def _write(self, img, path):
+        """Save the image so that path is either missing or complete."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "%s.%d-%d.tmp" % (path, os.getpid(), threading.get_ident())
+        try:
+            img.save(tmp_path, format="PNG")
+            os.replace(tmp_path, path)
+        finally:
+            if (os.path.exists(tmp_path)):
+                os.remove(tmp_path)
+
+    def format_stats(self):
+        """Return a one line summary of the downloads."""
+        return ("CG downloads: %d in flight, %d done, %d failed, %d retries"
+                % (len(self.in_flight), self.downloaded, self.failed,
+                   self.retried))
+
+    def shutdown(self, wait=True):
+        """Stop the download threads, finishing queued downloads if wait."""
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+downloads = DownloadManager(setting('downloads.workers'),
+                            setting('downloads.timeout'),
+                            setting('downloads.retries'),
+                            setting('downloads.backoff'),
+                            setting('downloads.failure_cooldown'))
@@ -0,0 +1,275 @@
+"""Handles long-lived SQLite connections."""
+import os
+import sqlite3
+import threading
+import zlib
+from contextlib import contextmanager, ExitStack
+
+
+class Database:
+    """A single persistent connection to a SQLite database file."""
+
+    # True for databases that are lost once closed
+    in_memory = False
+
+    def __init__(self, path, synchronous="NORMAL", cache_size=-16000,
+                 cached_statements=256):
+        """Initialize the database.
+
+        Parameters
+        ----------
+        path : str
+            Location of the database file.
+        synchronous : str
+            Value for the synchronous pragma. NORMAL is safe in WAL mode and
+            only syncs on checkpoints.
+        cache_size : int
+            Value for the cache_size pragma, negative values are in KiB.
+        cached_statements : int
+            Number of prepared statements SQLite keeps around for reuse.
+        """
+        self.path = path
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.cached_statements = cached_statements
+        self._conn = None
+        self._depth = 0
+        self._lock = threading.RLock()
+        # functions called after a transaction is rolled back, e.g. to
+        # invalidate caches written through during it
+        self.rollback_hooks = []
+
+    def connection(self):
+        """Return the connection, opening it the first time it is needed."""
+        with self._lock:
+            if (self._conn is None):
+                conn = sqlite3.connect(
+                    self.path, isolation_level=None, check_same_thread=False,
+                    cached_statements=self.cached_statements)
+                self._configure(conn)
+                self._conn = conn
+            return self._conn
+
+    def _configure(self, conn):
+        """Set the pragmas for a newly opened connection."""
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=%s" % self.synchronous)
+        conn.execute("PRAGMA cache_size=%d" % self.cache_size)
+
+    def close(self):
+        """Close the connection if it is open."""
+        with self._lock:
+            if (self._conn is not None):
+                self._conn.close()
+                self._conn = None
+
+    @contextmanager
+    def transaction(self, begin="BEGIN IMMEDIATE"):
+        """Run every statement inside the block in a single transaction.
+
+        Nested scopes join the outermost one, which commits when it exits
+        normally and rolls back if an exception escapes it. Don't await
+        inside of a transaction scope.
+
+        Parameters
+        ----------
+        begin : str
+            The statement starting the outermost scope. IMMEDIATE takes the
+            write lock up front so a write can't fail halfway through.
+        """
+        with self._lock:
+            conn = self.connection()
+            if (self._depth == 0):
+                conn.execute(begin)
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._depth -= 1
+                if (self._depth == 0):
+                    conn.execute("ROLLBACK")
+                    for hook in self.rollback_hooks:
+                        hook()
+                raise
+            self._depth -= 1
+            if (self._depth == 0):
+                conn.execute("COMMIT")
+
+    def read_transaction(self):
+        """Run every read inside the block against one snapshot.
+
+        Unlike transaction, this doesn't take the write lock, so it doesn't
+        hold up writers in other processes. Don't write inside of it.
+        """
+        return self.transaction(begin="BEGIN")
+
+    def execute(self, query, args=()):
+        """Run a statement, committing it unless inside of a transaction.
+
+        Returns
+        -------
+        int
+            The number of rows modified.
+        """
+        with self._lock:
+            cur = self.connection().execute(query, args)
+            count = cur.rowcount
+            cur.close()
+            return count
+
+    def executemany(self, query, arg_list):
+        """Run a statement once for every set of arguments."""
+        with self._lock:
+            cur = self.connection().executemany(query, arg_list)
+            count = cur.rowcount
+            cur.close()
+            return count
+
+    def executescript(self, script):
+        """Run a script of several SQL statements."""
+        with self._lock:
+            self.connection().executescript(script)
+
+    def fetchone(self, query, args=()):
+        """Run a query and return its first row, or None."""
+        with self._lock:
+            cur = self.connection().execute(query, args)
+            row = cur.fetchone()
+            cur.close()
+            return row
+
+    def fetchall(self, query, args=()):
+        """Run a query and return all of its rows."""
+        with self._lock:
+            cur = self.connection().execute(query, args)
+            rows = cur.fetchall()
+            cur.close()
+            return rows
+
+
+class MemoryDatabase(Database):
+    """A database that only lives in memory, for tests and benchmarks.
+
+    Everything is lost once it is closed. Runs the same SQL as the file
+    backend without ever touching the disk.
+    """
+
+    in_memory = True
+
+    def __init__(self, cached_statements=256):
+        """Initialize the database.
+
+        Parameters
+        ----------
+        cached_statements : int
+            Number of prepared statements SQLite keeps around for reuse.
+        """
+        super().__init__(":memory:", cached_statements=cached_statements)
+
+    def _configure(self, conn):
+        """Set the pragmas for a newly opened connection."""
+        # there is no file to sync, and the default in-memory journal is
+        # kept so transactions can still roll back
+        conn.execute("PRAGMA synchronous=OFF")
+
+
+def shard_index(discordid, shard_count):
+    """Return which of shard_count shards a Discord ID belongs in.
+
+    Uses crc32 rather than hash() so the result never changes between runs
+    or Python versions.
+    """
+    if (shard_count == 1):
+        return 0
+    return zlib.crc32(str(int(discordid)).encode()) % shard_count
+
+
+def shard_paths(path, shard_count):
+    """Return the file locations of each shard of the database at path.
+
+    A single shard is just the database at path, so turning sharding on and
+    off doesn't need anything renamed. e.g. with 4 shards usersdb.db is
+    split into usersdb.shard0-of-4.db up to usersdb.shard3-of-4.db
+    """
+    if (shard_count == 1):
+        return [path]
+    root, ext = os.path.splitext(path)
+    return ["%s.shard%d-of-%d%s" % (root, i, shard_count, ext)
+            for i in range(shard_count)]
+
+
+class ShardRouter:
+    """Routes every Discord ID to one of several databases.
+
+    With more than one shard, writes for users on different shards no
+    longer wait on the same SQLite write lock.
+    """
+
+    def __init__(self, shards):
+        """Initialize the router.
+
+        Parameters
+        ----------
+        shards : list
+            The Database for each shard. Their order decides which users
+            live in which shard, so it must never change for the same files.
+        """
+        self.shards = list(shards)
+        self.in_memory = all(x.in_memory for x in self.shards)
+
+    def __len__(self):
+        """Return the number of shards."""
+        return len(self.shards)
+
+    def __iter__(self):
+        """Iterate over every shard."""
+        return iter(self.shards)
+
+    def index(self, discordid):
+        """Return the index of the shard holding the given user."""
+        return shard_index(discordid, len(self.shards))
+
+    def shard(self, discordid):
+        """Return the Database holding the given user."""
+        return self.shards[self.index(discordid)]
+
+    @contextmanager
+    def transaction(self, discordids):
+        """Run the block in a transaction on each shard the users are in.
+
+        Shards are always entered in the same order so two threads can't
+        deadlock on each other. Each shard still commits on its own.
+        """
+        indexes = sorted(set(self.index(x) for x in discordids))
+        with ExitStack() as stack:
+            for i in indexes:
+                stack.enter_context(self.shards[i].transaction())
+            yield self
+
+    @contextmanager
+    def read_transaction(self, discordids):
+        """Run the block in a read transaction on each shard the users are in.
+
+        See Database.read_transaction.
+        """
+        indexes = sorted(set(self.index(x) for x in discordids))
+        with ExitStack() as stack:
+            for i in indexes:
+                stack.enter_context(self.shards[i].read_transaction())
+            yield self
+
+    def add_rollback_hook(self, hook):
+        """Call a function whenever a transaction on any shard rolls back."""
+        for shard in self.shards:
+            shard.rollback_hooks.append(hook)
+
+    def remove_rollback_hook(self, hook):
+        """Stop calling a function added with add_rollback_hook."""
+        for shard in self.shards:
+            if (hook in shard.rollback_hooks):
+                shard.rollback_hooks.remove(hook)
+
+    def close(self):
+        """Close every shard."""
+        for shard in self.shards:
+            shard.close()
@@ -0,0 +1,113 @@
+"""Handles one-shot migrations of the users database."""
+import logging
+import re
+import sqlutils
+
+LEGACY_INVENTORY_PATTERN = re.compile(r"^INV_(\d+)$")
+MIGRATION_BATCH_SIZE = 500
+
+
+def legacy_inventory_tables(conn):
+    """Return a list of (table name, discord ID) for old inventory tables."""
+    tables = []
+    for name in sqlutils.tables_like(conn, "INV_%"):
+        match = LEGACY_INVENTORY_PATTERN.match(name)
+        if (match):
+            tables.append((name, int(match.group(1))))
+    return tables
+
+
+def _legacy_last_id(conn, table_name):
+    """Return the last inventory ID handed out by an old inventory table."""
+    cur = conn.cursor()
+    cur.execute("SELECT MAX(ID) FROM %s" % table_name)
+    last_id = cur.fetchone()[0] or 0
+    if (sqlutils.table_exists(conn, "sqlite_sequence")):
+        cur.execute("SELECT seq FROM sqlite_sequence WHERE name=?",
+                    (table_name,))
+        row = cur.fetchone()
+        if (row):
+            last_id = max(last_id, row[0])
+    cur.close()
+    return last_id
+
+
+def migrate_inventories(db, batch_size=MIGRATION_BATCH_SIZE):
+    """Move every INV_<discordid> table into the shared Inventory table.
+
+    Each table is copied and dropped inside its own transaction, so the
+    migration can be stopped at any point and run again to pick up where it
+    left off.
+
+    Parameters
+    ----------
+    db : database.Database
+        The users database.
+    batch_size : int
+        Number of rows to read from an old table at a time.
+
+    Returns
+    -------
+    int
+        The number of tables migrated.
+    """
+    tables = legacy_inventory_tables(db.connection())
+    for table_name, discordid in tables:
+        with db.transaction():
+            conn = db.connection()
+            db.execute("INSERT OR REPLACE INTO InventorySeq (OwnerID, "
+                       "LastID) VALUES (?, ?)",
+                       (discordid, _legacy_last_id(conn, table_name)))
+            src = conn.cursor()
+            src.execute("SELECT ID, ShipID, ShipLevel, ShipXP FROM %s"
+                        % table_name)
+            while True:
+                rows = src.fetchmany(batch_size)
+                if (not rows):
+                    break
+                db.executemany("INSERT OR REPLACE INTO Inventory (OwnerID, "
+                               "ID, ShipID, ShipLevel, ShipXP) VALUES "
+                               "(?, ?, ?, ?, ?)",
+                               [(discordid,) + tuple(r) for r in rows])
+            src.close()
+            db.execute("DROP TABLE %s" % table_name)
+        logging.info("[Migrate] Moved inventory table %s" % table_name)
+    return len(tables)
+
+
+def migrate_fleets(db, fleet_count=4):
+    """Move the semicolon-joined Fleet_N columns into the FleetSlots table.
+
+    Each migrated column is emptied in the same transaction, so running
+    this again only picks up users that haven't been moved yet.
+
+    Parameters
+    ----------
+    db : database.Database
+        The users database.
+    fleet_count : int
+        Number of Fleet_N columns in the Users table.
+
+    Returns
+    -------
+    int
+        The number of fleets migrated.
+    """
+    moved = 0
+    with db.transaction():
+        for fid in range(1, fleet_count + 1):
+            col = "Fleet_%s" % fid
+            rows = db.fetchall("SELECT DiscordID, %s FROM Users WHERE %s!=''"
+                               % (col, col))
+            for discordid, ship_string in rows:
+                slots = [(discordid, fid, pos, int(invid)) for pos, invid
+                         in enumerate(ship_string.split(";"))]
+                db.execute("DELETE FROM FleetSlots WHERE OwnerID=? AND "
+                           "FleetID=?", (discordid, fid))
+                db.executemany("INSERT INTO FleetSlots (OwnerID, FleetID, "
+                               "Position, InvID) VALUES (?, ?, ?, ?)", slots)
+                moved += 1
+            db.execute("UPDATE Users SET %s='' WHERE %s!=''" % (col, col))
+    if (moved > 0):
+        logging.info("[Migrate] Moved %s fleets to FleetSlots" % moved)
+    return moved
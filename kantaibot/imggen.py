@@ -1,11 +1,14 @@
 """Handles image generation."""
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw
+import assetcache
 import io
+import lrucache
 import os
 import ship_stats
 import userinfo
 import math
 import json
+import time
 from settings import setting, namesub
 
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -23,6 +26,9 @@ def read_json(filepath):
         return data
 
 
+# bump when the drawing code changes, so cached renders get redrawn
+RENDER_VERSION = 2
+
 CONFIG_DATA_FILE = os.path.join(DIR_PATH, "../layout.json")
 CONFIG_DATA = read_json(CONFIG_DATA_FILE)
 
@@ -30,12 +36,505 @@ small_ico_ring_img = os.path.join(DIR_PATH, "images/ring_icon.png")
 
 large_bg_map_img = os.path.join(DIR_PATH, "images/map_bg.jpg")
 
+BIRTHDAY_SIZE = (600, 800)
+
 RARITY_COLORS = [(150, 150, 150), (150, 150, 150), (150, 150, 150),
                  (0, 122, 103), (255, 255, 50), (0, 255, 84),
                  (250, 25, 25), (255, 0, 234)]
 
 
-def generate_inventory_screen(member, page, only_dupes=False):
+def get_quality(name=None):
+    """Return a render quality profile from the layout file.
+
+    Parameters
+    ----------
+    name : str
+        The name of the profile, e.g. "fast", None for the default one.
+
+    Returns
+    -------
+    dict
+        The profile's supersample factor, resample filters and number of
+        text outline passes.
+    """
+    return CONFIG_DATA['quality_profiles'][name or
+                                           CONFIG_DATA['default_quality']]
+
+
+def resample_filter(name):
+    """Return the PIL resampling filter with the given name, e.g. BICUBIC."""
+    return getattr(Image, name)
+
+
+def inventory_cell_size(quality=None):
+    """Return the (supersampled) size of one inventory cell.
+
+    Parameters
+    ----------
+    quality : str
+        The name of the quality profile, None for the default.
+    """
+    layout = CONFIG_DATA['inventory']
+    w, h = layout['image_size']
+    antialias_value = get_quality(quality)['supersample']
+    return (int(w * antialias_value / layout['per_row']),
+            int(h * antialias_value / layout['per_column']))
+
+
+def downsample(img, factor, filter_name):
+    """Return a supersampled image shrunk back down by the given factor.
+
+    Parameters
+    ----------
+    img : PIL.Image
+        The image drawn at factor times its final size.
+    factor : int
+        The supersample factor of the quality profile it was drawn with.
+    filter_name : str
+        The name of the PIL resampling filter to shrink it with.
+    """
+    w, h = img.size
+    return img.resize((w // factor, h // factor), resample_filter(filter_name))
+
+
+def icon_size(cell_size):
+    """Return the size a ship's icon is drawn at in an inventory cell."""
+    return (int(cell_size[1] * 1.5) - 6, cell_size[1] - 6)
+
+
+def fit_height(size, targ_height):
+    """Return the size scaled to the given height, keeping its aspect ratio."""
+    return (int(targ_height * (size[0] / size[1])), targ_height)
+
+
+def warm_cgs(base, quality=None):
+    """Make the ship's CGs at every size they're drawn at, if not made yet.
+
+    Parameters
+    ----------
+    base : ShipBase
+        The ship to make the CGs of.
+    quality : str
+        The name of the quality profile, None for the default.
+
+    Returns
+    -------
+    list
+        (path, size, resample) of each scaled CG saved to disk, see
+        assetcache.prune_mips. CGs in the asset pack are only scaled in
+        memory, so they aren't listed.
+    """
+    profile = get_quality(quality)
+    icon_filter = resample_filter(profile['icon_filter'])
+    cg_filter = resample_filter(profile['cg_filter'])
+    cg_size = base.get_cg_size()
+    # (ico, size, resample) of each way the CGs are drawn
+    wanted = [(True, icon_size(inventory_cell_size(quality)), icon_filter),
+              (False, fit_height(cg_size, BIRTHDAY_SIZE[1] * 3 // 4),
+               cg_filter)]
+    if (CONFIG_DATA['ship_card']['main_image']['enabled']):
+        wanted.append((False, fit_height(
+            cg_size, CONFIG_DATA['ship_card']['main_image']['targ_height']),
+            cg_filter))
+    made = []
+    for ico, size, resample in wanted:
+        base.get_scaled_cg(size, resample, ico=ico)
+        if (base.packed_cg_key(ico) is None):
+            made.append((base.get_cg_path(ico), size, resample))
+    return made
+
+
+def output_filename(kind):
+    """Return the file name to upload an image of the given kind as."""
+    return "image.%s" % CONFIG_DATA['output'][kind]['format'].lower()
+
+
+def _budget_steps(options):
+    """Yield cheaper versions of the output options, smallest output last.
+
+    PNGs are quantized to fewer and fewer colors, WebPs are saved lossy at
+    a lower and lower quality.
+    """
+    options = dict(options)
+    if (options['format'] == "WEBP"):
+        if (options.get('lossless')):
+            options['lossless'] = False
+            options['quality'] = 90
+            yield dict(options)
+        while (options.get('quality', 80) > 30):
+            options['quality'] = options.get('quality', 80) - 15
+            yield dict(options)
+    else:
+        for colors in (256, 128, 64, 32):
+            if (not options.get('colors') or colors < options['colors']):
+                options['colors'] = colors
+                yield dict(options)
+
+
+def _save(img, options):
+    """Return a BytesIO object of the image saved with the output options."""
+    if (options.get('colors')):
+        if (img.mode not in ("RGB", "RGBA")):
+            img = img.convert("RGBA")
+        img = img.quantize(options['colors'], method=Image.FASTOCTREE)
+    r = io.BytesIO(b'')
+    if (options['format'] == "WEBP"):
+        img.save(r, format="WEBP", quality=options.get('quality', 80),
+                 lossless=options.get('lossless', False),
+                 method=options.get('method', 4))
+    else:
+        img.save(r, format="PNG",
+                 compress_level=options.get('compress_level', 6))
+    return r
+
+
+def encode_image(img, kind):
+    """Encode a finished image for upload.
+
+    The format and its options come from the kind's entry in the output
+    section of the layout file. If the result is bigger than the entry's
+    max_bytes, it's saved again with cheaper options until it fits or
+    there's nothing left to try.
+
+    Parameters
+    ----------
+    img : PIL.Image
+        The image to encode.
+    kind : str
+        The kind of image, e.g. "inventory".
+
+    Returns
+    -------
+    BytesIO
+        The encoded image. Its name is the file name to upload it as,
+        encode_time is the seconds spent encoding and encode_steps is how
+        many times it had to step down to fit the budget.
+    """
+    options = CONFIG_DATA['output'][kind]
+    max_bytes = options.get('max_bytes', 0)
+    start = time.perf_counter()
+    r = _save(img, options)
+    steps = 0
+    if (max_bytes > 0 and r.getbuffer().nbytes > max_bytes):
+        for cheaper in _budget_steps(options):
+            steps += 1
+            r = _save(img, cheaper)
+            if (r.getbuffer().nbytes <= max_bytes):
+                break
+    r.name = output_filename(kind)
+    r.encode_time = time.perf_counter() - start
+    r.encode_steps = steps
+    return r
+
+
+_fade_mask_cache = {}
+# only used to measure text
+_measure = ImageDraw.Draw(Image.new(size=(1, 1), mode="L"))
+
+# (cell size, quality, sid, invid, level, fleet role, shade) -> cell
+tile_cache = lrucache.LRUCache(setting('assets.tile_cache_bytes'),
+                               weigh=assetcache.image_bytes)
+# (text, font, size, max width, colors, passes) -> finished text image
+sprite_cache = lrucache.LRUCache(setting('assets.sprite_cache_bytes'),
+                                 weigh=assetcache.image_bytes)
+
+
+def get_fade_mask(size):
+    """Return a mask that fades out the right quarter of an image.
+
+    Multiplying an image's alpha by the mask makes the right quarter fade
+    out quadratically, so inventory icons blend into their cells.
+
+    Parameters
+    ----------
+    size : tuple
+        2-tuple of the size of the image to fade.
+
+    Returns
+    -------
+    PIL.Image
+        An "L" image of the given size, shared between callers.
+    """
+    if (size in _fade_mask_cache):
+        return _fade_mask_cache[size]
+    w, h = size
+    grad_start = int(w * 0.75)
+    row = [255] * grad_start
+    for ix in range(grad_start, w):
+        fade_amt = (ix - grad_start) / (w - grad_start)
+        row.append(int(255 * (1 - fade_amt * fade_amt)))
+    mask = Image.new(size=(w, 1), mode="L")
+    mask.putdata(row)
+    mask = mask.resize(size, Image.NEAREST)
+    _fade_mask_cache[size] = mask
+    return mask
+
+
+class ShipView:
+    """A detached copy of a ship with everything drawn about it worked out.
+
+    Views are plain data, so they can be drawn on any thread or process
+    without going back to the database or the ship data.
+    """
+
+    def __init__(self, ship_instance):
+        """Initialize the view.
+
+        Parameters
+        ----------
+        ship_instance : ShipInstance
+            The ship to copy.
+        """
+        base = ship_instance.base()
+        self.invid = ship_instance.invid
+        self.sid = ship_instance.sid
+        self.owner = ship_instance.owner
+        self.level = ship_instance.level
+        self.exp = ship_instance.exp
+        self.exp_req = ship_instance.exp_req()
+        self.name = base.name
+        self.class_name = base.class_name
+        self.stype = base.stype
+        self.rarity = base.rarity
+        self.seasonal = base.has_seasonal_cg()
+        self.remodel_ready = ship_instance.is_remodel_ready()
+        self.married = ship_instance.level > setting('levels.level_cap')
+        # (name, level) of the next remodel, if there is one
+        self.next_remodel = None
+        if (base.remodels_into):
+            self.next_remodel = (
+                ship_stats.ShipBase.instance(base.remodels_into).name,
+                base.remodel_level)
+
+    def get_cg(self, ico=False, dmg=False):
+        """Return the ship's CG, see ShipBase.get_cg."""
+        return ship_stats.ShipBase.instance(self.sid).get_cg(ico, dmg)
+
+    def has_cg(self, ico=False, dmg=False):
+        """Return True if the ship's CG is downloaded, see ShipBase.has_cg."""
+        return ship_stats.ShipBase.instance(self.sid).has_cg(ico, dmg)
+
+    def get_cg_size(self, ico=False, dmg=False):
+        """Return the size of the ship's CG, see ShipBase.get_cg_size."""
+        return ship_stats.ShipBase.instance(self.sid).get_cg_size(ico, dmg)
+
+    def get_scaled_cg(self, size, resample=None, ico=False, dmg=False):
+        """Return the ship's resized CG, see ShipBase.get_scaled_cg."""
+        return ship_stats.ShipBase.instance(self.sid).get_scaled_cg(
+            size, resample, ico, dmg)
+
+
+class InventorySnapshot:
+    """A copy of everything shown on one page of a user's inventory.
+
+    Taking a snapshot reads the user, their inventory and all of their
+    fleets in one read transaction. Drawing one doesn't touch the database,
+    so the drawing can happen on any thread or process.
+    """
+
+    def __init__(self, display_name, page, pages_needed, ships, ship_count,
+                 fleets, resources, shipslots, rings, only_dupes=False):
+        """Initialize the snapshot.
+
+        Parameters
+        ----------
+        display_name : str
+            The name of the user shown in the footer.
+        page : int
+            The page shown, starting at 1.
+        pages_needed : int
+            The total number of pages.
+        ships : list
+            ShipViews of the ships on the page, in order.
+        ship_count : int
+            The number of ships on all pages.
+        fleets : dict
+            Maps each fleet ID to the inventory IDs in it, flagship first.
+        resources : tuple
+            The user's fuel, ammo, steel and bauxite.
+        shipslots : int
+            The size of the user's inventory.
+        rings : int
+            The number of rings the user has.
+        only_dupes : bool
+            If True, only ships which the user has two or more of are shown.
+        """
+        self.display_name = display_name
+        self.page = page
+        self.pages_needed = pages_needed
+        self.ships = ships
+        self.ship_count = ship_count
+        self.fleets = fleets
+        self.resources = resources
+        self.shipslots = shipslots
+        self.rings = rings
+        self.only_dupes = only_dupes
+
+    @staticmethod
+    def take(discord_id, display_name, page, only_dupes=False):
+        """Return a snapshot of the given page of a user's inventory."""
+        userinfo.ensure_user(discord_id)
+        with userinfo.read_transaction(discord_id):
+            user = userinfo.get_user(discord_id)
+            inv = userinfo.get_user_inventory(discord_id)
+            fleets = userinfo.get_fleets(discord_id)
+        layout = CONFIG_DATA['inventory']
+
+        ship_pool = inv.inventory
+        if (only_dupes):
+            ship_pool = [s for s in ship_pool if len(inv.by_base(s.sid)) > 1]
+
+        ships_per_page = layout['per_row'] * layout['per_column']
+        pages_needed = (len(ship_pool) // ships_per_page) + \
+            (0 if len(ship_pool) % ships_per_page == 0 and len(ship_pool) > 0
+             else 1)
+        if (page < 1):
+            page = 1
+        elif (page > pages_needed):
+            page = pages_needed
+        start = ships_per_page * (page - 1)
+        ships = [ShipView(s)
+                 for s in ship_pool[start:start + ships_per_page]]
+
+        return InventorySnapshot(
+            display_name, page, pages_needed, ships, len(ship_pool),
+            {f.fid: list(f.ships) for f in fleets},
+            (user.fuel, user.ammo, user.steel, user.bauxite),
+            user.shipslots, user.rings, only_dupes)
+
+
+class ShipCardSnapshot:
+    """A copy of everything shown on a ship's card."""
+
+    def __init__(self, ship, owner_name):
+        """Initialize the snapshot.
+
+        Parameters
+        ----------
+        ship : ShipView
+            The ship to display.
+        owner_name : str
+            The name of the ship's owner.
+        """
+        self.ship = ship
+        self.owner_name = owner_name
+
+    @staticmethod
+    def take(bot, ship_instance):
+        """Return a snapshot of a ship's card, looking up its owner's name."""
+        owner_name = "Unknown User"
+        for g in bot.guilds:
+            owner = g.get_member(ship_instance.owner)
+            if (owner):
+                owner_name = "%s#%s" % (owner.name, owner.discriminator)
+                break
+        return ShipCardSnapshot(ShipView(ship_instance), owner_name)
+
+
+def get_inventory_tile(ship, fleet_role, shade, size, quality=None):
+    """Return the image of one cell of the inventory grid.
+
+    Cells are cached, so a ship is only drawn again once something shown in
+    its cell changes, e.g. its level.
+
+    Parameters
+    ----------
+    ship : ShipView
+        The ship in the cell, None for an empty cell.
+    fleet_role : str
+        "flag" if the ship is the flagship of the first fleet, "fleet" if
+        it's elsewhere in the first fleet, None otherwise.
+    shade : bool
+        Which of the two alternating cell colors to use.
+    size : tuple
+        2-tuple of the (supersampled) size of the cell.
+    quality : str
+        The name of the quality profile to draw with.
+
+    Returns
+    -------
+    PIL.Image
+        The shared cached cell, don't draw on it.
+    """
+    # whether the ship is seasonal or ready for a remodel follows from its
+    # sid and level, so they don't need to be part of the key. Whether its
+    # icon is downloaded does, so a placeholder isn't kept once it is
+    key = (size, quality, shade) if ship is None else (
+        size, quality, shade, ship.sid, ship.invid, ship.level, fleet_role,
+        ship.has_cg(ico=True))
+    tile = tile_cache.get(key)
+    if (tile is None):
+        tile = draw_inventory_tile(ship, fleet_role, shade, size, quality)
+        tile_cache.put(key, tile)
+    return tile
+
+
+def draw_inventory_tile(ship, fleet_role, shade, size, quality=None):
+    """Draw one cell of the inventory grid, see get_inventory_tile."""
+    layout = CONFIG_DATA['inventory']
+    profile = get_quality(quality)
+    cw, ch = size
+    img = Image.new(size=size, mode="RGB", color=(255, 255, 255))
+    draw = ImageDraw.Draw(img)
+
+    shade_color = (("filled_color1" if shade else "filled_color2")
+                   if ship else ("empty_color1" if shade else "empty_color2"))
+    rbg = None
+
+    if (ship):
+        rbg = ship_stats.get_rarity_backdrop(ship.rarity, (cw, ch))
+        if (fleet_role == "flag"):
+            shade_color = 'flag_border_color'
+        elif (fleet_role == "fleet"):
+            shade_color = "fleet_color1" if shade else "fleet_color2"
+        elif (ship.seasonal):
+            shade_color = "seasonal_color1" if shade else "seasonal_color2"
+
+    shade_color = tuple(layout[shade_color])
+
+    x, y = (0, 0)
+    draw.rectangle((x, y, x + cw, y + ch), fill=shade_color)
+    if (rbg):
+        img.paste(rbg, (x, y))
+    if (ship):
+        font = assetcache.font("fonts/trebucbd.ttf", ch * 1 // 2)
+        num_str = "%s-%04d" % (ship.stype, ship.invid)
+        draw_squish_text(img, (x + cw * 3 // 4, y + ch * 1 // 4), num_str,
+                         font, cw * 7 // 16 - 2, color=(0, 0, 0))
+
+        if (setting('features.levels_enabled')):
+            if (setting('features.marriage_enabled') and ship.married):
+                ring = assetcache.image(small_ico_ring_img,
+                                        (ch // 3 - 4, ch // 3 - 4))
+                ring_loc = (x + cw * 8 // 9 - 2, y + ch * 5 // 8 + 2)
+                draw.ellipse(
+                    (ring_loc, tuple(map(sum, zip(ring_loc, ring.size)))), fill=(0, 0, 0))
+                img.paste(ring, ring_loc, mask=ring)
+            font = assetcache.font("fonts/trebucbd.ttf", ch * 3 // 8)
+            lvl_str = "Lv. %02d" % (ship.level)
+            draw_squish_text(img, (x + 2 + cw * 11 // 16, y + ch * 3 // 4 - 2),
+                             lvl_str, font, cw // 3 - 4, color=(0, 0, 0))
+            if (ship.remodel_ready):
+                draw.rectangle((x + cw // 2 + 2, y + ch * 9 // 16, x + cw * 31 // 32, y + ch * 15 // 16),
+                               outline=(50, 0, 250), width=2)
+
+        cir_start_x = x + 3
+        cir_start_y = y + 3
+        use_damaged = False  # TODO check if use damaged image
+        ico = ship.get_scaled_cg(icon_size(size),
+                                 resample_filter(profile['icon_filter']),
+                                 ico=True, dmg=use_damaged).copy()
+        ico.putalpha(ImageChops.multiply(ico.getchannel('A'),
+                                         get_fade_mask(ico.size)))
+        img.paste(ico, (cir_start_x, cir_start_y), ico)
+
+        draw.rectangle((x, y, x + cw - 1,
+                        y + ch - 1), outline=shade_color, width=3)
+    return img
+
+
+def generate_inventory_screen(member, page, only_dupes=False,
+                              quality=None):
     """Return a BytesIO object of the user's inventory image.
 
     Parameters
@@ -46,120 +545,55 @@ def generate_inventory_screen(member, page, only_dupes=False):
         The page to show.
     only_dupes : bool
         If True, only display ships which the user has two or more of.
+    quality : str
+        The name of the quality profile to draw with, None for the default.
+    """
+    return draw_inventory_screen(InventorySnapshot.take(
+        member.id, "%s#%s" % (member.name, member.discriminator), page,
+        only_dupes), quality)
+
+
+def draw_inventory_screen(snapshot, quality=None):
+    """Return a BytesIO object of an inventory image.
+
+    Parameters
+    ----------
+    snapshot : InventorySnapshot
+        The page of the inventory to draw.
+    quality : str
+        The name of the quality profile to draw with, None for the default.
     """
-    discord_id = member.id
-    user = userinfo.get_user(discord_id)
-    inv = userinfo.get_user_inventory(discord_id)
     layout = CONFIG_DATA['inventory']
+    profile = get_quality(quality)
     w, h = layout['image_size']
-    antialias_value = 2
+    antialias_value = profile['supersample']
     w *= antialias_value
     h *= antialias_value
     sx, sy = layout['per_row'], layout['per_column']
-    cw = int(w / sx)
-    ch = int(h / sy)
+    cw, ch = inventory_cell_size(quality)
     h += layout['lower_padding'] * antialias_value
 
-    ship_pool = inv.inventory
-    if (only_dupes):
-        new_pool = []
-        first_bases = {}
-        for s in ship_pool:
-            first_bases[s.sid] = s.base().get_first_base()
-        for i in range(len(ship_pool)):
-            s = ship_pool.pop(0)
-            if (first_bases[s.sid].sid in map(lambda x:
-                                              first_bases[x.sid].sid, new_pool)
-                or first_bases[s.sid].sid in map(lambda x:
-                                                 first_bases[x.sid].sid,
-                                                 ship_pool)):
-                new_pool.append(s)
-        ship_pool = new_pool
-
-    ships_per_page = sx * sy
-    pages_needed = (len(ship_pool) // ships_per_page) + \
-        (0 if len(ship_pool) % ships_per_page == 0 and len(ship_pool) > 0
-         else 1)
-    if (page < 1):
-        page = 1
-    elif (page > pages_needed):
-        page = pages_needed
-
     img = Image.new(size=(w, h), mode="RGB", color=(255, 255, 255))
 
-    draw = ImageDraw.Draw(img)
+    fleet_ships = snapshot.fleets.get(1, [])
     shade = False
     indx = 0
-    indx += (ships_per_page * (page - 1))
     for xi in range(sx):
         for yi in range(sy):
-            ship = ship_pool[indx] if indx < len(ship_pool) else None
-
-            shade_color = (("filled_color1" if shade else "filled_color2")
-                           if ship else ("empty_color1" if shade else "empty_color2"))
-            rbg = None
-
-            if (ship):
-                rbg = ship_stats.get_rarity_backdrop(ship.base().rarity)
-                rbg = rbg.resize((cw, ch))
-                fleet = userinfo.UserFleet.instance(1, discord_id)
-                if (ship.invid in fleet.ships):
-                    flag = fleet.ships.index(ship.invid) == 0
-                    if flag:
-                        shade_color = 'flag_border_color'
-                    else:
-                        shade_color = "fleet_color1" if shade else "fleet_color2"
-                elif (ship.base().has_seasonal_cg()):
-                    shade_color = "seasonal_color1" if shade else "seasonal_color2"
-
-            shade_color = tuple(layout[shade_color])
+            ship = (snapshot.ships[indx] if indx < len(snapshot.ships)
+                    else None)
+            fleet_role = None
+            if (ship and ship.invid in fleet_ships):
+                flag = fleet_ships.index(ship.invid) == 0
+                fleet_role = "flag" if flag else "fleet"
+            tile = get_inventory_tile(ship, fleet_role, shade, (cw, ch),
+                                      quality)
 
             x, y = (xi * cw, yi * ch)
-            draw.rectangle((x, y, x + cw, y + ch), fill=shade_color)
-            if (rbg):
-                img.paste(rbg, (x, y))
-            if (ship):
-                base = ship.base()
-                font = ImageFont.truetype("fonts/trebucbd.ttf", ch * 1 // 2)
-                num_str = "%s-%04d" % (base.stype, ship.invid)
-                draw_squish_text(img, (x + cw * 3 // 4, y + ch * 1 // 4), num_str,
-                                 font, cw * 7 // 16 - 2, color=(0, 0, 0))
-
-                if (setting('features.levels_enabled')):
-                    if (setting('features.marriage_enabled') and ship.level > setting('levels.level_cap')):
-                        ring = Image.open(small_ico_ring_img)
-                        ring = ring.resize((ch // 3 - 4, ch // 3 - 4))
-                        ring_loc = (x + cw * 8 // 9 - 2, y + ch * 5 // 8 + 2)
-                        draw.ellipse(
-                            (ring_loc, tuple(map(sum, zip(ring_loc, ring.size)))), fill=(0, 0, 0))
-                        img.paste(ring, ring_loc, mask=ring)
-                    font = ImageFont.truetype(
-                        "fonts/trebucbd.ttf", ch * 3 // 8)
-                    lvl_str = "Lv. %02d" % (ship.level)
-                    draw_squish_text(img, (x + 2 + cw * 11 // 16, y + ch * 3 // 4 - 2),
-                                     lvl_str, font, cw // 3 - 4, color=(0, 0, 0))
-                    if (ship.is_remodel_ready()):
-                        draw.rectangle((x + cw // 2 + 2, y + ch * 9 // 16, x + cw * 31 // 32, y + ch * 15 // 16),
-                                       outline=(50, 0, 250), width=2)
-
-                cir_start_x = x + 3
-                cir_start_y = y + 3
-                use_damaged = False  # TODO check if use damaged image
-                ico = base.get_cg(ico=True, dmg=use_damaged)
-                ico = ico.resize((int(ch * 1.5) - 6, ch - 6), Image.BILINEAR)
-                pxls = ico.load()
-                grad_start = int(ico.size[0] * 0.75)
-                grad_end = ico.size[0]
-                for ix in range(grad_start, grad_end):
-                    for iy in range(ico.size[1]):
-                        fade_amt = (ix - grad_start) / (grad_end - grad_start)
-                        fade_amt *= fade_amt
-                        new_alpha = int(pxls[ix, iy][3] * (1 - fade_amt))
-                        pxls[ix, iy] = pxls[ix, iy][:3] + (new_alpha,)
-                img.paste(ico, (cir_start_x, cir_start_y), ico)
-
-                draw.rectangle((x, y, x + cw - 1,
-                                y + ch - 1), outline=shade_color, width=3)
+            img.paste(tile, (x, y))
+            if (yi == sy - 1):
+                # the cell's fill runs one row over the top of the footer
+                img.paste(tile.crop((0, ch - 1, cw, ch)), (x, y + ch))
             shade = not shade
             indx += 1
         if(sy % 2 == 0):
@@ -170,45 +604,47 @@ def generate_inventory_screen(member, page, only_dupes=False):
     x, y = (0, layout['image_size'][1] * antialias_value)
     fw, fh = (w, layout['lower_padding'] * antialias_value)  # size of footer
 
-    display_name = "%s#%s" % (member.name, member.discriminator)
-    font = ImageFont.truetype("fonts/framd.ttf", fh * 3 // 4)
-    o_txt = namesub("<ship_plural.title>") if not only_dupes else "Dupes"
-    draw.text((x + 10, y + fh // 8), "%s's %s" % (display_name, o_txt),
+    font = assetcache.font("fonts/framd.ttf", fh * 3 // 4)
+    o_txt = (namesub("<ship_plural.title>") if not snapshot.only_dupes
+             else "Dupes")
+    draw.text((x + 10, y + fh // 8), "%s's %s" % (snapshot.display_name,
+                                                 o_txt),
               font=font, fill=(0, 0, 0))
 
-    font = ImageFont.truetype("fonts/framdit.ttf", fh // 2)
-    pg_txt = "Page %s of %s" % (page, pages_needed)
+    font = assetcache.font("fonts/framdit.ttf", fh // 2)
+    pg_txt = "Page %s of %s" % (snapshot.page, snapshot.pages_needed)
     pgw, pgh = draw.textsize(pg_txt, font=font)
     pgx, pgy = (fw - pgw - 2, y + fh - pgh - 2)
     draw.text((pgx, pgy), pg_txt, font=font, fill=(50, 50, 50))
 
-    font = ImageFont.truetype("fonts/trebucbd.ttf", fh * 3 // 8)
+    font = assetcache.font("fonts/trebucbd.ttf", fh * 3 // 8)
     rsc_x, rsc_y = (fw * 21 // 32, y + 1)
 
-    txt_fuel = "%05d" % (user.fuel)
-    txt_ammo = "%05d" % (user.ammo)
-    txt_steel = "%05d" % (user.steel)
-    txt_bauxite = "%05d" % (user.bauxite)
-    txt_ships = "%03d / %03d" % (len(ship_pool), user.shipslots)
-    txt_rings = "%01d" % (user.rings)
+    fuel, ammo, steel, bauxite = snapshot.resources
+    txt_fuel = "%05d" % (fuel)
+    txt_ammo = "%05d" % (ammo)
+    txt_steel = "%05d" % (steel)
+    txt_bauxite = "%05d" % (bauxite)
+    txt_ships = "%03d / %03d" % (snapshot.ship_count, snapshot.shipslots)
+    txt_rings = "%01d" % (snapshot.rings)
 
     txt_w, txt_h = draw.textsize(txt_fuel, font)
 
     ico_size = (fh * 3 // 8 + 2, fh * 3 // 8 + 2)
     if (setting('features.resources_enabled')):
-        ico_fuel = Image.open(DIR_PATH + '/icons/fuel.png').resize(ico_size,
-                                                                   Image.LINEAR)
-        ico_ammo = Image.open(DIR_PATH + '/icons/ammo.png').resize(ico_size,
-                                                                   Image.LINEAR)
-        ico_steel = Image.open(DIR_PATH + '/icons/steel.png').resize(ico_size,
-                                                                     Image.LINEAR)
-        ico_bauxite = Image.open(DIR_PATH + '/icons/bauxite.png') \
-            .resize(ico_size, Image.LINEAR)
-    ico_ships = Image.open(DIR_PATH + '/icons/ship.png').resize(ico_size,
-                                                                Image.LINEAR)
+        ico_fuel = assetcache.image(DIR_PATH + '/icons/fuel.png', ico_size,
+                                    Image.LINEAR)
+        ico_ammo = assetcache.image(DIR_PATH + '/icons/ammo.png', ico_size,
+                                    Image.LINEAR)
+        ico_steel = assetcache.image(DIR_PATH + '/icons/steel.png', ico_size,
+                                     Image.LINEAR)
+        ico_bauxite = assetcache.image(DIR_PATH + '/icons/bauxite.png',
+                                       ico_size, Image.LINEAR)
+    ico_ships = assetcache.image(DIR_PATH + '/icons/ship.png', ico_size,
+                                 Image.LINEAR)
     if (setting('features.marriage_enabled') and setting('levels.marriage_ring_required')):
-        ico_rings = Image.open(DIR_PATH + '/icons/marriagepapers.png') \
-            .resize(ico_size, Image.LINEAR)
+        ico_rings = assetcache.image(DIR_PATH + '/icons/marriagepapers.png',
+                                     ico_size, Image.LINEAR)
 
     x_off = ico_size[0] + txt_w + 6
     y_off = ico_size[1] + 2
@@ -238,15 +674,13 @@ def generate_inventory_screen(member, page, only_dupes=False):
     if (setting('features.marriage_enabled') and setting('levels.marriage_ring_required')):
         img.paste(ico_rings, (rsc_x + int(x_off * 3.5), rsc_y), mask=ico_rings)
 
-    img = img.resize((w // antialias_value, h //
-                      antialias_value), Image.ANTIALIAS)
+    if (antialias_value > 1):
+        img = downsample(img, antialias_value, profile['downsample_filter'])
 
-    r = io.BytesIO()
-    img.save(r, format="PNG")
-    return r
+    return encode_image(img, "inventory")
 
 
-def generate_ship_card(bot, ship_instance):
+def generate_ship_card(bot, ship_instance, quality=None):
     """Return a BytesIO object of a card image of the given ship.
 
     Parameters
@@ -255,10 +689,27 @@ def generate_ship_card(bot, ship_instance):
         The bot being run.
     ship_instance : ShipInstance
         The ship to display.
+    quality : str
+        The name of the quality profile to draw with, None for the default.
+    """
+    return draw_ship_card(ShipCardSnapshot.take(bot, ship_instance), quality)
+
+
+def draw_ship_card(snapshot, quality=None):
+    """Return a BytesIO object of a ship's card image.
+
+    Parameters
+    ----------
+    snapshot : ShipCardSnapshot
+        The ship to display.
+    quality : str
+        The name of the quality profile to draw with, None for the default.
     """
-    base = ship_instance.base()
+    profile = get_quality(quality)
+    passes = profile['outline_passes']
+    ship = snapshot.ship
 
-    img = ship_stats.get_rarity_backdrop(base.rarity)
+    img = ship_stats.get_rarity_backdrop(ship.rarity).copy()
 
     layout = CONFIG_DATA['ship_card']
     obj_small_identifier = layout['small_identifier']
@@ -272,95 +723,87 @@ def generate_ship_card(bot, ship_instance):
 
     use_damaged = False  # TODO make this check if ship is damaged
 
-    img_full = base.get_cg(dmg=use_damaged)
-
     if (obj_main_image['enabled']):
-        img_w, img_h = img_full.size
-        targ_width = int(obj_main_image['targ_height'] * (img_w / img_h))
-        x_offset = int(obj_main_image['x_offset'] - (targ_width / 2))
-        img_full = img_full.resize((targ_width, obj_main_image['targ_height']),
-                                   Image.BICUBIC)
+        targ_size = fit_height(ship.get_cg_size(dmg=use_damaged),
+                               obj_main_image['targ_height'])
+        x_offset = int(obj_main_image['x_offset'] - (targ_size[0] / 2))
+        img_full = ship.get_scaled_cg(targ_size,
+                                      resample_filter(profile['cg_filter']),
+                                      dmg=use_damaged)
         img.paste(
             img_full, (x_offset, obj_main_image['y_offset']), mask=img_full)
 
-    if (ship_instance.level > setting('levels.level_cap')):
-        ring = Image.open(small_ico_ring_img)
-        ring = ring.resize((60, 60))
+    if (ship.married):
+        ring = assetcache.image(small_ico_ring_img, (60, 60))
         img.paste(ring, (20, 20), mask=ring)
 
     if (obj_name['enabled']):
-        draw_object(img, obj_name, base.name)
+        draw_object(img, obj_name, ship.name, outline_passes=passes)
     if (obj_class_name['enabled']):
-        draw_object(img, obj_class_name, "%s %s" % (base.class_name,
-                                                    ship_stats.get_ship_type(base.stype).full_name))
+        draw_object(img, obj_class_name, "%s %s" % (ship.class_name,
+                                                    ship_stats.get_ship_type(ship.stype).full_name),
+                    outline_passes=passes)
     if (setting('features.levels_enabled')):
         if (obj_level_indicator['enabled']):
             draw_object(img, obj_level_indicator, "Level %s" %
-                        (ship_instance.level))
-        if (obj_level_progress['enabled'] and (ship_instance.level > 1 or ship_instance.exp > 0)
-                and ship_instance.level != setting('levels.level_cap') and ship_instance.level < setting('levels.level_cap_married')):
-            exp = ship_instance.exp
-            req = ship_instance.exp_req()
+                        (ship.level), outline_passes=passes)
+        if (obj_level_progress['enabled'] and (ship.level > 1 or ship.exp > 0)
+                and ship.level != setting('levels.level_cap') and ship.level < setting('levels.level_cap_married')):
+            exp = ship.exp
+            req = ship.exp_req
             draw_object(img, obj_level_progress, "%s / %s EXP (%.02f%%)" %
-                        (exp, req, 100.0 * exp / req))
-        if (base.remodels_into and obj_next_remodel['enabled']):
-            r_base = ship_stats.ShipBase.instance(base.remodels_into)
-            draw_object(img, obj_next_remodel, "Next Remodel: %s (Level %s)" % (
-                r_base.name, base.remodel_level))
+                        (exp, req, 100.0 * exp / req), outline_passes=passes)
+        if (ship.next_remodel and obj_next_remodel['enabled']):
+            draw_object(img, obj_next_remodel, "Next Remodel: %s (Level %s)" %
+                        ship.next_remodel, outline_passes=passes)
 
     if (obj_small_identifier['enabled']):
         draw_object(img, obj_small_identifier, "%s-%04d" %
-                    (base.stype, ship_instance.invid))
+                    (ship.stype, ship.invid), outline_passes=passes)
 
     if (obj_owned_by['enabled']):
-        display_name = "Unknown User"
-        for g in bot.guilds:
-            owner = g.get_member(ship_instance.owner)
-            if (owner):
-                display_name = "%s#%s" % (owner.name, owner.discriminator)
-                break
-        draw_object(img, obj_owned_by, namesub("Part of %s's <fleet.title>" % (display_name)))
+        draw_object(img, obj_owned_by, namesub("Part of %s's <fleet.title>" % (snapshot.owner_name)),
+                    outline_passes=passes)
 
-    r = io.BytesIO(b'')
-    img.save(r, format="PNG")
-    return r
+    return encode_image(img, "ship_card")
 
 
-def get_birthday_image(base):
+def get_birthday_image(base, quality=None):
     """Return BytesIO object of an image for a ship's birthday.
 
     Parameters
     ----------
     base : ShipBase
         The base object of the ship to celebrate the birthday of.
+    quality : str
+        The name of the quality profile to draw with, None for the default.
     """
-    img_size = (600, 800)
+    profile = get_quality(quality)
+    img_size = BIRTHDAY_SIZE
     img = Image.new(size=img_size, mode="RGB", color=(0, 0, 0))
 
-    backdrop = Image.open(DIR_PATH + '/images/bday_bg.png')
+    backdrop = assetcache.image(DIR_PATH + '/images/bday_bg.png')
     img.paste(backdrop)
 
-    cg = base.get_cg()
-
-    img_w, img_h = cg.size
     targ_height = img_size[1] * 3 // 4
-    targ_width = int(targ_height * (img_w / img_h))
+    targ_width, _ = fit_height(base.get_cg_size(), targ_height)
     x_offset = int((img_size[0] / 2) - (targ_width / 2))
-    cg = cg.resize((targ_width, targ_height), Image.BICUBIC)
+    cg = base.get_scaled_cg((targ_width, targ_height),
+                            resample_filter(profile['cg_filter']))
     img.paste(cg, (x_offset, 0), mask=cg)
 
-    font = ImageFont.truetype("fonts/impact.ttf", 60)
+    font = assetcache.font("fonts/impact.ttf", 60)
     draw_squish_text(img, (img_size[0] // 2, targ_height + 20),
                      "Happy Birthday", font, img_size[0] - 20, color=(0, 0, 0),
-                     outline=(125, 125, 125))
-    font_2 = ImageFont.truetype("fonts/impact.ttf", 80)
+                     outline=(125, 125, 125),
+                     outline_passes=profile['outline_passes'])
+    font_2 = assetcache.font("fonts/impact.ttf", 80)
     draw_squish_text(img, (img_size[0] // 2, targ_height + 110), "%s!"
                      % (base.name), font_2, img_size[0] - 20, color=(0, 0, 0),
-                     outline=(125, 125, 125))
+                     outline=(125, 125, 125),
+                     outline_passes=profile['outline_passes'])
 
-    r = io.BytesIO(b'')
-    img.save(r, format="PNG")
-    return r
+    return encode_image(img, "birthday")
 
 
 def generate_sortie_card(sortie):
@@ -387,11 +830,12 @@ def generate_sortie_card(sortie):
     img = Image.new(size=(orig_w + padding_s + info_w, orig_h + padding_s
                           + info_h), mode="RGB", color=(255, 255, 255))
 
-    bg = Image.open(large_bg_map_img)
-    bg = bg.resize((orig_w + padding_s, orig_h + padding_s), Image.LINEAR)
+    bg = assetcache.image(large_bg_map_img,
+                          (orig_w + padding_s, orig_h + padding_s),
+                          Image.LINEAR)
     img.paste(bg, (0, 0))
 
-    font = ImageFont.truetype("fonts/framd.ttf", 20)
+    font = assetcache.font("fonts/framd.ttf", 20)
     draw = ImageDraw.Draw(img)
     for pos, node in sortie.nodes:
         pos = (pos[0] + padding, pos[1] + padding)
@@ -442,21 +886,21 @@ def generate_sortie_card(sortie):
             txt_y += 22
         txt_y += 10
 
-    r = io.BytesIO(b'')
-    img.save(r, format="PNG")
-    return r
+    return encode_image(img, "sortie")
 
 
-def draw_object(img, obj, text, center_height=True, repeat=1):
+def draw_object(img, obj, text, center_height=True, repeat=1,
+                outline_passes=3):
     """Draw a configuration object using its JSON Parameters."""
-    font = ImageFont.truetype(obj['font'], obj['font_size'])
+    font = assetcache.font(obj['font'], obj['font_size'])
     draw_squish_text(img, tuple(obj['position']), text, font, obj['width'], color=tuple(obj['color']),
-                     outline=tuple(obj['outline']), center_height=center_height, repeat=repeat)
+                     outline=tuple(obj['outline']), center_height=center_height, repeat=repeat,
+                     outline_passes=outline_passes)
 
 
 def draw_squish_text(img, position, text, font, max_width,
                      color=(255, 255, 255), outline=None, center_height=True,
-                     repeat=1):
+                     repeat=1, outline_passes=3):
     """Draw centered text and squish it if it is too wide.
 
     Parameters
@@ -480,14 +924,11 @@ def draw_squish_text(img, position, text, font, max_width,
         True if the text should be centered vertically.
     repeat : int
         Amount of times to repeat drawing this text, for sharpness.
+    outline_passes : int
+        Amount of times to draw the outline for each repeat.
     """
-    draw = ImageDraw.Draw(img)
-    w, h = draw.textsize(text, font=font)
-    text_img = Image.new(size=(w, h), color=(0, 0, 0, 0), mode="RGBA")
-    tdraw = ImageDraw.Draw(text_img)
-    draw_outline(tdraw, (0, 0), text, font, color, outline, repeat)
-    if (max_width < w):
-        text_img = text_img.resize((max_width, h), Image.BILINEAR)
+    text_img = get_text_sprite(text, font, max_width, color, outline,
+                               repeat, outline_passes)
     w, h = text_img.size
     paste_x = int(position[0] - (w / 2))
     if center_height:
@@ -495,7 +936,33 @@ def draw_squish_text(img, position, text, font, max_width,
     else:
         paste_y = position[1]
     img.paste(text_img, (paste_x, paste_y), mask=text_img)
-    del draw
+
+
+def get_text_sprite(text, font, max_width, color=(255, 255, 255),
+                    outline=None, repeat=1, outline_passes=3):
+    """Return an image of the text, squished to fit max_width.
+
+    Sprites are cached, so common labels like levels and ship names are
+    only drawn once. See draw_squish_text for the parameters.
+
+    Returns
+    -------
+    PIL.Image
+        The shared cached RGBA sprite, don't draw on it.
+    """
+    key = (text, font.path, font.size, max_width, color, outline, repeat,
+           outline_passes)
+    sprite = sprite_cache.get(key)
+    if (sprite is None):
+        stroke = 1 if outline else 0
+        w, h = _measure.textsize(text, font=font, stroke_width=stroke)
+        sprite = Image.new(size=(w, h), color=(0, 0, 0, 0), mode="RGBA")
+        draw_outline(ImageDraw.Draw(sprite), (stroke, stroke), text, font,
+                     color, outline, repeat, outline_passes)
+        if (max_width < w):
+            sprite = sprite.resize((max_width, h), Image.BILINEAR)
+        sprite_cache.put(key, sprite)
+    return sprite
 
 
 def draw_centered_text(draw, position, text, font, color=(255, 255, 255),
@@ -531,8 +998,9 @@ def draw_centered_text(draw, position, text, font, color=(255, 255, 255),
     draw_outline(draw, start_loc, text, font, color, outline, repeat)
 
 
-def draw_outline(draw, position, text, font, fill, outline, repeat):
-    """Draw text with an outline.
+def draw_outline(draw, position, text, font, fill, outline, repeat,
+                 outline_passes=3):
+    """Draw text with a one pixel outline.
 
     Parameters
     ----------
@@ -550,13 +1018,14 @@ def draw_outline(draw, position, text, font, fill, outline, repeat):
         3-tuple of the color of the outline, None for no outline
     repeat : int
         Amount of times to repeat drawing this text, for sharpness.
+    outline_passes : int
+        Amount of times to draw the outline for each repeat, more passes
+        make its antialiased edge darker.
     """
     x, y = position
     if (outline):
-        for i in range(repeat * 3):
-            draw.text((x-1, y-1), text, font=font, fill=outline)
-            draw.text((x+1, y-1), text, font=font, fill=outline)
-            draw.text((x-1, y-1), text, font=font, fill=outline)
-            draw.text((x+1, y+1), text, font=font, fill=outline)
+        for i in range(repeat * outline_passes):
+            draw.text((x, y), text, font=font, fill=fill, stroke_width=1,
+                      stroke_fill=outline)
     for i in range(repeat):
         draw.text((x, y), text, font=font, fill=fill)
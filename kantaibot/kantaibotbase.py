@@ -3,10 +3,15 @@ import discord
 from discord.ext import commands
 import asyncio
 import imggen
+import render
 import io
 import drophandler
 import craftinghandler
 import userinfo
+import asyncdb
+import assetcache
+import cgdownload
+import backups
 import os
 import traceback
 import sys
@@ -15,7 +20,6 @@ import sorties
 import ship_stats
 import json
 import datetime
-import subprocess
 import logging
 from settings import setting, namesub, setting_random
 
@@ -28,23 +32,27 @@ DROP_COOLDOWN = setting('cooldowns.drop')
 CRAFTING_COOLDOWN = setting('cooldowns.craft')
 TRAINING_COOLDOWN = setting('cooldowns.train')
 
+# sent when a command's checks no longer held once it went to save, e.g. the
+# same command was used twice at once
+CONFLICT_MESSAGE = "Your data changed while that was happening, so nothing " \
+    "was done. Try again!"
+
 
 @bot.command(help=namesub("Show a <ship.title> from your inventory"), usage="[Ship ID]")
 async def show(ctx, shipid: int):
     """Show the specified ship from the user's inventory."""
     did = ctx.author.id
-    inv = userinfo.get_user_inventory(did)
-    ins = [x for x in inv.inventory if x.invid == shipid]
-    if (len(ins) > 0):
-        ship_instance = ins.pop()
+    inv = await asyncdb.inventories.get(did)
+    ship_instance = inv.get(shipid)
+    if (ship_instance):
         base = ship_instance.base()
-        image_file = imggen.generate_ship_card(ctx.bot, ship_instance)
+        image_file = await render.ship_card(ctx.bot, ship_instance)
         if (ship_instance.level > setting('levels.level_cap')):
             quote = base.get_quote('married')
         else:
             quote = base.get_quote('idle')
         await ctx.send(file=discord.File(io.BytesIO(image_file.getvalue()),
-                                         filename="image.png"),
+                                         filename=image_file.name),
                        content="%s: *%s*" % (base.name, quote))
     else:
         await ctx.send(namesub("<ship.title> with ID %s not found in your inventory") % (
@@ -59,22 +67,29 @@ async def drop(ctx):
     if (not setting('features.drop_enabled')):
         await ctx.send("That feature is not enabled.")
         return
-    if (userinfo.has_space_in_inventory(did)):
-        cd = userinfo.check_cooldown(did, 'Last_Drop', DROP_COOLDOWN)
+    if (await asyncdb.users.has_space(did)):
+        cd = await asyncdb.users.cooldown(did, 'Last_Drop', DROP_COOLDOWN,
+                                          set_if_off=False)
         if (cd == 0):
             drop = drophandler.get_random_drop(did, only_droppable=True)
             ship_base = drop.base()
             ship_name = ship_base.name
             ship_rarity = ship_base.rarity
             rarity = setting('rarities')
-            inv = userinfo.get_user_inventory(did)
-            inv.add_to_inventory(drop)
-            image_file = imggen.generate_ship_card(ctx.bot, drop)
+            with userinfo.UnitOfWork() as uow:
+                userinfo.require_space(did)
+                userinfo.require_cooldown(did, 'Last_Drop', DROP_COOLDOWN)
+                userinfo.UserInventory(did).add_to_inventory(drop)
+                userinfo.set_cooldown(did, 'Last_Drop')
+            if (not await asyncdb.apply(did, uow)):
+                await ctx.send(CONFLICT_MESSAGE)
+                return
+            image_file = await render.ship_card(ctx.bot, drop)
 
             await ctx.send(
                 file=discord.File(
                     io.BytesIO(image_file.getvalue()),
-                    filename="image.png"),
+                    filename=image_file.name),
                 content="%s got %s! (%s)\n\n%s: *%s*" % (
                         ctx.author.display_name, ship_name,
                         rarity[ship_rarity - 1], ship_name,
@@ -95,9 +110,9 @@ async def drop(ctx):
 @bot.command(help="Show your inventory", usage="(Page #)")
 async def inv(ctx, page: int=1):
     """Show the user's inventory."""
-    image_file = imggen.generate_inventory_screen(ctx.author, page)
+    image_file = await render.inventory(ctx.author, page)
     await ctx.send(file=discord.File(io.BytesIO(image_file.getvalue()),
-                                     filename="image.png"))
+                                     filename=image_file.name))
 
 
 @bot.command(help=namesub("Craft a <ship.title> with the given resources"),
@@ -106,12 +121,12 @@ async def inv(ctx, page: int=1):
 async def craft(ctx, fuel: int, ammo: int, steel: int, bauxite: int):
     """Craft a random ship based on the user's inputted resources."""
     did = ctx.author.id
-    user = userinfo.get_user(did)
+    user = await asyncdb.users.get(did)
     if (not setting('features.crafting_enabled') or not setting('features.resources_enabled')):
         await ctx.send("That feature is not enabled.")
         return
-    if (userinfo.has_space_in_inventory(did)):
-        cd = userinfo.check_cooldown(
+    if (await asyncdb.users.has_space(did)):
+        cd = await asyncdb.users.cooldown(
             did, 'Last_Craft', CRAFTING_COOLDOWN, set_if_off=False)
         if (cd == 0):
             min_craft = setting('resources.min_crafting')
@@ -120,20 +135,27 @@ async def craft(ctx, fuel: int, ammo: int, steel: int, bauxite: int):
                 if (user.has_enough(fuel, ammo, steel, bauxite)):
                     craft = craftinghandler.get_craft_from_resources(
                         did, fuel, ammo, steel, bauxite)
-                    user.mod_fuel(-fuel)
-                    user.mod_ammo(-ammo)
-                    user.mod_steel(-steel)
-                    user.mod_bauxite(-bauxite)
-                    inv = userinfo.get_user_inventory(did)
-                    inv.add_to_inventory(craft)
-                    # set cooldown
-                    userinfo.check_cooldown(
-                        did, 'Last_Craft', CRAFTING_COOLDOWN, set_if_off=True)
-                    image_file = imggen.generate_ship_card(ctx.bot, craft)
+
+                    with userinfo.UnitOfWork() as uow:
+                        userinfo.require_space(did)
+                        userinfo.require_cooldown(did, 'Last_Craft',
+                                                  CRAFTING_COOLDOWN)
+                        userinfo.require_resources(did, fuel, ammo, steel,
+                                                   bauxite)
+                        user.mod_fuel(-fuel)
+                        user.mod_ammo(-ammo)
+                        user.mod_steel(-steel)
+                        user.mod_bauxite(-bauxite)
+                        userinfo.UserInventory(did).add_to_inventory(craft)
+                        userinfo.set_cooldown(did, 'Last_Craft')
+                    if (not await asyncdb.apply(did, uow)):
+                        await ctx.send(CONFLICT_MESSAGE)
+                        return
+                    image_file = await render.ship_card(ctx.bot, craft)
                     ship_base = craft.base()
                     await ctx.send(
                         file=discord.File(io.BytesIO(image_file.getvalue()),
-                                          filename="image.png"),
+                                          filename=image_file.name),
                         content="%s just crafted %s!\n\n%s: *%s*" % (
                             ctx.author.display_name, ship_base.name,
                             ship_base.name, ship_base.get_quote('intro')))
@@ -160,17 +182,22 @@ async def craft(ctx, fuel: int, ammo: int, steel: int, bauxite: int):
 async def scrap(ctx, shipid: int):
     """Scrap the given ship from the user's inventory."""
     did = ctx.author.id
-    user = userinfo.get_user(did)
-    inv = userinfo.get_user_inventory(did)
-    ins = [x for x in inv.inventory if x.invid == shipid]
-    if (len(ins) > 0):
-        ship_instance = ins.pop()
+    user = await asyncdb.users.get(did)
+    inv = await asyncdb.inventories.get(did)
+    ship_instance = inv.get(shipid)
+    if (ship_instance):
         base = ship_instance.base()
-        user.mod_fuel(setting_random('resources.scrap_gain.fuel'))
-        user.mod_ammo(setting_random('resources.scrap_gain.ammo'))
-        user.mod_steel(setting_random('resources.scrap_gain.steel'))
-        user.mod_bauxite(setting_random('resources.scrap_gain.bauxite'))
-        inv.remove_from_inventory(shipid)
+
+        with userinfo.UnitOfWork() as uow:
+            userinfo.require_ships(did, [shipid])
+            user.mod_fuel(setting_random('resources.scrap_gain.fuel'))
+            user.mod_ammo(setting_random('resources.scrap_gain.ammo'))
+            user.mod_steel(setting_random('resources.scrap_gain.steel'))
+            user.mod_bauxite(setting_random('resources.scrap_gain.bauxite'))
+            inv.remove_from_inventory(shipid)
+        if (not await asyncdb.apply(did, uow)):
+            await ctx.send(CONFLICT_MESSAGE)
+            return
         await ctx.send("Scrapped %s... <:roosad:434916104268152853>" % (
             base.name))
         logging.info("[Scrap] %s (%s) scrapped ship %s with inv id %s" %
@@ -184,10 +211,9 @@ async def scrap(ctx, shipid: int):
              usage="(Page #)")
 async def dupes(ctx, page: int=1):
     """Show all the ships the user has two or more of."""
-    image_file = imggen.generate_inventory_screen(
-        ctx.author, page, only_dupes=True)
+    image_file = await render.inventory(ctx.author, page, only_dupes=True)
     await ctx.send(file=discord.File(io.BytesIO(image_file.getvalue()),
-                                     filename="image.png"))
+                                     filename=image_file.name))
 
 
 @bot.command(help=namesub("Remodel a <ship.title> if it is a high enough level"),
@@ -198,22 +224,21 @@ async def remodel(ctx, shipid: int):
         await ctx.send("That feature is not enabled.")
         return
     did = ctx.author.id
-    inv = userinfo.get_user_inventory(did)
-    ins = [x for x in inv.inventory if x.invid == shipid]
-    if (len(ins) > 0):
-        ship_instance = ins.pop()
+    inv = await asyncdb.inventories.get(did)
+    ship_instance = inv.get(shipid)
+    if (ship_instance):
         base = ship_instance.base()
         if (base.remodels_into):
             if (ship_instance.is_remodel_ready()):
                 old_name = base.name
-                ship_instance.sid = base.remodels_into
+                inv.change_sid(ship_instance, base.remodels_into)
                 base = ship_instance.base()
                 new_name = base.name
-                userinfo.update_ship_sid(ship_instance)
-                image_file = imggen.generate_ship_card(ctx.bot, ship_instance)
+                await asyncdb.inventories.update_sid(ship_instance)
+                image_file = await render.ship_card(ctx.bot, ship_instance)
                 await ctx.send(file=discord.File(
                     io.BytesIO(image_file.getvalue()),
-                    filename="image.png"),
+                    filename=image_file.name),
                                content="%s: *%s*" % (new_name,
                                                      base.get_quote('remodel')
                                                      ))
@@ -258,20 +283,23 @@ async def train(ctx, dif: int=-1):
     else:
         if (dif > 0 and dif <= len(difs)):
             dif_targ = difs[dif - 1]
-            fleet = userinfo.UserFleet.instance(1, did)
+            fleet = await asyncdb.fleets.get(did)
             if (len(fleet.ships) > 0):
-                ins = fleet.get_ship_instances()
+                ins = await asyncdb.fleets.ships(fleet)
                 flag = ins[0]
                 if (flag.level >= dif_targ.min_flag):
-                    rsc = dif_targ.resource_costs(fleet)
+                    rsc = await asyncdb.run(did, dif_targ.resource_costs,
+                                            fleet)
                     rsc = tuple(map(int, rsc))
-                    user = userinfo.get_user(did)
+                    user = await asyncdb.users.get(did)
                     if (user.has_enough(*rsc)):
-                        cd = userinfo.check_cooldown(
-                            did, "Last_Training", TRAINING_COOLDOWN)
+                        cd = await asyncdb.users.cooldown(
+                            did, "Last_Training", TRAINING_COOLDOWN,
+                            set_if_off=False)
                         if (cd == 0):
                             # conditions passed
-                            rank = dif_targ.rank_training(fleet)
+                            rank = await asyncdb.run(
+                                did, dif_targ.rank_training, fleet)
 
                             exp_rew_base = rank.exp_mult \
                                 * dif_targ.exp_reward_base
@@ -284,14 +312,24 @@ async def train(ctx, dif: int=-1):
                             exp = list(map(lambda x: x + exp_per, exp))
 
                             lvl_dif = [x.level for x in ins]
-                            for i in range(len(ins)):
-                                ins[i].add_exp(exp[i])
-                                lvl_dif[i] = ins[i].level - lvl_dif[i]
-
-                            user.mod_fuel(-rsc[0])
-                            user.mod_ammo(-rsc[1])
-                            user.mod_steel(-rsc[2])
-                            user.mod_bauxite(-rsc[3])
+                            with userinfo.UnitOfWork() as uow:
+                                userinfo.require_cooldown(
+                                    did, "Last_Training", TRAINING_COOLDOWN)
+                                userinfo.require_resources(did, *rsc)
+                                userinfo.require_ships(
+                                    did, [x.invid for x in ins])
+                                for i in range(len(ins)):
+                                    ins[i].add_exp(exp[i])
+                                    lvl_dif[i] = ins[i].level - lvl_dif[i]
+
+                                user.mod_fuel(-rsc[0])
+                                user.mod_ammo(-rsc[1])
+                                user.mod_steel(-rsc[2])
+                                user.mod_bauxite(-rsc[3])
+                                userinfo.set_cooldown(did, "Last_Training")
+                            if (not await asyncdb.apply(did, uow)):
+                                await ctx.send(CONFLICT_MESSAGE)
+                                return
 
                             embed = discord.Embed(title="Training %s" % (
                                 "Success" if rank.is_success else "Failed"))
@@ -361,7 +399,7 @@ async def cooldowns(ctx):
     msg = "Current cooldowns for %s:\n" % ctx.author.display_name
     msg += "```\n"
     for cd, name, cd_s in cd_check:
-        t = userinfo.check_cooldown(did, cd, cd_s, set_if_off=False)
+        t = await asyncdb.users.cooldown(did, cd, cd_s, set_if_off=False)
         if (t > 0):
             hrs = t // 3600
             min = t // 60 % 60
@@ -381,11 +419,10 @@ async def marry(ctx, shipid: int):
     if (not setting('features.marriage_enabled') or not setting('features.levels_enabled')):
         await ctx.send("This feature is not enabled.")
     did = ctx.author.id
-    user = userinfo.get_user(did)
-    inv = userinfo.get_user_inventory(did)
-    ins = [x for x in inv.inventory if x.invid == shipid]
-    if (len(ins) > 0):
-        ship_instance = ins.pop()
+    user = await asyncdb.users.get(did)
+    inv = await asyncdb.inventories.get(did)
+    ship_instance = inv.get(shipid)
+    if (ship_instance):
         base = ship_instance.base()
         if (ship_instance.level == setting('levels.level_cap')):
             ring_req = setting('levels.marriage_ring_required')
@@ -393,13 +430,22 @@ async def marry(ctx, shipid: int):
             if (rings > 0 or not ring_req):
                 ship_instance.level = setting('levels.level_cap') + 1
                 ship_instance.exp = 0
-                ship_instance.add_exp(0)
-                if (ring_req):
-                    user.use_ring()
+
+                with userinfo.UnitOfWork() as uow:
+                    userinfo.require_ships(
+                        did, [shipid], max_level=setting('levels.level_cap'))
+                    if (ring_req):
+                        userinfo.require_rings(did)
+                    ship_instance.add_exp(0)
+                    if (ring_req):
+                        user.use_ring()
+                if (not await asyncdb.apply(did, uow)):
+                    await ctx.send(CONFLICT_MESSAGE)
+                    return
                 ship_name = base.name
-                image_file = imggen.generate_ship_card(ctx.bot, ship_instance)
+                image_file = await render.ship_card(ctx.bot, ship_instance)
                 await ctx.send(file=discord.File(
-                    io.BytesIO(image_file.getvalue()), filename="image.png"),
+                    io.BytesIO(image_file.getvalue()), filename=image_file.name),
                                content="%s: *%s*" % (ship_name,
                                                      base.get_quote('married')
                                                      ))
@@ -419,38 +465,66 @@ async def marry(ctx, shipid: int):
 async def newmap(ctx):
     """Debug function to show a generated map."""
     sortie = sorties.random_sortie()
-    image_file = imggen.generate_sortie_card(sortie)
+    image_file = await render.sortie_card(sortie)
     await ctx.send(file=discord.File(io.BytesIO(image_file.getvalue()),
-                                     filename="image.png"))
+                                     filename=image_file.name))
 
 
-@bot.command(help=namesub("Admin command to add a <ship.title> to someone's inventory"),
+@bot.command(help="Show cache sizes and hit rates", hidden=True)
+@commands.is_owner()
+async def cachestats(ctx):
+    """Debug function to show how well the caches are doing."""
+    lines = [userinfo.user_cache.format_stats("Users")]
+    lines += assetcache.format_stats()
+    lines.append(imggen.tile_cache.format_stats("Tiles"))
+    lines.append(imggen.sprite_cache.format_stats("Text sprites"))
+    lines += render.png_cache.format_stats("Renders")
+    lines.append(cgdownload.downloads.format_stats())
+    await ctx.send("```\n%s\n```" % "\n".join(lines))
+
+
+@bot.command(help="Show image render queue and timings", hidden=True)
+@commands.is_owner()
+async def renderstats(ctx):
+    """Debug function to show how busy the render pool is."""
+    await ctx.send("```\n%s\n```" % "\n".join(render.pool.format_stats()))
+
+
+@bot.command(help=namesub("Admin command to add <ship_plural> to people's inventories"),
+             usage=namesub("[@users...] [<ship.title> name] (Amount)"),
              hidden=True)
 @commands.is_owner()
-async def add_ship(ctx, user: discord.Member, ship_name):
-    """Admin command to add a ship to a user's inventory."""
-    inv = userinfo.get_user_inventory(user.id)
+async def add_ship(ctx, users: commands.Greedy[discord.Member], ship_name,
+                   amount: int=1):
+    """Admin command to add ships to one or more users' inventories."""
     targ = None
     for ship in ship_stats.get_all_ships():
         if (ship.name.lower() == ship_name.lower() or ship.name.lower()
                 .replace(' ', '_') == ship_name.lower()):
             targ = ship
             break
-    if (targ):
-        ins = ship_stats.ShipInstance.new(targ.sid, user.id)
-        inv.add_to_inventory(ins)
-        await ctx.send("Added %s to %s's inventory" % (targ.name, str(user)))
-        logging.info("[ADMIN_ADD] Added %s to %s's (%s) inventory" %
-                     (targ.name, str(user), user.id))
+    if (len(users) == 0):
+        await ctx.send("Please mention at least one user")
+    elif (amount < 1):
+        await ctx.send("Amount must be at least 1")
+    elif (targ):
+        # each user's batch runs on their own lane
+        await asyncio.gather(*[asyncdb.inventories.add_many(
+            user.id, [ship_stats.ShipInstance.new(targ.sid, user.id)
+                      for _ in range(amount)]) for user in users])
+        await ctx.send("Added %s x%s to %s" % (
+            targ.name, amount, ", ".join("%s's inventory" % str(user)
+                                         for user in users)))
+        for user in users:
+            logging.info("[ADMIN_ADD] Added %s x%s to %s's (%s) inventory" %
+                         (targ.name, amount, str(user), user.id))
     else:
         await ctx.send(namesub("Cannot find <ship.title> '%s'") % ship_name)
 
 
 def fleet_strings(inv, fleet_s):
     """Return a list of strings detailing the given fleet's information."""
-    ship_ins = list(
-        map(lambda x: [y for y in inv.inventory if y.invid == x].pop(),
-            fleet_s.ships))
+    ship_ins = [inv.get(x) for x in fleet_s.ships]
     ship_data = list(map(lambda x: "*%s* (L%02d, %s)" %
                          (x.base().name, x.level, x.base().stype), ship_ins))
     return ship_data
@@ -466,9 +540,9 @@ async def fleet(ctx):
         return
     if (not ctx.invoked_subcommand):
         did = ctx.author.id
-        fleet = userinfo.UserFleet.instance(1, did)
+        fleet = await asyncdb.fleets.get(did)
         if(len(fleet.ships) > 0):
-            ins = fleet.get_ship_instances()
+            ins = await asyncdb.fleets.ships(fleet)
             fleet_lvl = sum(x.level for x in ins) // len(ins)
 
             embed = discord.Embed(title=namesub("%s's <fleet.title>") % str(ctx.author))
@@ -498,16 +572,16 @@ async def f_add(ctx, shipid: int):
         await ctx.send("That feature is not enabled.")
         return
     did = ctx.author.id
-    fleet = userinfo.UserFleet.instance(1, did)
-    inv = userinfo.get_user_inventory(did)
-    ins = [x for x in inv.inventory if x.invid == shipid]
-    if (len(ins) > 0):
-        ins = ins.pop()
+    fleet = await asyncdb.fleets.get(did)
+    inv = await asyncdb.inventories.get(did)
+    ins = inv.get(shipid)
+    if (ins):
         if (shipid not in fleet.ships):
-            if (not fleet.has_similar(ins.sid)):
+            if (not any(x.invid in fleet.ships
+                        for x in inv.by_base(ins.sid))):
                 if (len(fleet.ships) < setting('fleets.fleet_capacity')):
                     fleet.ships.append(shipid)
-                    fleet.update()
+                    await asyncdb.fleets.update(fleet)
                     await ctx.send(namesub("Added %s to <fleet> %s\n\n%s: *%s*") % (
                         ins.base().name, 1, ins.base().name,
                         ins.base().get_quote('fleet_join')))
@@ -532,32 +606,29 @@ async def f_set(ctx, *ships):
         await ctx.send("That feature is not enabled.")
         return
     did = ctx.author.id
-    fleet = userinfo.UserFleet.instance(1, did)
-    inv = userinfo.get_user_inventory(did)
+    fleet = await asyncdb.fleets.get(did)
+    inv = await asyncdb.inventories.get(did)
     sids_raw = map(int, ships)
-    sids_raw = [x for x in sids_raw if x >
-                0 and x in map(lambda n: n.invid, inv.inventory)]
+    sids_raw = [x for x in sids_raw if x > 0 and inv.get(x)]
     # check for no dupes while still keeping order
     sids = []
+    used_sids = set()
     for x in sids_raw:
-        if x in sids:
-            continue
-        sid = [y for y in inv.inventory if y.invid == x].pop().sid
-        if sid in map(lambda y: [z for z in inv.inventory if z.invid == y]
-                      .pop().sid, sids):
+        sid = inv.get(x).sid
+        if x in sids or sid in used_sids:
             continue
         sids.append(x)
+        used_sids.add(sid)
     if (len(sids) == 0):
         await ctx.send(namesub("Please include at least one valid <ship.title> ID"))
     elif(len(sids) > setting('fleets.fleet_capacity')):
         await ctx.send(namesub("Too many <ship_plural> in the <fleet>!"))
     else:
         fleet.ships = sids
-        fleet.update()
+        await asyncdb.fleets.update(fleet)
         strs = fleet_strings(inv, fleet)
         flag = strs.pop(0)
-        line_base = [x for x in inv.inventory if x.invid ==
-                     sids[0]].pop().base()
+        line_base = inv.get(sids[0]).base()
         if (len(strs) > 0):
             await ctx.send(namesub("Set <fleet> %s to: <flagship.title> %s, <ship_plural> %s\n\n%s: *%s*")
                            % (1, flag, ", ".join(strs), line_base.name,
@@ -578,11 +649,10 @@ async def f_flag(ctx, flagship: int):
         await ctx.send("That feature is not enabled.")
         return
     did = ctx.author.id
-    fleet = userinfo.UserFleet.instance(1, did)
-    inv = userinfo.get_user_inventory(did)
-    ins = [x for x in inv.inventory if x.invid == flagship]
-    if (len(ins) > 0):
-        ins = ins.pop()
+    fleet = await asyncdb.fleets.get(did)
+    inv = await asyncdb.inventories.get(did)
+    ins = inv.get(flagship)
+    if (ins):
         cancel = False
         if (len(fleet.ships) > 0):
             old_flag = fleet.ships.pop(0)
@@ -593,8 +663,7 @@ async def f_flag(ctx, flagship: int):
                     if (len(fleet.ships) > setting('fleets.fleet_capacity')):
                         cancel = True
                         await ctx.send(namesub("<fleet.title> %s is full!") % (1))
-                    if ins.sid in map(lambda x: [y for y in inv.inventory
-                                                 if y.invid == x].pop().sid,
+                    if ins.sid in map(lambda x: inv.get(x).sid,
                                       fleet.ships):
                         cancel = True
                         await ctx.send(namesub("You already have another %s in <fleet> "
@@ -608,7 +677,7 @@ async def f_flag(ctx, flagship: int):
         else:
             fleet.ships = [flagship, ]
         if (not cancel):
-            fleet.update()
+            await asyncdb.fleets.update(fleet)
             await ctx.send(namesub("Set %s as the <flagship> of <fleet> %s\n\n%s: *%s*") % (
                 ins.base().name, 1, ins.base().name,
                 ins.base().get_quote('fleet_join')))
@@ -626,15 +695,14 @@ async def f_rem(ctx, shipid: int):
         await ctx.send("That feature is not enabled.")
         return
     did = ctx.author.id
-    fleet = userinfo.UserFleet.instance(1, did)
-    inv = userinfo.get_user_inventory(did)
-    ins = [x for x in inv.inventory if x.invid == shipid]
-    if (len(ins) > 0):
-        ins = ins.pop()
+    fleet = await asyncdb.fleets.get(did)
+    inv = await asyncdb.inventories.get(did)
+    ins = inv.get(shipid)
+    if (ins):
         base = ins.base()
         if (shipid in fleet.ships):
             fleet.ships.remove(shipid)
-            fleet.update()
+            await asyncdb.fleets.update(fleet)
             await ctx.send(namesub("Removed %s from <fleet> %s!") % (base.name, 1))
         else:
             await ctx.send(namesub("%s isn't in <fleet> %s!") % (base.name, 1))
@@ -651,9 +719,9 @@ async def f_clear(ctx):
         await ctx.send("That feature is not enabled.")
         return
     did = ctx.author.id
-    fleet = userinfo.UserFleet.instance(1, did)
+    fleet = await asyncdb.fleets.get(did)
     fleet.ships = []
-    fleet.update()
+    await asyncdb.fleets.update(fleet)
     await ctx.send(namesub("Cleared <fleet> %s!") % (1))
 
 
@@ -668,6 +736,34 @@ async def on_ready():
 BONUS_COOLDOWN = 120
 
 
+def passive_gain(did):
+    """Buffer a user's passive resource and flagship gains if off cooldown.
+
+    Returns
+    -------
+    ShipInstance
+        The user's flagship if it levelled up, otherwise None.
+    """
+    if (userinfo.check_cooldown(did, 'Last_Bonus', BONUS_COOLDOWN,
+                                deferred=True) > 0):
+        return None
+    if (setting('features.resources_enabled')):
+        userinfo.pending.add_resources(
+            did,
+            RFuel=setting_random('resources.passive_gain.fuel'),
+            RAmmo=setting_random('resources.passive_gain.ammo'),
+            RSteel=setting_random('resources.passive_gain.steel'),
+            RBauxite=setting_random('resources.passive_gain.bauxite'))
+
+    fleet = userinfo.UserFleet.instance(1, did)
+    if (setting('features.levels_enabled') and len(fleet.ships) > 0):
+        si_flag = userinfo.get_ship_instance(did, fleet.ships[0])
+        flag_exp = setting_random('levels.passive_flag_bonus')
+        if (userinfo.pending.add_ship_exp(si_flag, flag_exp)):
+            return si_flag
+    return None
+
+
 @bot.event
 async def on_message(message):
     """Run when a user sends a message that the bot can see."""
@@ -682,24 +778,14 @@ async def on_message(message):
                                  message.author.discriminator, message.content)
             await chnl.send(msg)
             logging.info("[PM] %s" % msg)
-        elif (userinfo.check_cooldown(did, 'Last_Bonus', BONUS_COOLDOWN) == 0):
-            user = userinfo.get_user(did)
-            user.mod_fuel(setting_random('resources.passive_gain.fuel'))
-            user.mod_ammo(setting_random('resources.passive_gain.ammo'))
-            user.mod_steel(setting_random('resources.passive_gain.steel'))
-            user.mod_bauxite(setting_random('resources.passive_gain.bauxite'))
-
-            fleet = userinfo.UserFleet.instance(1, did)
-            if (setting('features.levels_enabled') and len(fleet.ships) > 0):
-                si_flag = fleet.get_ship_instances()[0]
-                flag_exp = setting_random('levels.passive_flag_bonus')
-                lvl = si_flag.add_exp(flag_exp)
-                if (lvl):
-                    await message.channel.send("**%s** - *%s* has leveled up! "
-                                               "(Level %s!)"
-                                               % (message.author.display_name,
-                                                   si_flag.base().name,
-                                                   si_flag.level))
+        else:
+            si_flag = await asyncdb.run(did, passive_gain, did)
+            if (si_flag):
+                await message.channel.send("**%s** - *%s* has leveled up! "
+                                           "(Level %s!)"
+                                           % (message.author.display_name,
+                                              si_flag.base().name,
+                                              si_flag.level))
 
     await bot.process_commands(message)
 
@@ -717,12 +803,12 @@ async def show_birthdays(bdays, channels, mon, day):
         for sn in ship_names:
             for sb in ships:
                 if (sb.name.lower() == sn.lower()):
-                    bio = imggen.get_birthday_image(sb)
+                    bio = await render.birthday(sb)
                     files.append((bio, sb.name))
         for c in channels:
             for ft in files:
                 bio, sbname = ft
-                f = discord.File(io.BytesIO(bio.getvalue()), filename="image.png")
+                f = discord.File(io.BytesIO(bio.getvalue()), filename=bio.name)
                 await c.send(file=f, content=(msg % sbname))
     else:
         msg = "There are no birthdays today. (%02d/%02d)" % (day, mon)
@@ -759,26 +845,43 @@ async def birthday_task():
         await asyncio.sleep(30)
 
 
+async def flush_task():
+    """Periodically write buffered passive gains to the user database."""
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        await asyncio.sleep(setting('write_behind.flush_interval'))
+        count = await asyncdb.flush()
+        if (count > 0):
+            logging.info("Flushed %s buffered writes" % count)
+
+
 async def backup_task():
     """Automatically back up the user database."""
     await bot.wait_until_ready()
     if (not setting('backups.enabled')):
         logging.info("Backups not enabled, stopping task...")
         return
+    if (userinfo.db.in_memory):
+        logging.info("In-memory database can't be backed up, stopping "
+                     "task...")
+        return
     DIR_PATH = os.path.dirname(os.path.realpath(__file__))
-    DB_PATH = os.path.join(DIR_PATH, "../usersdb.db")  # hidden to git
     BACKUP_DIR = os.path.join(DIR_PATH, setting('backups.backup_folder_local'))
     await asyncio.sleep(20)
     while not bot.is_closed():
-        now = datetime.datetime.now()
-        backup_name = "usersdb-backup-%s.db" % (
-            now.strftime("%y-%m-%d.%H-%M-%S"))
-        backup_file = os.path.join(BACKUP_DIR, backup_name)
-        backup_file = str(os.path.realpath(backup_file)).replace('\\', '\\\\')
-        db_loc = str(os.path.realpath(DB_PATH))
-        logging.info("Creating backup %s..." % backup_file)
-        subprocess.check_output(
-            ['sqlite3', db_loc, '.backup %s' % backup_file])
+        try:
+            for shard in userinfo.db:
+                await backups.create_backup(
+                    shard.path, BACKUP_DIR,
+                    pages_per_step=setting('backups.pages_per_step'),
+                    step_sleep=setting('backups.step_sleep'),
+                    compression_level=setting('backups.compression_level'))
+            await asyncio.get_event_loop().run_in_executor(
+                None, backups.rotate_backups, BACKUP_DIR,
+                setting('backups.keep_hourly'), setting('backups.keep_daily'),
+                setting('backups.keep_weekly'))
+        except Exception:
+            logging.exception("[Backup] Backup failed")
         await asyncio.sleep(setting('backups.backup_time'))
 
 
@@ -806,8 +909,17 @@ if __name__ == '__main__':
     with open(os.path.join(DIR_PATH, "../botinfo.json"), 'r') as bi:
         info = json.load(bi)
         key = info['key']  # yeah, no, I'm keeping this secret
+    logging.info("Preparing user database...")
+    userinfo.init_db()
     logging.info("Creating async tasks...")
     bot.loop.create_task(birthday_task())
     bot.loop.create_task(backup_task())
+    bot.loop.create_task(flush_task())
     logging.info("Running bot...")
     bot.run(key)
+    render.pool.shutdown()
+    # a half done download is never written, so it's safe to drop
+    cgdownload.downloads.shutdown(wait=False)
+    asyncdb.lanes.shutdown()
+    userinfo.flush_pending()
+    userinfo.db.close()
@@ -0,0 +1,98 @@
+"""Handles bounded least-recently-used caches."""
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """A thread-safe mapping that drops its least recently used entries."""
+
+    def __init__(self, maxsize, weigh=None):
+        """Initialize the cache.
+
+        Parameters
+        ----------
+        maxsize : int
+            The maximum total weight of everything in the cache.
+        weigh : function
+            Function returning the weight of a value, e.g. its size in
+            bytes. Every value weighs 1 if None.
+        """
+        self.maxsize = maxsize
+        self.weigh = weigh or (lambda value: 1)
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        """Return the number of entries in the cache."""
+        return len(self._data)
+
+    def __contains__(self, key):
+        """Return True if the key is cached, without counting a hit."""
+        return key in self._data
+
+    def get(self, key, default=None):
+        """Return the value for the key, or default if it isn't cached."""
+        with self._lock:
+            if (key in self._data):
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key][0]
+            self.misses += 1
+            return default
+
+    def peek(self, key, default=None):
+        """Return the value for the key without touching the counters."""
+        with self._lock:
+            if (key in self._data):
+                return self._data[key][0]
+            return default
+
+    def put(self, key, value):
+        """Store a value, evicting old entries if over the size limit."""
+        with self._lock:
+            self.pop(key)
+            weight = self.weigh(value)
+            if (weight > self.maxsize):
+                return
+            self._data[key] = (value, weight)
+            self.weight += weight
+            while (self.weight > self.maxsize):
+                _k, (_v, old_weight) = self._data.popitem(last=False)
+                self.weight -= old_weight
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        """Remove a key from the cache, returning its value."""
+        with self._lock:
+            if (key not in self._data):
+                return default
+            value, weight = self._data.pop(key)
+            self.weight -= weight
+            return value
+
+    def clear(self):
+        """Remove everything from the cache."""
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def stats(self):
+        """Return a dict of the cache's size and hit/miss counters."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {'entries': len(self._data), 'weight': self.weight,
+                    'maxsize': self.maxsize, 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / total if total else 0.0}
+
+    def format_stats(self, name):
+        """Return a one line summary of the cache's stats."""
+        st = self.stats()
+        return "%s: %s entries (%s/%s), %s hits, %s misses (%.1f%%), " \
+            "%s evictions" % (name, st['entries'], st['weight'],
+                              st['maxsize'], st['hits'], st['misses'],
+                              100.0 * st['hit_rate'], st['evictions'])
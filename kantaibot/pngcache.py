@@ -0,0 +1,186 @@
+"""Handles caching encoded images by a hash of what was drawn.
+
+Entries are kept in a memory tier and, if given a folder, a disk tier that
+survives restarts. Both tiers drop their least recently used entries once
+over their size limit. Keys are content hashes of the render inputs, so an
+entry never goes stale, it just stops being asked for.
+
+e.g.
+    key = pngcache.make_key("ship card", version, ship.sid, ship.level)
+    data = cache.get(key)
+    if (data is None):
+        data = draw(...).getvalue()
+        cache.put(key, data)
+"""
+import hashlib
+import logging
+import lrucache
+import os
+import threading
+
+
+def make_key(*parts):
+    """Return a hex digest identifying the given render inputs.
+
+    Parameters
+    ----------
+    *parts
+        Plain values (str, int, tuple...) whose repr describes the render.
+    """
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()
+
+
+class PNGCache:
+    """A two tier (memory and disk) cache of encoded image bytes."""
+
+    def __init__(self, memory_bytes, disk_dir=None, disk_bytes=0):
+        """Initialize the cache.
+
+        Parameters
+        ----------
+        memory_bytes : int
+            The most bytes of images to keep in memory.
+        disk_dir : str
+            The folder to keep images in on disk, created if missing. None
+            to only cache in memory.
+        disk_bytes : int
+            The most bytes of images to keep on disk, 0 for no disk tier.
+        """
+        self.memory = lrucache.LRUCache(memory_bytes, weigh=len)
+        self.disk_dir = disk_dir if disk_bytes > 0 else None
+        self.disk_bytes = disk_bytes
+        self.disk_used = 0
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self.disk_evictions = 0
+        self._lock = threading.Lock()
+        if (self.disk_dir):
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self.disk_used = sum(size for _mtime, size, _path in
+                                 self._disk_entries())
+
+    def _path(self, key):
+        """Return where the image with the given key is kept on disk."""
+        return os.path.join(self.disk_dir, key + ".png")
+
+    def _disk_entries(self):
+        """Return a list of (mtime, size, path) of every file on disk."""
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if (name.endswith(".png")):
+                path = os.path.join(self.disk_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def get_memory(self, key):
+        """Return the bytes for the key from memory only, or None.
+
+        This never touches the disk, so it's safe to call on the event loop.
+        """
+        return self.memory.get(key)
+
+    def get_disk(self, key):
+        """Return the bytes for the key from disk, or None.
+
+        A hit is copied into memory so the next get_memory finds it.
+        """
+        if (self.disk_dir is None):
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # the mtime is used as the last use time for eviction
+            os.utime(path)
+        except OSError:
+            self.disk_misses += 1
+            return None
+        self.disk_hits += 1
+        self.memory.put(key, data)
+        return data
+
+    def get(self, key):
+        """Return the bytes for the key from either tier, or None."""
+        data = self.get_memory(key)
+        if (data is None):
+            data = self.get_disk(key)
+        return data
+
+    def put_memory(self, key, data):
+        """Store the bytes for the key in memory only."""
+        self.memory.put(key, data)
+
+    def put_disk(self, key, data):
+        """Store the bytes for the key on disk only.
+
+        A failed write is logged rather than raised, the entry just stays
+        memory only.
+        """
+        if (self.disk_dir is None or len(data) > self.disk_bytes):
+            return
+        path = self._path(key)
+        tmp_path = "%s.%d.tmp" % (path, threading.get_ident())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            with self._lock:
+                old_size = (os.path.getsize(path) if os.path.exists(path)
+                            else 0)
+                os.replace(tmp_path, path)
+                self.disk_used += len(data) - old_size
+                if (self.disk_used > self.disk_bytes):
+                    self._trim_disk()
+        except OSError as e:
+            logging.warning("[PNGCache] Couldn't write %s: %s" % (path, e))
+            if (os.path.exists(tmp_path)):
+                os.remove(tmp_path)
+
+    def put(self, key, data):
+        """Store the bytes for the key in both tiers."""
+        self.put_memory(key, data)
+        self.put_disk(key, data)
+
+    def _trim_disk(self):
+        """Remove the least recently used files until under the size limit.
+
+        Trims down to 90% of the limit so it doesn't run on every put.
+        """
+        entries = sorted(self._disk_entries())
+        self.disk_used = sum(size for _mtime, size, _path in entries)
+        target = self.disk_bytes * 9 // 10
+        for _mtime, size, path in entries:
+            if (self.disk_used <= target):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.disk_used -= size
+            self.disk_evictions += 1
+
+    def clear(self):
+        """Remove everything from both tiers."""
+        self.memory.clear()
+        if (self.disk_dir is None):
+            return
+        with self._lock:
+            for _mtime, _size, path in self._disk_entries():
+                os.remove(path)
+            self.disk_used = 0
+
+    def format_stats(self, name):
+        """Return a list of one line summaries of both tiers."""
+        lines = [self.memory.format_stats(name)]
+        if (self.disk_dir):
+            total = self.disk_hits + self.disk_misses
+            lines.append("%s (disk): %s/%s bytes, %s hits, %s misses "
+                         "(%.1f%%), %s evictions" % (
+                             name, self.disk_used, self.disk_bytes,
+                             self.disk_hits, self.disk_misses,
+                             100.0 * self.disk_hits / total if total
+                             else 0.0, self.disk_evictions))
+        return lines
@@ -0,0 +1,262 @@
+"""Handles generating images away from the event loop.
+
+Each render is split in two: a snapshot of the data to show is taken first
+(on the user's database lane if it needs the database), then the snapshot
+is drawn on a pool of threads or processes. Drawing never touches the
+database or Discord, so a slow render only holds up its own command.
+
+Ship cards and birthday images only depend on a few values, so they are
+also cached as PNG bytes keyed by a hash of those values. Whether the CG
+is downloaded yet is one of them, so a render with a placeholder CG is
+drawn again once the real one is there.
+
+Each kind of image is drawn with the quality profile set for it in the
+settings, or a cheaper one while the pool is backed up.
+
+e.g.
+    image_file = await render.inventory(ctx.author, page)
+    image_file = await render.ship_card(ctx.bot, ship_instance)
+"""
+import asyncio
+import asyncdb
+import hashlib
+import imggen
+import io
+import os
+import pngcache
+import ship_stats
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from settings import setting, SETTINGS_FILE
+
+
+def _timed(func, *args):
+    """Run func in a worker, returning its result and how long it took."""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+class JobStats:
+    """Timing and output size of one kind of render job."""
+
+    def __init__(self):
+        """Initialize the stats."""
+        self.count = 0
+        self.render_time = 0.0
+        self.wait_time = 0.0
+        self.max_time = 0.0
+        self.encode_time = 0.0
+        self.output_bytes = 0
+        self.budget_steps = 0
+
+    def record(self, render_time, total_time, result=None):
+        """Add a finished job.
+
+        Parameters
+        ----------
+        render_time : float
+            Seconds spent drawing and encoding the image.
+        total_time : float
+            Seconds from queueing the job to it finishing.
+        result : BytesIO
+            The encoded image, see imggen.encode_image.
+        """
+        self.count += 1
+        self.render_time += render_time
+        self.wait_time += max(0.0, total_time - render_time)
+        self.max_time = max(self.max_time, total_time)
+        if (result is not None):
+            self.encode_time += getattr(result, 'encode_time', 0.0)
+            self.budget_steps += getattr(result, 'encode_steps', 0)
+            self.output_bytes += result.getbuffer().nbytes
+
+    def format(self, name):
+        """Return a one line summary of the stats."""
+        if (self.count == 0):
+            return "%s: no jobs" % name
+        return ("%s: %d jobs, %.1fms avg render (%.1fms encoding), "
+                "%.1fms avg wait, %.1fms max, %d KiB avg, %d budget steps"
+                % (name, self.count, self.render_time * 1000 / self.count,
+                   self.encode_time * 1000 / self.count,
+                   self.wait_time * 1000 / self.count, self.max_time * 1000,
+                   self.output_bytes // 1024 // self.count,
+                   self.budget_steps))
+
+
+class RenderPool:
+    """A pool of workers for drawing images."""
+
+    def __init__(self, workers, use_processes=False):
+        """Initialize the pool.
+
+        Parameters
+        ----------
+        workers : int
+            The number of threads or processes drawing images.
+        use_processes : bool
+            If True, draw in separate processes so renders don't hold the
+            GIL. Jobs and their results are pickled in that case.
+        """
+        self.workers = max(1, workers)
+        self.use_processes = use_processes
+        if (use_processes):
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers,
+                                               thread_name_prefix="render")
+        # jobs submitted but not finished yet, including running ones
+        self.pending = 0
+        self.peak_pending = 0
+        # jobs drawn at a lower quality because the pool was busy
+        self.busy_renders = 0
+        self.stats = {}
+
+    async def run(self, kind, func, *args):
+        """Run func(*args) on the pool and return its result.
+
+        Parameters
+        ----------
+        kind : str
+            The kind of image, e.g. "inventory". The job's stats are
+            recorded under it.
+        func : function
+            A module level function taking only plain data.
+        """
+        loop = asyncio.get_event_loop()
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        start = time.perf_counter()
+        try:
+            result, render_time = await loop.run_in_executor(
+                self.executor, _timed, func, *args)
+        finally:
+            self.pending -= 1
+        self.stats.setdefault(kind, JobStats()).record(
+            render_time, time.perf_counter() - start, result)
+        return result
+
+    def format_stats(self):
+        """Return a list of one line summaries of the pool and its jobs."""
+        lines = ["Render pool: %d %s, %d queued or running (peak %d), "
+                 "%d busy renders" % (
+                     self.workers,
+                     "processes" if self.use_processes else "threads",
+                     self.pending, self.peak_pending, self.busy_renders)]
+        for kind in sorted(self.stats):
+            lines.append(self.stats[kind].format(
+                kind.replace("_", " ").title()))
+        return lines
+
+    def shutdown(self):
+        """Wait for all queued renders to finish and stop the workers."""
+        self.executor.shutdown(wait=True)
+
+
+def _render_version():
+    """Return a hash of everything besides the snapshot that changes renders.
+
+    That's the drawing code's version and the layout, settings and ship
+    data files, so editing any of them stops old cached renders being used.
+    """
+    version = hashlib.sha256(str(imggen.RENDER_VERSION).encode('utf-8'))
+    for path in (imggen.CONFIG_DATA_FILE, SETTINGS_FILE,
+                 ship_stats.SHIP_DATA_FILE, ship_stats.SEASONAL_DATA_FILE):
+        with open(path, 'rb') as f:
+            version.update(f.read())
+    return version.hexdigest()
+
+
+pool = RenderPool(setting('render.workers'),
+                  setting('render.pool') == "process")
+VERSION = _render_version()
+png_cache = pngcache.PNGCache(
+    setting('render.cache_memory_bytes'),
+    os.path.join(imggen.DIR_PATH, setting('render.cache_folder')),
+    setting('render.cache_disk_bytes'))
+
+
+def pick_quality(kind, quality=None):
+    """Return the name of the quality profile to draw a job with.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of image, a key of the render.quality setting.
+    quality : str
+        A profile asked for by the caller, always used if given.
+    """
+    if (quality):
+        return quality
+    if (pool.pending >= setting('render.busy_queue_depth')):
+        pool.busy_renders += 1
+        return setting('render.busy_quality')
+    return setting('render.quality').get(kind)
+
+
+async def _cached(key, kind, func, *args):
+    """Return a render from the PNG cache, drawing and caching it if missing.
+
+    Returns
+    -------
+    BytesIO
+        The encoded image, named with the file name to upload it as.
+    """
+    loop = asyncio.get_event_loop()
+    data = png_cache.get_memory(key)
+    if (data is None and png_cache.disk_dir):
+        data = await loop.run_in_executor(None, png_cache.get_disk, key)
+    if (data is None):
+        data = (await pool.run(kind, func, *args)).getvalue()
+        png_cache.put_memory(key, data)
+        loop.run_in_executor(None, png_cache.put_disk, key, data)
+    image_file = io.BytesIO(data)
+    image_file.name = imggen.output_filename(kind)
+    return image_file
+
+
+async def inventory(member, page, only_dupes=False, quality=None):
+    """Return a BytesIO object of the user's inventory image.
+
+    Parameters
+    ----------
+    member : discord.Member
+        The user to generate the inventory of.
+    page : int
+        The page to show.
+    only_dupes : bool
+        If True, only display ships which the user has two or more of.
+    quality : str
+        The name of the quality profile to draw with, see pick_quality.
+    """
+    snapshot = await asyncdb.run(
+        member.id, imggen.InventorySnapshot.take, member.id,
+        "%s#%s" % (member.name, member.discriminator), page, only_dupes)
+    return await pool.run("inventory", imggen.draw_inventory_screen,
+                          snapshot, pick_quality("inventory", quality))
+
+
+async def ship_card(bot, ship_instance, quality=None):
+    """Return a BytesIO object of a card image of the given ship."""
+    snapshot = imggen.ShipCardSnapshot.take(bot, ship_instance)
+    quality = pick_quality("ship_card", quality)
+    ship = snapshot.ship
+    key = pngcache.make_key("ship_card", VERSION, quality, ship.sid,
+                            ship.level, ship.exp, ship.invid,
+                            snapshot.owner_name, ship.has_cg())
+    return await _cached(key, "ship_card", imggen.draw_ship_card, snapshot,
+                         quality)
+
+
+async def birthday(base, quality=None):
+    """Return a BytesIO object of an image for a ship's birthday."""
+    quality = pick_quality("birthday", quality)
+    key = pngcache.make_key("birthday", VERSION, quality, base.sid,
+                            base.has_cg())
+    return await _cached(key, "birthday", imggen.get_birthday_image, base,
+                         quality)
+
+
+async def sortie_card(sortie):
+    """Return a BytesIO object of a sortie map."""
+    return await pool.run("sortie", imggen.generate_sortie_card, sortie)
@@ -5,7 +5,9 @@ import random
 
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
 
-with open(os.path.join(DIR_PATH, "../settings.json"), 'r') as sf:
+SETTINGS_FILE = os.path.join(DIR_PATH, "../settings.json")
+
+with open(SETTINGS_FILE, 'r') as sf:
     setting_data = json.load(sf)
 
 
@@ -1,9 +1,10 @@
 """Handles information about ships."""
 import os
+import assetcache
+import assetpack
+import cgdownload
 import userinfo
 import json
-import urllib.request
-from io import BytesIO
 from PIL import Image
 from settings import setting
 
@@ -33,6 +34,10 @@ SEASONAL_DATA = read_json(SEASONAL_DATA_FILE)
 EXPERIENCE_DATA_FILE = os.path.join(DIR_PATH, "../experience.json")
 EXPERIENCE_DATA = read_json(EXPERIENCE_DATA_FILE)
 
+# drawn in place of a CG while it's being downloaded
+PLACEHOLDER_CG = os.path.join(DIR_PATH, "images/cg_placeholder.png")
+PLACEHOLDER_ICO = os.path.join(DIR_PATH, "images/ico_placeholder.png")
+
 _sbase_cache = {}
 
 
@@ -103,9 +108,72 @@ class ShipBase:
         """Return True if the ship has a seasonal artwork."""
         return str(self.sid) in SEASONAL_DATA
 
+    def cg_source(self, ico=False, dmg=False):
+        """Return the (path, url) of the ship's CG file, see get_cg_path.
+
+        The file isn't downloaded if it's missing.
+        """
+        seasonal = self.has_seasonal_cg()
+        file_dir = "../seasonal_cg/" if seasonal else ("../icos/" if
+                                                       ico else "../cgs/")
+        file_dir = os.path.join(DIR_PATH, file_dir)
+        info_name = 'small' if ico else 'full'
+        info_name += '_damaged' if dmg else ''
+        image_info = (SEASONAL_DATA[str(self.sid)]['images'][info_name] if
+                      seasonal else self.images[info_name])
+        return file_dir + image_info['file_name'], image_info['url']
+
+    def cg_pack_key(self, ico=False, dmg=False):
+        """Return the key of the ship's CG in the asset pack, see get_cg."""
+        variant = 'small' if ico else 'full'
+        variant += '_damaged' if dmg else ''
+        if (self.has_seasonal_cg()):
+            return assetpack.make_key(self.sid, "seasonal_" + variant)
+        # icons are named by KC3 ID, full CGs by ship ID
+        return assetpack.make_key(self.kc3id if ico else self.sid, variant)
+
+    def packed_cg_key(self, ico=False, dmg=False):
+        """Return the CG's key if it's in the asset pack, otherwise None."""
+        if (assetpack.pack is None):
+            return None
+        key = self.cg_pack_key(ico, dmg)
+        return key if key in assetpack.pack else None
+
+    def has_cg(self, ico=False, dmg=False):
+        """Return True if the ship's CG is packed or downloaded."""
+        return (self.packed_cg_key(ico, dmg) is not None
+                or os.path.exists(self.cg_source(ico, dmg)[0]))
+
+    def get_cg_path(self, ico=False, dmg=False, wait=False):
+        """Return the location of the ship's CG.
+
+        A missing CG is queued for download, and a placeholder image is
+        returned in its place until it's done.
+
+        Parameters
+        ----------
+        ico : bool
+            True if requesting the icon, False if requesting the full CG.
+        dmg : bool
+            True if requesting the damaged version, False if normal version.
+        wait : bool
+            If True, wait for a missing CG to download rather than
+            returning the placeholder. Raises if the download fails.
+        """
+        path, url = self.cg_source(ico, dmg)
+        if (not os.path.exists(path)):
+            download = cgdownload.downloads.request(url, path)
+            if (not wait):
+                return PLACEHOLDER_ICO if ico else PLACEHOLDER_CG
+            download.result()
+        return path
+
     def get_cg(self, ico=False, dmg=False):
         """Return the full CG of the ship.
 
+        It's read from the asset pack if it's in there, otherwise from its
+        own file.
+
         Parameters
         ----------
         ico : bool
@@ -118,24 +186,30 @@ class ShipBase:
         PIL.Image
             The CG requested, in its native size
         """
-        seasonal = self.has_seasonal_cg()
-        file_dir = "../seasonal_cg/" if seasonal else ("../icos/" if
-                                                       ico else "../cgs/")
-        file_dir = os.path.join(DIR_PATH, file_dir)
-        info_name = 'small' if ico else 'full'
-        info_name += '_damaged' if dmg else ''
-        image_info = (SEASONAL_DATA[str(self.sid)]['images'][info_name] if
-                      seasonal else self.images[info_name])
-
-        try:
-            img = Image.open(file_dir + image_info['file_name'])
-            return img
-        except IOError:
-            url = image_info['url']
-            req = urllib.request.urlopen(url)
-            imgdata = Image.open(BytesIO(req.read())).convert('RGBA')
-            imgdata.save(file_dir + image_info['file_name'])
-            return imgdata
+        key = self.packed_cg_key(ico, dmg)
+        if (key is not None):
+            return assetpack.pack.image(key).copy()
+        return Image.open(self.get_cg_path(ico, dmg))
+
+    def get_cg_size(self, ico=False, dmg=False):
+        """Return the native size of the ship's CG, see get_cg."""
+        key = self.packed_cg_key(ico, dmg)
+        if (key is not None):
+            return assetpack.pack.size(key)
+        return assetcache.image_size(self.get_cg_path(ico, dmg))
+
+    def get_scaled_cg(self, size, resample=None, ico=False, dmg=False):
+        """Return the ship's CG resized to the given size.
+
+        The resized CG is cached in memory, and on disk if it isn't from
+        the asset pack, so it's shared and mustn't be drawn on. See get_cg
+        for ico and dmg.
+        """
+        key = self.packed_cg_key(ico, dmg)
+        if (key is not None):
+            return assetpack.pack.scaled_image(key, size, resample)
+        return assetcache.scaled_image(self.get_cg_path(ico, dmg), size,
+                                       resample)
 
 
 class ShipInstance:
@@ -162,6 +236,8 @@ class ShipInstance:
         self.owner = owner
         self.level = level
         self.exp = exp
+        # buffered exp merged into this instance that isn't in the database
+        self.pending_exp = 0
 
     def base(self):
         """Return the ShipBase corresponding to this ship."""
@@ -172,9 +248,16 @@ class ShipInstance:
         """Make a new ship with the given shipid owned by the given owner."""
         return ShipInstance(-1, sid, owner)
 
-    def add_exp(self, exp):
+    def add_exp(self, exp, save=True):
         """Add EXP to the local copy of the ship.
 
+        Parameters
+        ----------
+        exp : int
+            The amount of EXP to add.
+        save : bool
+            If True, also write the new level and EXP to the database.
+
         Returns
         -------
         bool
@@ -190,10 +273,11 @@ class ShipInstance:
                 self.level += 1
                 self.exp -= req
                 lvl = True
-                self.add_exp(0)  # level up as much as possible
+                self.add_exp(0, save=False)  # level up as much as possible
         else:
             self.exp = 0
-        userinfo.update_ship_exp(self)
+        if (save):
+            userinfo.update_ship_exp(self)
         return lvl
 
     def exp_req(self):
@@ -209,17 +293,24 @@ class ShipInstance:
         return self.level >= base.remodel_level
 
 
-def get_rarity_backdrop(rarity):
+def get_rarity_backdrop(rarity, size=None):
     """Return an image of the corresponding rarity background.
 
+    Parameters
+    ----------
+    rarity : int
+        The rarity of the ship.
+    size : tuple
+        2-tuple of the size to resize to, or None for the original size.
+
     Returns
     -------
     PIL.Image
-        The image resized to the given size.
+        The image resized to the given size. It is shared with the asset
+        cache, so copy() it before drawing on it.
     """
     rarity -= 1
-    rimg = Image.open(DIR_PATH + '/images/bg_%d.png' % (rarity))
-    return rimg
+    return assetcache.image(DIR_PATH + '/images/bg_%d.png' % (rarity), size)
 
 
 ALL_SHIP_TYPES = []
@@ -10,24 +10,12 @@ def table_exists(conn, table_name):
     return cur.fetchone()[0] == 1
 
 
-def copy_table(conn, original_table, new_table_name):
-    """Copy a table to a new table with the given name."""
-    query = "SELECT sql FROM sqlite_master WHERE type='table' AND name=?"
-    args = (original_table,)
+def tables_like(conn, pattern):
+    """Return the names of all tables matching the given LIKE pattern."""
+    query = "SELECT name FROM sqlite_master WHERE type='table' AND name LIKE ?"
+    args = (pattern,)
     cur = conn.cursor()
     cur.execute(query, args)
-    create_statement = cur.fetchone()[0]
+    names = [row[0] for row in cur.fetchall()]
     cur.close()
-
-    new_statement = create_statement.replace(original_table, new_table_name)
-    cur = conn.cursor()
-    cur.execute(new_statement)
-    cur.close()
-
-    query = "INSERT INTO %s SELECT * FROM %s" \
-        % (new_table_name, original_table)
-    cur = conn.cursor()
-    cur.execute(query)
-    cur.close()
-
-    conn.commit()
+    return names
@@ -1,24 +1,406 @@
 """Handles the basic user information and database."""
-import sqlite3
 import os
+import contextvars
 import ship_stats
-import sqlutils
+import dbmigrate
+import database
+import lrucache
+import threading
 import time
 from settings import setting
 
 DIR_PATH = os.path.dirname(os.path.realpath(__file__))
-DB_PATH = os.path.join(DIR_PATH, "../usersdb.db")  # hidden to git
+DB_PATH = os.path.join(DIR_PATH, setting('database.path'))  # hidden to git
+SCHEMA_PATH = os.path.join(DIR_PATH, "../usersdb_schema.sql")
 
 
-def get_connection():
-    """Return a new SQLite connection to the users database."""
-    return sqlite3.connect(DB_PATH)
+def open_database(backend=None, shard_count=None):
+    """Return a new ShardRouter over the databases for the given backend.
+
+    Parameters
+    ----------
+    backend : str
+        "file" for the database at DB_PATH or "memory" for a throwaway
+        in-memory one. Uses the database.backend setting if None.
+    shard_count : int
+        Number of databases to split users between. Uses the
+        database.shards setting if None.
+    """
+    if (backend is None):
+        backend = setting('database.backend')
+    if (shard_count is None):
+        shard_count = setting('database.shards')
+    if (backend == "memory"):
+        return database.ShardRouter(
+            database.MemoryDatabase(
+                cached_statements=setting('database.cached_statements'))
+            for _ in range(shard_count))
+    elif (backend == "file"):
+        return database.ShardRouter(
+            database.Database(
+                path, synchronous=setting('database.synchronous'),
+                cache_size=setting('database.cache_size'),
+                cached_statements=setting('database.cached_statements'))
+            for path in database.shard_paths(DB_PATH, shard_count))
+    raise ValueError("Unknown database backend '%s'" % backend)
+
+
+# every query goes through the shard holding the user it is for
+db = open_database()
+
+
+USER_COLUMNS = ("DiscordID", "RFuel", "RAmmo", "RSteel", "RBauxite",
+                "Last_Bonus", "TotalXP", "Inventory_Size", "Last_Drop",
+                "Last_Craft", "Last_Training", "Rings")
+
+# fleets a user can have, matching the old Fleet_1..Fleet_4 columns
+FLEET_COUNT = 4
+
+# discord id -> {column: value} of recently used rows in the Users table
+user_cache = lrucache.LRUCache(setting('database.user_cache_size'))
+db.add_rollback_hook(user_cache.clear)
+
+
+def use_database(new_db):
+    """Switch all user data over to another ShardRouter.
+
+    Buffered writes are flushed to the old databases and the caches are
+    emptied first. Call init_db() afterwards if the new databases are empty.
+
+    e.g.
+        userinfo.use_database(userinfo.open_database("memory"))
+        userinfo.init_db()
+    """
+    global db
+    pending.flush()
+    db.remove_rollback_hook(user_cache.clear)
+    user_cache.clear()
+    db = new_db
+    db.add_rollback_hook(user_cache.clear)
+
+
+def invalidate_user(discordid):
+    """Drop a user's cached row, e.g. after editing the database by hand."""
+    user_cache.pop(discordid)
+
+
+def _cache_col(discordid, col, val):
+    """Write a new column value through to the user's cached row."""
+    row = user_cache.peek(discordid)
+    if (row is not None):
+        row[col] = val
+
+
+def transaction(*discordids):
+    """Return a scope that groups the given users' writes into one commit.
+
+    e.g.
+        with userinfo.transaction(did):
+            user.mod_fuel(-10)
+            inv.add_to_inventory(ship)
+    """
+    return db.transaction(discordids)
+
+
+def read_transaction(*discordids):
+    """Return a scope that reads the given users' data from one snapshot.
+
+    It doesn't take the write lock, so nothing should be written inside it.
+
+    e.g.
+        with userinfo.read_transaction(did):
+            inv = userinfo.get_user_inventory(did)
+            fleets = userinfo.get_fleets(did)
+    """
+    return db.read_transaction(discordids)
+
+
+_active_unit = contextvars.ContextVar('active_unit', default=None)
+
+
+class UnitOfWork:
+    """Collects every database write made by one command.
+
+    While the unit is active, writes from User, UserInventory, UserFleet,
+    ShipInstance.add_exp and set_cooldown only change the local objects and
+    are queued. apply() then writes them all in a single transaction, so a
+    command costs one commit and never ends up half applied.
+
+    Checks queued with the require_* functions are run again by apply()
+    inside that transaction, before any write. If one of them no longer
+    holds, e.g. another command from the same user got there first, nothing
+    is written.
+
+    e.g.
+        with userinfo.UnitOfWork() as uow:
+            userinfo.require_cooldown(did, 'Last_Craft', CRAFTING_COOLDOWN)
+            userinfo.require_resources(did, 10, 0, 0, 0)
+            user.mod_fuel(-10)
+            inv.add_to_inventory(ship)
+            userinfo.set_cooldown(did, 'Last_Craft')
+        if (not await asyncdb.apply(did, uow)):
+            ...
+    """
+
+    def __init__(self):
+        """Initialize the empty unit."""
+        self.ops = []
+        self.checks = []
+        self.discordids = set()
+        self._tokens = []
+
+    def __enter__(self):
+        """Start collecting writes made in the current context."""
+        self._tokens.append(_active_unit.set(self))
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        """Stop collecting writes."""
+        _active_unit.reset(self._tokens.pop())
+
+    def __len__(self):
+        """Return the number of queued writes."""
+        return len(self.ops)
+
+    def queue(self, discordid, func, *args):
+        """Queue a function writing the user's data to run on apply."""
+        self.discordids.add(discordid)
+        self.ops.append((func, args))
+
+    def require(self, discordid, check, *args):
+        """Queue a function checking the user's data to run on apply."""
+        self.discordids.add(discordid)
+        self.checks.append((discordid, check, args))
+
+    def apply(self):
+        """Run every queued check, then every queued write, in one transaction.
+
+        Returns
+        -------
+        bool
+            True if the writes were made, False if a check failed and
+            nothing was written.
+        """
+        token = _active_unit.set(None)
+        try:
+            if (len(self.checks) > 0):
+                # checks read the database, so buffered gains have to be in it
+                pending.flush_resources(set(x[0] for x in self.checks))
+            with db.transaction(self.discordids):
+                passed = all(check(*args) for _did, check, args
+                             in self.checks)
+                if (passed):
+                    for func, args in self.ops:
+                        func(*args)
+            self.ops = []
+            self.checks = []
+            self.discordids = set()
+            return passed
+        finally:
+            _active_unit.reset(token)
+
+
+def _write(discordid, func, *args):
+    """Run a write to the user's data now, or queue it in the UnitOfWork.
+
+    Returns the write's result, or None if it was queued.
+    """
+    unit = _active_unit.get()
+    if (unit is not None):
+        unit.queue(discordid, func, *args)
+        return None
+    return func(*args)
+
+
+def _require(discordid, check, *args):
+    """Run a check on the user's data now, or queue it in the UnitOfWork.
+
+    Returns the check's result, or True if it was queued.
+    """
+    unit = _active_unit.get()
+    if (unit is not None):
+        unit.require(discordid, check, *args)
+        return True
+    return check(*args)
+
+
+def _apply_set_col(discordid, col, val):
+    """Write a value to one of the user's columns."""
+    query = "UPDATE Users SET %s=? WHERE DiscordID=?" % col
+    args = (val, discordid)
+    db.shard(discordid).execute(query, args)
+    _cache_col(discordid, col, val)
+
+
+def _apply_mod_resource(discordid, col, delta):
+    """Add to one of the user's resource columns, within the cap."""
+    query = "UPDATE Users SET {0}=MAX(0, MIN(?, {0} + ?)) " \
+        "WHERE DiscordID=?".format(col)
+    args = (RESOURCE_CAP, delta, discordid)
+    db.shard(discordid).execute(query, args)
+    row = user_cache.peek(discordid)
+    if (row is not None):
+        row[col] = max(0, min(RESOURCE_CAP, row[col] + delta))
+
+
+def _apply_add_ships(discordid, ship_instances):
+    """Insert ships into the user's inventory and set their inventory IDs.
+
+    Returns
+    -------
+    list
+        The inventory IDs given to the ships, in order.
+    """
+    shard = db.shard(discordid)
+    if (len(ship_instances) == 0):
+        return []
+    with shard.transaction():
+        _ensure_inventory(discordid)
+        # reserve a block of IDs in one statement
+        query = "UPDATE InventorySeq SET LastID=LastID+? WHERE OwnerID=? " \
+            "RETURNING LastID"
+        args = (len(ship_instances), discordid)
+        last_id = shard.fetchone(query, args)[0]
+        first_id = last_id - len(ship_instances) + 1
+        for i, ship_instance in enumerate(ship_instances):
+            ship_instance.invid = first_id + i
+
+        query = "INSERT INTO Inventory (OwnerID, ID, ShipID, ShipLevel, " \
+            "ShipXP) VALUES (?, ?, ?, ?, ?)"
+        shard.executemany(query, [(discordid, x.invid, x.sid, x.level, x.exp)
+                               for x in ship_instances])
+    return [x.invid for x in ship_instances]
+
+
+def _apply_remove_ships(discordid, inv_ids):
+    """Delete ships from the user's inventory and all of their fleets."""
+    shard = db.shard(discordid)
+    args = [(discordid, x) for x in inv_ids]
+    with shard.transaction():
+        query = "DELETE FROM Inventory WHERE OwnerID=? AND ID=?"
+        shard.executemany(query, args)
+        # fleets are read ordered by position, so the gap this leaves keeps
+        # the rest of the fleet in order
+        query = "DELETE FROM FleetSlots WHERE OwnerID=? AND InvID=?"
+        shard.executemany(query, args)
+        for inv_id in inv_ids:
+            pending.discard_ship(discordid, inv_id)
+
+
+def _apply_fleet(fleet):
+    """Write a fleet's ships to the database."""
+    shard = db.shard(fleet.owner)
+    with shard.transaction():
+        query = "DELETE FROM FleetSlots WHERE OwnerID=? AND FleetID=?"
+        args = (fleet.owner, fleet.fid)
+        shard.execute(query, args)
+        query = "INSERT INTO FleetSlots (OwnerID, FleetID, Position, " \
+            "InvID) VALUES (?, ?, ?, ?)"
+        shard.executemany(query, [(fleet.owner, fleet.fid, pos, invid)
+                               for pos, invid in enumerate(fleet.ships)])
+
+
+def _apply_ship_exp(ship_instance):
+    """Write a ship's level and EXP to the database."""
+    query = "UPDATE Inventory SET ShipLevel=?, ShipXP=? " \
+        "WHERE OwnerID=? AND ID=?"
+    args = (ship_instance.level, ship_instance.exp, ship_instance.owner,
+            ship_instance.invid)
+    db.shard(ship_instance.owner).execute(query, args)
+    pending.consume_ship(ship_instance)
+
+
+def _apply_ship_sid(ship_instance):
+    """Write a ship's ship ID to the database."""
+    query = "UPDATE Inventory SET ShipID=? WHERE OwnerID=? AND ID=?"
+    args = (ship_instance.sid, ship_instance.owner, ship_instance.invid)
+    db.shard(ship_instance.owner).execute(query, args)
+
+
+def _apply_cooldown(discordid, colname, timestamp):
+    """Write a cooldown timestamp to the database."""
+    _apply_set_col(discordid, colname, timestamp)
+    pending.discard_cooldown(discordid, colname)
+
+
+def _apply_use_ring(discordid):
+    """Take one ring from the user in the database."""
+    query = "UPDATE Users SET Rings=MAX(0, Rings - 1) WHERE DiscordID=?"
+    args = (discordid,)
+    db.shard(discordid).execute(query, args)
+    row = user_cache.peek(discordid)
+    if (row is not None):
+        row['Rings'] = max(0, row['Rings'] - 1)
+
+
+def _read_cols(discordid, cols):
+    """Return the user's current values of the columns, skipping the cache."""
+    _user_row(discordid)
+    query = "SELECT %s FROM Users WHERE DiscordID=?" % ", ".join(cols)
+    args = (discordid,)
+    return db.shard(discordid).fetchone(query, args)
+
+
+def _check_cooldown(discordid, colname, cooldown_amount):
+    """Return True if the cooldown is off, see require_cooldown."""
+    ts = max(_read_cols(discordid, (colname,))[0],
+             pending.cooldown(discordid, colname) or 0)
+    return ts + cooldown_amount <= time.time()
+
+
+def _check_resources(discordid, costs):
+    """Return True if the user has the resources, see require_resources."""
+    if (not setting('features.resources_enabled')):
+        return True
+    have = _read_cols(discordid, ("RFuel", "RAmmo", "RSteel", "RBauxite"))
+    return all(x >= cost for x, cost in zip(have, costs))
+
+
+def _check_rings(discordid, count):
+    """Return True if the user has the rings, see require_rings."""
+    return _read_cols(discordid, ("Rings",))[0] >= count
+
+
+def _check_space(discordid, ship_amount):
+    """Return True if the user has inventory space, see require_space."""
+    _ensure_inventory(discordid)
+    query = "SELECT COUNT(*) FROM Inventory WHERE OwnerID=?"
+    args = (discordid,)
+    count = db.shard(discordid).fetchone(query, args)[0]
+    return count + ship_amount <= _read_cols(discordid,
+                                             ("Inventory_Size",))[0]
+
+
+def _check_ships(discordid, inv_ids, max_level):
+    """Return True if all of the ships still exist, see require_ships."""
+    inv_ids = set(inv_ids)
+    if (len(inv_ids) == 0):
+        return True
+    query = "SELECT COUNT(*) FROM Inventory WHERE OwnerID=? AND ID IN " \
+        "(%s)" % ", ".join("?" * len(inv_ids))
+    args = [discordid] + sorted(inv_ids)
+    if (max_level is not None):
+        query += " AND ShipLevel<=?"
+        args.append(max_level)
+    return db.shard(discordid).fetchone(query, args)[0] == len(inv_ids)
+
+
+def init_db():
+    """Create any missing tables and migrate old inventories and fleets."""
+    with open(SCHEMA_PATH, 'r') as schema:
+        script = schema.read()
+    for shard in db:
+        shard.executescript(script)
+        dbmigrate.migrate_inventories(shard)
+        dbmigrate.migrate_fleets(shard, FLEET_COUNT)
 
 
-USER_TABLE_NAME = "INV_%s"
 BASIC_TABLE_NAME = "INV_BASIC"
 
 RESOURCE_CAP = setting('resources.resource_cap')
+# maps resource columns to their User attribute
+RESOURCE_COLUMNS = {"RFuel": "fuel", "RAmmo": "ammo", "RSteel": "steel",
+                    "RBauxite": "bauxite"}
 
 
 class User:
@@ -66,13 +448,25 @@ class User:
         val : str
             What to set the user's row in the given column to.
         """
-        query = "UPDATE Users SET %s=? WHERE DiscordID=?" % col
-        args = (val, self.did)
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute(query, args)
-        cur.close()
-        conn.commit()
+        _write(self.did, _apply_set_col, self.did, col, val)
+
+    def mod_resource(self, col, delta):
+        """Add to one of the user's resources, keeping it within the cap.
+
+        The database is updated relative to its current value, so that
+        buffered passive gains aren't overwritten.
+
+        Parameters
+        ----------
+        col : str
+            The resource column to modify, e.g. "RFuel".
+        delta : int
+            Amount to add, can be negative.
+        """
+        attr = RESOURCE_COLUMNS[col]
+        setattr(self, attr, max(0, min(RESOURCE_CAP,
+                                       getattr(self, attr) + delta)))
+        _write(self.did, _apply_mod_resource, self.did, col, delta)
 
     def mod_fuel(self, delta):
         """Add fuel to the user.
@@ -83,9 +477,7 @@ class User:
             Amount to add, can be negative.
         """
         if (setting('features.resources_enabled')):
-            self.fuel += delta
-            self.fuel = max(0, min(RESOURCE_CAP, self.fuel))
-            self.set_col("RFuel", self.fuel)
+            self.mod_resource("RFuel", delta)
 
     def mod_ammo(self, delta):
         """Add ammo to the user.
@@ -96,9 +488,7 @@ class User:
             Amount to add, can be negative.
         """
         if (setting('features.resources_enabled')):
-            self.ammo += delta
-            self.ammo = max(0, min(RESOURCE_CAP, self.ammo))
-            self.set_col("RAmmo", self.ammo)
+            self.mod_resource("RAmmo", delta)
 
     def mod_steel(self, delta):
         """Add steel to the user.
@@ -109,9 +499,7 @@ class User:
             Amount to add, can be negative.
         """
         if (setting('features.resources_enabled')):
-            self.steel += delta
-            self.steel = max(0, min(RESOURCE_CAP, self.steel))
-            self.set_col("RSteel", self.steel)
+            self.mod_resource("RSteel", delta)
 
     def mod_bauxite(self, delta):
         """Add bauxite to the user.
@@ -122,15 +510,13 @@ class User:
             Amount to add, can be negative.
         """
         if (setting('features.resources_enabled')):
-            self.bauxite += delta
-            self.bauxite = max(0, min(RESOURCE_CAP, self.bauxite))
-            self.set_col("RBauxite", self.bauxite)
+            self.mod_resource("RBauxite", delta)
 
     def use_ring(self):
         """Remove 1 ring from the user's inventory."""
         self.rings -= 1
         self.rings = max(0, self.rings)
-        self.set_col("Rings", self.rings)
+        _write(self.did, _apply_use_ring, self.did)
 
     def has_enough(self, f, a, s, b):
         """Return if the user has enough of each given resource."""
@@ -140,6 +526,11 @@ class User:
         return True
 
 
+def _first_base_sid(sid):
+    """Return the ship ID of the original base of the given ship ID."""
+    return int(ship_stats.ShipBase.instance(int(sid)).get_first_base().sid)
+
+
 class UserInventory:
     """Represents a user's ship inventory."""
 
@@ -153,47 +544,122 @@ class UserInventory:
         """
         self.did = did
         self.inventory = []
+        # lookups into inventory, kept up to date by append and remove
+        self._by_invid = {}
+        self._by_sid = {}
+        self._by_base = {}
+        # ships added inside of a UnitOfWork that have no invid yet
+        self._unnumbered = []
+
+    def _index(self, ship_instance):
+        """Add a ship to the lookup indexes."""
+        if (ship_instance.invid < 0):
+            self._unnumbered.append(ship_instance)
+        else:
+            self._by_invid[ship_instance.invid] = ship_instance
+        self._by_sid.setdefault(int(ship_instance.sid),
+                                []).append(ship_instance)
+        self._by_base.setdefault(_first_base_sid(ship_instance.sid),
+                                 []).append(ship_instance)
+
+    def _unindex(self, ship_instance):
+        """Remove a ship from the lookup indexes."""
+        if (self._by_invid.get(ship_instance.invid) is ship_instance):
+            del self._by_invid[ship_instance.invid]
+        for index, key in ((self._by_sid, int(ship_instance.sid)),
+                           (self._by_base,
+                            _first_base_sid(ship_instance.sid))):
+            ships = index.get(key, [])
+            if (ship_instance in ships):
+                ships.remove(ship_instance)
+                if (len(ships) == 0):
+                    del index[key]
 
     def append(self, ship_instance):
         """Add the ship instance to the local inventory."""
         self.inventory.append(ship_instance)
+        self._index(ship_instance)
+
+    def get(self, invid):
+        """Return the ship with the given inventory ID, or None."""
+        if (len(self._unnumbered) > 0):
+            for ship_instance in self._unnumbered:
+                if (ship_instance.invid >= 0):
+                    self._by_invid[ship_instance.invid] = ship_instance
+            self._unnumbered = [x for x in self._unnumbered if x.invid < 0]
+        return self._by_invid.get(invid)
+
+    def by_sid(self, sid):
+        """Return a list of the ships with exactly the given ship ID."""
+        return list(self._by_sid.get(int(sid), []))
+
+    def by_base(self, sid):
+        """Return a list of the ships that are remodels of the same base."""
+        return list(self._by_base.get(_first_base_sid(sid), []))
+
+    def count(self, sid=None):
+        """Return the number of ships, or of ships with the given ship ID."""
+        if (sid is None):
+            return len(self.inventory)
+        return len(self._by_sid.get(int(sid), []))
+
+    def change_sid(self, ship_instance, sid):
+        """Change a ship's ship ID locally, e.g. for remodels."""
+        self._unindex(ship_instance)
+        ship_instance.sid = sid
+        self._index(ship_instance)
 
     def add_to_inventory(self, ship_instance):
-        """Add the ship instance to both the database and local inventories."""
-        table_name = USER_TABLE_NAME % (self.did)
-        query = "INSERT INTO %s (ShipID) VALUES (?)" % (table_name)
-        args = (ship_instance.sid,)
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute(query, args)
-
-        query = "SELECT ID FROM %s;" % table_name
-        cur.execute(query)
-        id = cur.fetchall()[-1]
-        ship_instance.invid = id[0]
-        cur.close()
-        conn.commit()
-        self.append(ship_instance)
+        """Add the ship instance to both the database and local inventories.
+
+        Inside of a UnitOfWork, the ship's invid is only set once the unit
+        has been applied.
+        """
+        self.add_many([ship_instance])
+
+    def add_many(self, ship_instances):
+        """Add several ship instances in one batched insert.
+
+        Parameters
+        ----------
+        ship_instances : list
+            The ShipInstances to add, all owned by this inventory's user.
+
+        Returns
+        -------
+        list
+            The inventory IDs given to the ships, or None inside of a
+            UnitOfWork, where they are only set once the unit is applied.
+        """
+        ship_instances = list(ship_instances)
+        ids = _write(self.did, _apply_add_ships, self.did, ship_instances)
+        for ship_instance in ship_instances:
+            self.append(ship_instance)
+        return ids
 
     def remove_from_inventory(self, inv_id):
         """Remove the given ship from the database and local inventories."""
-        table_name = USER_TABLE_NAME % (self.did)
-        query = "DELETE FROM %s WHERE ID=?" % (table_name)
-        args = (inv_id,)
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute(query, args)
-        cur.close()
-        conn.commit()
-        ins = [x for x in self.inventory if x.invid == inv_id]
-        if (len(ins) > 0):
-            si = ins.pop()
-            self.inventory.remove(si)
-        for f in range(1, 5):
-            fleet = UserFleet.instance(f, self.did)
-            if (inv_id in fleet.ships):
-                fleet.ships.remove(inv_id)
-                fleet.update()
+        self.remove_many([inv_id])
+
+    def remove_many(self, inv_ids):
+        """Remove several ships in one batched delete.
+
+        Parameters
+        ----------
+        inv_ids : list
+            The inventory IDs of the ships to remove.
+        """
+        inv_ids = list(inv_ids)
+        _write(self.did, _apply_remove_ships, self.did, inv_ids)
+        removed = set()
+        for inv_id in inv_ids:
+            ship_instance = self.get(inv_id)
+            if (ship_instance):
+                self._unindex(ship_instance)
+                removed.add(inv_id)
+        if (len(removed) > 0):
+            self.inventory = [x for x in self.inventory
+                              if x.invid not in removed]
 
 
 class UserFleet:
@@ -215,21 +681,13 @@ class UserFleet:
         self.owner = owner
         self.ships = ships
 
-    def col_name(self):
-        """Return the column name in the database for this fleet."""
-        return "Fleet_%s" % (self.fid)
-
-    def val(self):
-        """Return the string representation for this fleet."""
-        return ";".join(map(str, self.ships))
-
     def instance(fid, discordid):
         """Static method to return an instance of the given user's fleet.
 
         Parameters
         ----------
         fid : int
-            The id of the fleet to return, usually 1.
+            The id of the fleet to return, from 1 to FLEET_COUNT.
         discordid : int
             The discord ID of the user.
 
@@ -238,129 +696,159 @@ class UserFleet:
         UserFleet
             The fleet object.
         """
-        r = UserFleet(fid, discordid, [])
-        get_user(discordid)  # ensure user in table
-        query = "SELECT %s FROM Users WHERE DiscordID=?;" % (r.col_name())
-        args = (discordid,)
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute(query, args)
-        ship_string = cur.fetchone()[0]
-        cur.close()
-        conn.commit()
-
-        if(len(ship_string) > 0):
-            sids = ship_string.split(";")
-            sids = list(map(int, sids))
-            r.ships = sids
-        return r
+        if (fid < 1 or fid > FLEET_COUNT):
+            raise ValueError("No such fleet %s" % fid)
+        query = "SELECT InvID FROM FleetSlots WHERE OwnerID=? AND " \
+            "FleetID=? ORDER BY Position"
+        args = (discordid, fid)
+        rows = db.shard(discordid).fetchall(query, args)
+        return UserFleet(fid, discordid, [x[0] for x in rows])
 
     def update(self):
         """Update the local information to the database."""
-        query = "UPDATE Users SET %s=? WHERE DiscordID=?" % (self.col_name())
-        args = (self.val(), self.owner)
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute(query, args)
-        cur.close()
-        conn.commit()
+        _write(self.owner, _apply_fleet,
+               UserFleet(self.fid, self.owner, list(self.ships)))
 
     def get_ship_instances(self):
         """Return a list of instances of the ships in the fleet."""
         inv = get_user_inventory(self.owner)
-        return list(map(lambda x: [y for y in inv.inventory if
-                                   y.invid == x].pop(), self.ships))
+        return [inv.get(x) for x in self.ships]
 
     def has_similar(self, ship_id):
         """Return true if the fleet contains a ship with the given ID."""
-        check_id = ship_stats.ShipBase.instance(ship_id).get_first_base().sid
+        check_id = _first_base_sid(ship_id)
         return len([x for x in self.get_ship_instances() if
-                    x.base().get_first_base().sid == check_id]) > 0
+                    _first_base_sid(x.sid) == check_id]) > 0
 
 
-def get_user(discordid):
-    """Return a new User object representing the given user."""
-    query = "SELECT * FROM Users WHERE DiscordID=?"
+def _user_row(discordid):
+    """Return a dict of the user's row, creating the user if needed."""
+    shard = db.shard(discordid)
+    row = user_cache.get(discordid)
+    if (row is not None):
+        return row
+    query = "SELECT %s FROM Users WHERE DiscordID=?" % ", ".join(USER_COLUMNS)
     args = (discordid,)
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(query, args)
-    row = cur.fetchone()
-    cur.close()
-    conn.commit()
+    data = shard.fetchone(query, args)
 
-    if (not row):
+    if (not data):
         # if user doesn't exist, create it
         query = "REPLACE INTO Users (DiscordID) VALUES (?)"
-        args = (discordid,)
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute(query, args)
-        cur.close()
-        conn.commit()
-        return get_user(discordid)
-    return User(row[0], row[1], row[2], row[3], row[4], row[6], row[7],
-                row[15])
+        shard.execute(query, args)
+        return _user_row(discordid)
+    row = dict(zip(USER_COLUMNS, data))
+    user_cache.put(discordid, row)
+    return row
+
+
+def get_user(discordid):
+    """Return a new User object representing the given user."""
+    row = _user_row(discordid)
+    user = User(row['DiscordID'], row['RFuel'], row['RAmmo'], row['RSteel'],
+                row['RBauxite'], row['TotalXP'], row['Inventory_Size'],
+                row['Rings'])
+    pending.merge_user(user)
+    return user
+
+
+def _ensure_inventory(discordid):
+    """Give the user a starting inventory if they don't have one yet."""
+    shard = db.shard(discordid)
+    query = "SELECT 1 FROM InventorySeq WHERE OwnerID=?"
+    args = (discordid,)
+    if (shard.fetchone(query, args)):
+        return
+    # new inventories start as a copy of the base table
+    with shard.transaction():
+        query = "INSERT INTO Inventory (OwnerID, ID, ShipID, ShipLevel, " \
+            "ShipXP) SELECT ?, ID, ShipID, ShipLevel, ShipXP FROM %s" \
+            % BASIC_TABLE_NAME
+        shard.execute(query, args)
+        query = "INSERT INTO InventorySeq (OwnerID, LastID) " \
+            "SELECT ?, COALESCE(MAX(ID), 0) FROM %s" % BASIC_TABLE_NAME
+        shard.execute(query, args)
+
+
+def ensure_user(discordid):
+    """Create the user's row and starting inventory if they don't exist yet.
+
+    Call this before reading a user inside of a read_transaction, which
+    mustn't write.
+    """
+    _user_row(discordid)
+    _ensure_inventory(discordid)
 
 
 def get_user_inventory(discordid):
     """Return a UserInventory object for the given user."""
-    table_name = USER_TABLE_NAME % discordid
-    if (sqlutils.table_exists(get_connection(), table_name)):
-        query = "SELECT * FROM %s" % table_name
-        conn = get_connection()
-        cur = conn.cursor()
-        cur.execute(query)
-        data = cur.fetchall()
-        cur.close()
-        conn.commit()
-
-        inv = UserInventory(discordid)
-        for row in data:
-            si = ship_stats.ShipInstance(
-                row[0], row[1], discordid, row[2], row[3])
-            inv.append(si)
-        return inv
-    else:
-        # if user doesn't have an inventory, generate one from the base table
-        sqlutils.copy_table(get_connection(), BASIC_TABLE_NAME, table_name)
-        return get_user_inventory(discordid)
+    _ensure_inventory(discordid)
+    query = "SELECT ID, ShipID, ShipLevel, ShipXP FROM Inventory " \
+        "WHERE OwnerID=? ORDER BY ID"
+    args = (discordid,)
+    data = db.shard(discordid).fetchall(query, args)
+
+    inv = UserInventory(discordid)
+    for row in data:
+        si = ship_stats.ShipInstance(
+            row[0], row[1], discordid, row[2], row[3])
+        pending.merge_ship(si)
+        inv.append(si)
+    return inv
+
+
+def get_fleets(discordid):
+    """Return a list of all of the user's fleets, read in one query.
+
+    Returns
+    -------
+    list
+        UserFleets 1 to FLEET_COUNT, empty fleets included.
+    """
+    query = "SELECT FleetID, InvID FROM FleetSlots WHERE OwnerID=? " \
+        "ORDER BY FleetID, Position"
+    args = (discordid,)
+    fleets = [UserFleet(fid, discordid, [])
+              for fid in range(1, FLEET_COUNT + 1)]
+    for fid, inv_id in db.shard(discordid).fetchall(query, args):
+        if (1 <= fid <= FLEET_COUNT):
+            fleets[fid - 1].ships.append(inv_id)
+    return fleets
+
+
+def get_ship_instance(discordid, inv_id):
+    """Return a single ship from the user's inventory, or None."""
+    query = "SELECT ID, ShipID, ShipLevel, ShipXP FROM Inventory " \
+        "WHERE OwnerID=? AND ID=?"
+    args = (discordid, inv_id)
+    row = db.shard(discordid).fetchone(query, args)
+    if (not row):
+        return None
+    si = ship_stats.ShipInstance(row[0], row[1], discordid, row[2], row[3])
+    pending.merge_ship(si)
+    return si
 
 
 def has_space_in_inventory(did, ship_amount=1):
     """Return true if the user has space in their inventory for new ships."""
     user = get_user(did)
     inv = get_user_inventory(did)
-    return len(inv.inventory) + ship_amount <= user.shipslots
+    return inv.count() + ship_amount <= user.shipslots
 
 
 def update_ship_exp(ship_instance):
     """Update a ship instance's XP values in the database."""
-    query = "UPDATE %s SET ShipLevel=?, ShipXP=? WHERE ID=?" % (
-        USER_TABLE_NAME % ship_instance.owner)
-    args = (ship_instance.level, ship_instance.exp, ship_instance.invid)
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(query, args)
-    cur.close()
-    conn.commit()
+    _write(ship_instance.owner, _apply_ship_exp, ship_instance)
 
 
 def update_ship_sid(ship_instance):
     """Update a ship instance's ship ID in the database. Used for remodels."""
-    query = "UPDATE %s SET ShipID=? WHERE ID=?" % (
-        USER_TABLE_NAME % ship_instance.owner)
-    args = (ship_instance.sid, ship_instance.invid)
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(query, args)
-    cur.close()
-    conn.commit()
+    _write(ship_instance.owner, _apply_ship_sid, ship_instance)
 
 # returns 0 if off cooldown, # of seconds otherwise
 
 
-def check_cooldown(discordid, colname, cooldown_amount, set_if_off=True):
+def check_cooldown(discordid, colname, cooldown_amount, set_if_off=True,
+                   deferred=False):
     """Short summary.
 
     Parameters
@@ -373,33 +861,366 @@ def check_cooldown(discordid, colname, cooldown_amount, set_if_off=True):
         The number of seconds the cooldown is.
     set_if_off : bool
         If true and the user is off of cooldown, reset the cooldown.
+    deferred : bool
+        If true, the new cooldown is held in the write-behind buffer instead
+        of being written right away.
 
     Returns
     -------
     bool
         Whether or not the given cooldown is active for the user.
     """
-    query = "SELECT %s FROM Users WHERE DiscordID=?" % colname
-    args = (discordid,)
+    ts = pending.cooldown(discordid, colname)
+    if (ts is not None):
+        cd_s = max(0, ts + cooldown_amount - time.time())
+        if (cd_s > 0 or not set_if_off):
+            return cd_s
 
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(query, args)
-    ftch = cur.fetchone()
-    if not ftch:
-        get_user(discordid)  # generate default user profile
-        return check_cooldown(discordid, colname, cooldown_amount, set_if_off)
-    ts = ftch[0]
-    cur.close()
+    ts = max(_user_row(discordid)[colname],
+             pending.cooldown(discordid, colname) or 0)
 
     cd_s = ts + cooldown_amount - time.time()
     cd_s = max(0, cd_s)
     if (cd_s == 0 and set_if_off):
         new_time = int(time.time())
-        query = "UPDATE Users SET %s=? WHERE DiscordID=?" % colname
-        args = (new_time, discordid)
-        cur = conn.cursor()
-        cur.execute(query, args)
-        cur.close()
-    conn.commit()
+        if (deferred):
+            pending.stamp_cooldown(discordid, colname, new_time)
+        else:
+            set_cooldown(discordid, colname, new_time)
     return cd_s
+
+
+def set_cooldown(discordid, colname, timestamp=None):
+    """Start one of the user's cooldowns.
+
+    Parameters
+    ----------
+    discordid : int
+        The discord ID of the user.
+    colname : str
+        The column name in the database to set.
+    timestamp : int
+        The time the cooldown started, now if None.
+    """
+    if (timestamp is None):
+        timestamp = int(time.time())
+    _write(discordid, _apply_cooldown, discordid, colname, timestamp)
+
+
+def require_cooldown(discordid, colname, cooldown_amount):
+    """Require one of the user's cooldowns to be off.
+
+    Inside of a UnitOfWork the check is run again when the unit is applied,
+    and nothing is written if the cooldown has been started since.
+
+    Parameters
+    ----------
+    discordid : int
+        The discord ID of the user.
+    colname : str
+        The column name of the cooldown, e.g. "Last_Drop".
+    cooldown_amount : int
+        The number of seconds the cooldown is.
+
+    Returns
+    -------
+    bool
+        Whether the cooldown is off, always True inside of a UnitOfWork.
+    """
+    return _require(discordid, _check_cooldown, discordid, colname,
+                    cooldown_amount)
+
+
+def require_resources(discordid, fuel, ammo, steel, bauxite):
+    """Require the user to have at least the given resources.
+
+    See require_cooldown for how this works inside of a UnitOfWork.
+    """
+    return _require(discordid, _check_resources, discordid,
+                    (fuel, ammo, steel, bauxite))
+
+
+def require_rings(discordid, count=1):
+    """Require the user to have at least the given number of rings.
+
+    See require_cooldown for how this works inside of a UnitOfWork.
+    """
+    return _require(discordid, _check_rings, discordid, count)
+
+
+def require_space(discordid, ship_amount=1):
+    """Require the user to have space in their inventory for new ships.
+
+    See require_cooldown for how this works inside of a UnitOfWork.
+    """
+    return _require(discordid, _check_space, discordid, ship_amount)
+
+
+def require_ships(discordid, inv_ids, max_level=None):
+    """Require the ships to still be in the user's inventory.
+
+    See require_cooldown for how this works inside of a UnitOfWork.
+
+    Parameters
+    ----------
+    discordid : int
+        The discord ID of the user.
+    inv_ids : list
+        The inventory IDs of the ships.
+    max_level : int
+        If given, the ships also mustn't be above this level.
+    """
+    return _require(discordid, _check_ships, discordid, list(inv_ids),
+                    max_level)
+
+
+class WriteBehindBuffer:
+    """Holds frequent small writes in memory until they are flushed.
+
+    Resource gains and ship EXP are kept as deltas, cooldowns as the newest
+    timestamp. Reads through get_user, get_user_inventory and check_cooldown
+    merge in whatever is still waiting to be written.
+
+    The database threads take the buffer's lock while holding a shard's, so
+    the buffer never waits on a shard while holding its own lock. A flush
+    moves what it writes into an in-flight batch, which reads still merge
+    in, and only drops the batch inside its transaction.
+    """
+
+    def __init__(self):
+        """Initialize the empty buffer."""
+        self.resources = {}  # discord id -> {column: delta}
+        self.ship_exp = {}  # (discord id, inventory id) -> exp delta
+        self.cooldowns = {}  # (discord id, column) -> timestamp
+        # (resources, ship_exp, cooldowns) taken by flushes not yet committed
+        self._in_flight = []
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        """Return the number of buffered entries."""
+        return len(self.resources) + len(self.ship_exp) + len(self.cooldowns)
+
+    def _layers(self):
+        """Return the in-flight batches, oldest first, then the buffer."""
+        return self._in_flight + [(self.resources, self.ship_exp,
+                                   self.cooldowns)]
+
+    def add_resources(self, did, **deltas):
+        """Buffer resource gains for a user, keyed by resource column."""
+        with self._lock:
+            user_deltas = self.resources.setdefault(did, {})
+            for col, delta in deltas.items():
+                user_deltas[col] = user_deltas.get(col, 0) + delta
+
+    def add_ship_exp(self, ship_instance, exp):
+        """Buffer EXP for a ship, returning True if it levelled up.
+
+        The ship instance is updated locally but nothing is written.
+        """
+        with self._lock:
+            lvl = ship_instance.add_exp(exp, save=False)
+            key = (ship_instance.owner, ship_instance.invid)
+            self.ship_exp[key] = self.ship_exp.get(key, 0) + exp
+            ship_instance.pending_exp += exp
+            return lvl
+
+    def stamp_cooldown(self, did, colname, timestamp):
+        """Buffer a new cooldown timestamp."""
+        with self._lock:
+            self.cooldowns[(did, colname)] = timestamp
+
+    def cooldown(self, did, colname):
+        """Return the buffered timestamp for a cooldown, or None."""
+        with self._lock:
+            stamps = [cooldowns[(did, colname)]
+                      for _r, _e, cooldowns in self._layers()
+                      if (did, colname) in cooldowns]
+            return max(stamps) if stamps else None
+
+    def discard_cooldown(self, did, colname):
+        """Forget a buffered cooldown which has been overwritten."""
+        with self._lock:
+            for _r, _e, cooldowns in self._layers():
+                cooldowns.pop((did, colname), None)
+
+    def discard_ship(self, did, inv_id):
+        """Forget buffered EXP for a ship which no longer exists."""
+        with self._lock:
+            for _r, ship_exp, _c in self._layers():
+                ship_exp.pop((did, inv_id), None)
+
+    def merge_user(self, user):
+        """Apply buffered resource gains to a freshly read User."""
+        with self._lock:
+            totals = {}
+            for resources, _e, _c in self._layers():
+                for col, delta in resources.get(user.did, {}).items():
+                    totals[col] = totals.get(col, 0) + delta
+            for col, delta in totals.items():
+                attr = RESOURCE_COLUMNS[col]
+                setattr(user, attr, max(0, min(RESOURCE_CAP,
+                                               getattr(user, attr) + delta)))
+
+    def merge_ship(self, ship_instance):
+        """Apply buffered EXP to a freshly read ShipInstance."""
+        with self._lock:
+            key = (ship_instance.owner, ship_instance.invid)
+            exp = sum(ship_exp.get(key, 0)
+                      for _r, ship_exp, _c in self._layers())
+            if (exp):
+                ship_instance.add_exp(exp, save=False)
+                ship_instance.pending_exp = exp
+
+    def consume_ship(self, ship_instance):
+        """Drop the buffered EXP a ship instance had merged into it.
+
+        Called once the ship's absolute level and EXP have been written.
+        """
+        with self._lock:
+            key = (ship_instance.owner, ship_instance.invid)
+            used = ship_instance.pending_exp
+            for _r, ship_exp, _c in self._layers():
+                left = ship_exp.get(key, 0) - used
+                used = max(0, -left)
+                if (left > 0):
+                    ship_exp[key] = left
+                else:
+                    ship_exp.pop(key, None)
+            ship_instance.pending_exp = 0
+
+    def _take(self, wanted, resources_only=False):
+        """Move the entries of the wanted users into a new in-flight batch.
+
+        Call with the lock held.
+
+        Parameters
+        ----------
+        wanted : function
+            Returns True for the Discord IDs to take.
+        resources_only : bool
+            If True, only take resource gains.
+
+        Returns
+        -------
+        tuple
+            The batch's (resources, ship_exp, cooldowns), or None if there
+            was nothing to take.
+        """
+        sources = [(self.resources, lambda k: k),
+                   (self.ship_exp, lambda k: k[0]),
+                   (self.cooldowns, lambda k: k[0])]
+        if (resources_only):
+            sources = sources[:1]
+        batch = ({}, {}, {})
+        for taken, (entries, did_of) in zip(batch, sources):
+            for key in [k for k in entries if wanted(did_of(k))]:
+                taken[key] = entries.pop(key)
+        if (not any(batch)):
+            return None
+        self._in_flight.append(batch)
+        return batch
+
+    def _write(self, batch):
+        """Write an in-flight batch in one transaction per shard.
+
+        Call without the lock held. On failure the batch goes back into
+        the buffer.
+        """
+        resources, ship_exp, cooldowns = batch
+        dids = set(resources)
+        dids.update(x[0] for x in ship_exp)
+        dids.update(x[0] for x in cooldowns)
+        try:
+            with db.transaction(dids):
+                # the shards are held now, so nothing else changes the batch
+                for did, deltas in resources.items():
+                    for col, delta in deltas.items():
+                        _apply_mod_resource(did, col, delta)
+                for (did, colname), timestamp in cooldowns.items():
+                    query = "UPDATE Users SET {0}=MAX({0}, ?) " \
+                        "WHERE DiscordID=?".format(colname)
+                    args = (timestamp, did)
+                    db.shard(did).execute(query, args)
+                    row = user_cache.peek(did)
+                    if (row is not None):
+                        _cache_col(did, colname, max(row[colname], timestamp))
+                for (did, inv_id), exp in list(ship_exp.items()):
+                    # read without merging, the batch's EXP is still buffered
+                    query = "SELECT ShipID, ShipLevel, ShipXP FROM Inventory " \
+                        "WHERE OwnerID=? AND ID=?"
+                    args = (did, inv_id)
+                    row = db.shard(did).fetchone(query, args)
+                    if (row):
+                        si = ship_stats.ShipInstance(inv_id, row[0], did,
+                                                     row[1], row[2])
+                        si.add_exp(exp, save=False)
+                        _apply_ship_exp(si)
+                with self._lock:
+                    self._drop_batch(batch)
+        except BaseException:
+            with self._lock:
+                self._drop_batch(batch)
+                for did, deltas in resources.items():
+                    self.add_resources(did, **deltas)
+                for key, exp in ship_exp.items():
+                    self.ship_exp[key] = self.ship_exp.get(key, 0) + exp
+                for key, timestamp in cooldowns.items():
+                    self.cooldowns[key] = max(self.cooldowns.get(key, 0),
+                                              timestamp)
+            raise
+
+    def _drop_batch(self, batch):
+        """Forget an in-flight batch, call with the lock held."""
+        self._in_flight = [x for x in self._in_flight if x is not batch]
+
+    def flush_resources(self, dids):
+        """Write the buffered resource gains of only the given users.
+
+        Returns
+        -------
+        int
+            The number of users whose gains were written.
+        """
+        dids = set(dids)
+        with self._lock:
+            batch = self._take(lambda did: did in dids, resources_only=True)
+        if (batch is None):
+            return 0
+        self._write(batch)
+        return len(batch[0])
+
+    def flush(self, shard=None):
+        """Write everything in the buffer in one transaction per shard.
+
+        Parameters
+        ----------
+        shard : int
+            If given, only flush the users in the shard with this index.
+
+        Returns
+        -------
+        int
+            The number of entries written.
+        """
+        with self._lock:
+            batch = self._take(lambda did: shard is None
+                               or db.index(did) == shard)
+        if (batch is None):
+            return 0
+        self._write(batch)
+        return sum(len(x) for x in batch)
+
+
+pending = WriteBehindBuffer()
+
+
+def flush_pending(shard=None):
+    """Write all buffered changes to the database.
+
+    Parameters
+    ----------
+    shard : int
+        If given, only write the changes of users in the shard with this
+        index.
+    """
+    return pending.flush(shard)
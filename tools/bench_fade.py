@@ -0,0 +1,74 @@
+"""Benchmark the inventory icon fade: per-pixel loop against a cached mask.
+
+e.g.
+    python tools/bench_fade.py --icons 200
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '../kantaibot'))
+
+from PIL import Image, ImageChops  # noqa: E402
+import imggen  # noqa: E402
+
+
+def fade_loop(ico):
+    """Fade the right quarter of an icon one pixel at a time, as it was."""
+    pxls = ico.load()
+    grad_start = int(ico.size[0] * 0.75)
+    grad_end = ico.size[0]
+    for ix in range(grad_start, grad_end):
+        for iy in range(ico.size[1]):
+            fade_amt = (ix - grad_start) / (grad_end - grad_start)
+            fade_amt *= fade_amt
+            new_alpha = int(pxls[ix, iy][3] * (1 - fade_amt))
+            pxls[ix, iy] = pxls[ix, iy][:3] + (new_alpha,)
+    return ico
+
+
+def fade_mask(ico):
+    """Fade the right quarter of an icon with the cached gradient mask."""
+    ico.putalpha(ImageChops.multiply(ico.getchannel('A'),
+                                     imggen.get_fade_mask(ico.size)))
+    return ico
+
+
+def bench(func, icon, count):
+    """Return the average milliseconds func takes to fade a copy of icon."""
+    copies = [icon.copy() for _ in range(count)]
+    start = time.perf_counter()
+    for ico in copies:
+        func(ico)
+    return (time.perf_counter() - start) * 1000 / count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--icons", type=int, default=200,
+                        help="number of icons to fade with each approach")
+    parser.add_argument("--height", type=int,
+                        help="icon height, defaults to an inventory cell's")
+    args = parser.parse_args()
+
+    layout = imggen.CONFIG_DATA['inventory']
+    ch = args.height or (layout['image_size'][1] * 2
+                         // layout['per_column'])
+    size = (int(ch * 1.5) - 6, ch - 6)
+    # an opaque icon with some noise so nothing is optimised away
+    icon = Image.merge("RGBA", [Image.effect_noise(size, 64)] * 3
+                       + [Image.new("L", size, 255)])
+
+    loop_ms = bench(fade_loop, icon, args.icons)
+    imggen.get_fade_mask(size)  # built once per size, not timed
+    mask_ms = bench(fade_mask, icon, args.icons)
+
+    diff = ImageChops.difference(fade_loop(icon.copy()).getchannel('A'),
+                                 fade_mask(icon.copy()).getchannel('A'))
+    print("icon size %dx%d, %d icons" % (size + (args.icons,)))
+    print("pixel loop:    %8.3f ms per icon" % loop_ms)
+    print("gradient mask: %8.3f ms per icon (%.0fx faster)" % (
+        mask_ms, loop_ms / mask_ms))
+    print("largest alpha difference: %d" % diff.getextrema()[1])
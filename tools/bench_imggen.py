@@ -0,0 +1,311 @@
+"""Benchmark the image generation paths on synthetic users.
+
+Builds users with the given numbers of ships on a throwaway in-memory
+database, then times the inventory screen, ship cards, birthday images
+and sortie maps. Each render is split into stages: data fetch,
+compositing, text, downsample and encode. Every render is timed cold
+(in-memory caches and scaled CGs on disk emptied first) and warm. Scaled
+CGs go to a temporary folder, so the bot's own cache isn't touched.
+
+Results are written as JSON so two commits can be compared.
+
+e.g.
+    python tools/bench_imggen.py --output before.json
+    python tools/bench_imggen.py --output after.json --compare before.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '../kantaibot'))
+
+import PIL  # noqa: E402
+import assetcache  # noqa: E402
+import assetpack  # noqa: E402
+import imggen  # noqa: E402
+import ship_stats  # noqa: E402
+import sorties  # noqa: E402
+import userinfo  # noqa: E402
+from settings import setting  # noqa: E402
+
+STAGES = ("fetch", "compositing", "text", "downsample", "encode")
+
+# seconds spent in each stage by the render being timed
+_stage_times = dict.fromkeys(STAGES, 0.0)
+
+
+def _timed_stage(stage, func):
+    """Wrap func so its time is added to the given stage."""
+    def wrapper(*args, **kwargs):
+        """Call func, timing it."""
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _stage_times[stage] += time.perf_counter() - start
+    return wrapper
+
+
+# text is also drawn inside of inventory cells, so it's timed where it's
+# drawn rather than around the callers
+imggen.draw_squish_text = _timed_stage("text", imggen.draw_squish_text)
+imggen.downsample = _timed_stage("downsample", imggen.downsample)
+imggen.encode_image = _timed_stage("encode", imggen.encode_image)
+
+
+def clear_caches():
+    """Empty the render caches and scaled CGs, so the next render is cold."""
+    assetcache.clear()
+    shutil.rmtree(assetcache.MIP_DIR, ignore_errors=True)
+    imggen.tile_cache.clear()
+    imggen.sprite_cache.clear()
+    imggen._fade_mask_cache.clear()
+
+
+def make_user(did, ship_count, rng):
+    """Add a user with the given number of ships to the database.
+
+    Ships cycle through every rarity. Some are married, some are ready to
+    remodel, and the first ships fill up every fleet.
+
+    Returns
+    -------
+    list
+        The user's ShipInstances.
+    """
+    by_rarity = {}
+    for sid in sorted(ship_stats.SHIP_DATA, key=int):
+        base = ship_stats.ShipBase.instance(int(sid))
+        by_rarity.setdefault(base.rarity, []).append(base)
+    rarities = sorted(by_rarity)
+    level_cap = setting('levels.level_cap')
+
+    ships = []
+    for i in range(ship_count):
+        base = rng.choice(by_rarity[rarities[i % len(rarities)]])
+        if (i % 7 == 0):
+            level = rng.randrange(level_cap + 1,
+                                  setting('levels.level_cap_married') + 1)
+        elif (i % 5 == 0 and base.remodels_into):
+            level = max(base.remodel_level, 1)
+        else:
+            level = rng.randrange(1, level_cap + 1)
+        ships.append(ship_stats.ShipInstance(-1, base.sid, did, level,
+                                             rng.randrange(0, 1000)))
+    inv = userinfo.get_user_inventory(did)
+    ids = inv.add_many(ships)
+    for ship_instance, invid in zip(ships, ids):
+        ship_instance.invid = invid
+    for fid in range(1, userinfo.FLEET_COUNT + 1):
+        fleet_ids = ids[(fid - 1) * 6:fid * 6]
+        if (fleet_ids):
+            userinfo.UserFleet(fid, did, fleet_ids).update()
+    userinfo.flush_pending()
+    return ships
+
+
+def time_render(fetch, draw):
+    """Run one render and return the seconds spent in each stage.
+
+    Parameters
+    ----------
+    fetch : function
+        Reads everything the render needs, returning it.
+    draw : function
+        Draws and encodes what fetch returned, returning the last BytesIO
+        it made.
+    """
+    for stage in STAGES:
+        _stage_times[stage] = 0.0
+    start = time.perf_counter()
+    data = fetch()
+    fetched = time.perf_counter()
+    result = draw(data)
+    end = time.perf_counter()
+
+    times = dict(_stage_times)
+    times['fetch'] = fetched - start
+    times['compositing'] = max(0.0, (end - fetched) - times['text']
+                               - times['downsample'] - times['encode'])
+    times['total'] = end - start
+    times['bytes'] = result.getbuffer().nbytes
+    return times
+
+
+def summarize(runs):
+    """Return the median of each stage over the runs, in milliseconds."""
+    summary = {}
+    for stage in STAGES + ("total",):
+        summary[stage] = round(statistics.median(
+            run[stage] for run in runs) * 1000, 3)
+    summary['total_min'] = round(min(run['total'] for run in runs) * 1000, 3)
+    summary['bytes'] = runs[-1]['bytes']
+    return summary
+
+
+def bench(fetch, draw, runs):
+    """Return the cold and warm summaries of a render."""
+    cold = []
+    for _ in range(runs):
+        clear_caches()
+        cold.append(time_render(fetch, draw))
+    warm = [time_render(fetch, draw) for _ in range(runs)]
+    return {'cold': summarize(cold), 'warm': summarize(warm)}
+
+
+def render_jobs(did, ships, quality, rng):
+    """Return (name, fetch, draw) of every render to time for a user."""
+    member = "Benchmark#0001"
+    bot = types.SimpleNamespace(guilds=[])
+    # one ship of each rarity, married and not, for the cards
+    card_ships = {}
+    for ship_instance in ships:
+        base = ship_instance.base()
+        married = ship_instance.level > setting('levels.level_cap')
+        card_ships.setdefault((base.rarity, married), ship_instance)
+    card_ships = [card_ships[k] for k in sorted(card_ships)]
+    birthday_bases = [ship_instance.base() for ship_instance in ships[:4]]
+    sortie_seeds = [rng.randrange(1 << 30) for _ in range(4)]
+
+    def draw_cards(snapshots):
+        """Draw every card, returning the last."""
+        for snapshot in snapshots:
+            result = imggen.draw_ship_card(snapshot, quality)
+        return result
+
+    def draw_birthdays(bases):
+        """Draw every birthday image, returning the last."""
+        for base in bases:
+            result = imggen.get_birthday_image(base, quality)
+        return result
+
+    def make_sorties():
+        """Return the sorties made from the seeds."""
+        made = []
+        for seed in sortie_seeds:
+            random.seed(seed)
+            made.append(sorties.random_sortie())
+        return made
+
+    def draw_sorties(made):
+        """Draw every sortie card, returning the last."""
+        for sortie in made:
+            result = imggen.generate_sortie_card(sortie)
+        return result
+
+    return [
+        ("inventory", lambda: imggen.InventorySnapshot.take(
+            did, member, 1, False),
+         lambda snapshot: imggen.draw_inventory_screen(snapshot, quality)),
+        ("inventory_dupes", lambda: imggen.InventorySnapshot.take(
+            did, member, 1, True),
+         lambda snapshot: imggen.draw_inventory_screen(snapshot, quality)),
+        ("ship_card x%d" % len(card_ships),
+         lambda: [imggen.ShipCardSnapshot.take(bot, s) for s in card_ships],
+         draw_cards),
+        ("birthday x%d" % len(birthday_bases), lambda: birthday_bases,
+         draw_birthdays),
+        ("sortie x%d" % len(sortie_seeds), make_sorties, draw_sorties),
+    ]
+
+
+def git_commit():
+    """Return the short hash of the checked out commit, or None."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=imggen.DIR_PATH,
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, meta, old):
+    """Print how each render's time changed against older results."""
+    print("\nCompared to %s:" % (old['meta'].get('commit') or "old results"))
+    for name in ('quality', 'runs', 'seed', 'asset_pack'):
+        if (old['meta'].get(name) != meta[name]):
+            print("  warning: %s was %s, now %s" % (
+                name, old['meta'].get(name), meta[name]))
+    for key, modes in sorted(results.items()):
+        if (key not in old['results']):
+            continue
+        for mode in ("cold", "warm"):
+            before = old['results'][key][mode]['total']
+            after = modes[mode]['total']
+            print("  %-32s %-4s %9.1fms -> %9.1fms (%+.1f%%)" % (
+                key, mode, before, after,
+                100.0 * (after - before) / before if before else 0.0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[50, 200, 1000],
+                        help="numbers of ships of the synthetic users")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="times to run each render cold and warm")
+    parser.add_argument("--quality",
+                        help="quality profile to draw with, defaults to the "
+                             "layout's default")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="seed for the synthetic users and sorties")
+    parser.add_argument("--output", help="file to write the JSON results to")
+    parser.add_argument("--compare",
+                        help="JSON results of an earlier run to compare to")
+    args = parser.parse_args()
+
+    # the fonts are found relative to the bot's folder
+    os.chdir(imggen.DIR_PATH)
+    userinfo.use_database(userinfo.open_database("memory"))
+    userinfo.init_db()
+    assetcache.MIP_DIR = tempfile.mkdtemp(prefix="bench_mips_")
+
+    rng = random.Random(args.seed)
+    results = {}
+    try:
+        for did, size in enumerate(args.sizes, start=1):
+            ships = make_user(did, size, rng)
+            for name, fetch, draw in render_jobs(did, ships, args.quality,
+                                                 rng):
+                key = "%s/%d ships" % (name, size)
+                results[key] = bench(fetch, draw, args.runs)
+                print("%-32s cold %9.1fms  warm %9.1fms  (%s)" % (
+                    key, results[key]['cold']['total'],
+                    results[key]['warm']['total'],
+                    ", ".join("%s %.1f" % (stage,
+                                           results[key]['warm'][stage])
+                              for stage in STAGES)))
+    finally:
+        shutil.rmtree(assetcache.MIP_DIR, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'quality': args.quality or imggen.CONFIG_DATA['default_quality'],
+            'runs': args.runs,
+            'seed': args.seed,
+            'asset_pack': assetpack.pack is not None,
+        },
+        'results': results,
+    }
+    if (args.output):
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print("Wrote %s" % args.output)
+    if (args.compare):
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(results, report['meta'], json.load(f))
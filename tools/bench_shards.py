@@ -0,0 +1,76 @@
+"""Benchmark user database write throughput as the shard count grows.
+
+Runs the same mix of writes a drop or craft makes (a resource change and a
+new ship, in one transaction) for many users at once through the database
+lanes, against throwaway database files.
+
+e.g.
+    python tools/bench_shards.py --shards 1 2 4 8 --writes 4000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '../kantaibot'))
+
+import asyncdb  # noqa: E402
+import database  # noqa: E402
+import ship_stats  # noqa: E402
+import userinfo  # noqa: E402
+
+
+def write(did):
+    """Make one command's worth of writes for a user."""
+    with userinfo.transaction(did):
+        userinfo.get_user(did).mod_fuel(-1)
+        userinfo.UserInventory(did).add_to_inventory(
+            ship_stats.ShipInstance.new(1, did))
+
+
+def bench(shard_count, writes, users, lanes_per_shard, synchronous):
+    """Return the writes per second reached with the given shard count."""
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = database.shard_paths(os.path.join(tmp, "usersdb.db"),
+                                     shard_count)
+        userinfo.use_database(database.ShardRouter(
+            database.Database(p, synchronous=synchronous) for p in paths))
+        userinfo.init_db()
+        lanes = asyncdb.DatabaseLanes(lanes_per_shard * shard_count,
+                                      shard_count)
+        dids = [random.randrange(10 ** 17, 10 ** 18) for _ in range(users)]
+        # create every user up front so only the writes are timed
+        for did in dids:
+            userinfo.get_user_inventory(did)
+
+        start = time.perf_counter()
+        futures = [lanes.lane(did).submit(write, did)
+                   for did in random.choices(dids, k=writes)]
+        for future in futures:
+            future.result()
+        elapsed = time.perf_counter() - start
+
+        lanes.shutdown()
+        userinfo.db.close()
+    return writes / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--shards", type=int, nargs="+",
+                        default=[1, 2, 4, 8])
+    parser.add_argument("--writes", type=int, default=4000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--lanes-per-shard", type=int, default=1)
+    parser.add_argument("--synchronous", default="NORMAL",
+                        help="synchronous pragma, FULL fsyncs every commit")
+    args = parser.parse_args()
+
+    print("shards  writes/s")
+    for shard_count in args.shards:
+        rate = bench(shard_count, args.writes, args.users,
+                     args.lanes_per_shard, args.synchronous)
+        print("%6d  %8.0f" % (shard_count, rate))
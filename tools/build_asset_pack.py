@@ -0,0 +1,61 @@
+"""Build the asset pack from the cgs/, icos/ and seasonal_cg/ folders.
+
+Every image of every ship in ships.json is packed, using the seasonal
+image for ships in seasonal.json. Images that haven't been downloaded are
+left out, and are read from their own files as before.
+
+e.g.
+    python tools/build_asset_pack.py --raw icons
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '../kantaibot'))
+
+import assetpack  # noqa: E402
+import ship_stats  # noqa: E402
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", default=assetpack.PACK_FILE,
+                        help="file to write, defaults to the assets.pack_file "
+                             "setting")
+    parser.add_argument("--raw", choices=("none", "icons", "all"),
+                        default="icons",
+                        help="which images to store pre-decoded. Raw images "
+                             "skip decoding but take several times the space")
+    args = parser.parse_args()
+    if (not args.output):
+        parser.error("no --output given and assets.pack_file isn't set")
+
+    start = time.perf_counter()
+    writer = assetpack.PackWriter(args.output)
+    missing = 0
+    for sid in sorted(ship_stats.SHIP_DATA, key=int):
+        base = ship_stats.ShipBase.instance(int(sid))
+        for ico in (True, False):
+            for dmg in (False, True):
+                key = base.cg_pack_key(ico, dmg)
+                path, _url = base.cg_source(ico, dmg)
+                if (key in writer.index):
+                    continue
+                if (not os.path.exists(path)):
+                    missing += 1
+                    continue
+                writer.add(key, path, raw=args.raw == "all" or (
+                    args.raw == "icons" and ico))
+    writer.close()
+
+    pack = assetpack.AssetPack(args.output)
+    raw = sum(1 for entry in pack.index.values()
+              if entry['encoding'] == "raw")
+    print("Packed %d images (%d pre-decoded) into %s, %.1f MiB, in %.1fs"
+          % (len(pack), raw, args.output,
+             os.path.getsize(args.output) / 1048576,
+             time.perf_counter() - start))
+    if (missing):
+        print("%d images weren't downloaded and were left out" % missing)
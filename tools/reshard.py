@@ -0,0 +1,140 @@
+"""Offline tool to split the users database into shards or merge them back.
+
+Stop the bot before running this, then set database.shards in the settings
+file to the new count. The old files are left in place.
+
+e.g.
+    python tools/reshard.py 1 4  (usersdb.db -> usersdb.shard0-of-4.db, ...)
+    python tools/reshard.py 4 1  (and back again)
+"""
+import argparse
+import os
+import sys
+from contextlib import ExitStack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '../kantaibot'))
+
+import database  # noqa: E402
+import userinfo  # noqa: E402
+
+# tables holding per-user rows, and the column with the user's Discord ID
+SHARDED_TABLES = (("Users", "DiscordID"), ("Inventory", "OwnerID"),
+                  ("InventorySeq", "OwnerID"), ("FleetSlots", "OwnerID"))
+# tables copied whole into every shard
+SHARED_TABLES = (userinfo.BASIC_TABLE_NAME,)
+BATCH_SIZE = 1000
+
+
+def columns(db, table):
+    """Return the column names of a table."""
+    return [x[1] for x in db.fetchall("PRAGMA table_info(%s)" % table)]
+
+
+def copy_rows(src, table, dests, route):
+    """Copy every row of a table from src into the dest chosen by route.
+
+    Parameters
+    ----------
+    src : database.Database
+        The shard to read from.
+    table : str
+        The table to copy.
+    dests : list
+        The Databases to write to.
+    route : function
+        Function taking a row and returning the index of its dest, or None
+        to copy the row into every dest.
+
+    Returns
+    -------
+    int
+        The number of rows read.
+    """
+    cols = [x for x in columns(src, table) if x in columns(dests[0], table)]
+    query = "INSERT OR REPLACE INTO %s (%s) VALUES (%s)" % (
+        table, ", ".join(cols), ", ".join("?" * len(cols)))
+    cur = src.connection().execute("SELECT %s FROM %s" % (", ".join(cols),
+                                                          table))
+    count = 0
+    while True:
+        rows = cur.fetchmany(BATCH_SIZE)
+        if (not rows):
+            break
+        count += len(rows)
+        batches = [[] for _ in dests]
+        for row in rows:
+            index = route(cols, row)
+            if (index is None):
+                for batch in batches:
+                    batch.append(row)
+            else:
+                batches[index].append(row)
+        for dest, batch in zip(dests, batches):
+            if (len(batch) > 0):
+                dest.executemany(query, batch)
+    cur.close()
+    return count
+
+
+def reshard(from_count, to_count, path=userinfo.DB_PATH):
+    """Copy every user from one shard layout into a new one."""
+    src_paths = database.shard_paths(path, from_count)
+    dest_paths = database.shard_paths(path, to_count)
+    for p in src_paths:
+        if (not os.path.exists(p)):
+            sys.exit("Missing source shard %s" % p)
+    for p in dest_paths:
+        if (os.path.exists(p)):
+            sys.exit("%s already exists, remove it first" % p)
+
+    # bring the old files up to the current schema first
+    src = database.ShardRouter(database.Database(p) for p in src_paths)
+    userinfo.use_database(src)
+    userinfo.init_db()
+    dests = [database.Database(p) for p in dest_paths]
+    with open(userinfo.SCHEMA_PATH, 'r') as schema:
+        script = schema.read()
+    for dest in dests:
+        dest.executescript(script)
+
+    with ExitStack() as stack:
+        for dest in dests:
+            stack.enter_context(dest.transaction())
+        for table in SHARED_TABLES:
+            copy_rows(src.shards[0], table, dests, lambda cols, row: None)
+        for table, key in SHARDED_TABLES:
+            total = 0
+            for shard in src:
+                total += copy_rows(
+                    shard, table, dests,
+                    lambda cols, row: database.shard_index(
+                        row[cols.index(key)], to_count))
+            print("%s: %d rows" % (table, total))
+
+    # make sure nothing was lost on the way
+    for table, _key in SHARDED_TABLES:
+        before = sum(x.fetchone("SELECT COUNT(*) FROM %s" % table)[0]
+                     for x in src)
+        after = sum(x.fetchone("SELECT COUNT(*) FROM %s" % table)[0]
+                    for x in dests)
+        if (before != after):
+            sys.exit("%s has %d rows in the new shards, expected %d" % (
+                table, after, before))
+    src.close()
+    for dest in dests:
+        dest.close()
+    print("Wrote %s" % ", ".join(dest_paths))
+    print("Set database.shards to %d in settings.json" % to_count)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("from_count", type=int,
+                        help="current number of shards")
+    parser.add_argument("to_count", type=int, help="new number of shards")
+    args = parser.parse_args()
+    if (args.from_count < 1 or args.to_count < 1
+            or args.from_count == args.to_count):
+        sys.exit("Shard counts must be different and at least 1")
+    reshard(args.from_count, args.to_count)
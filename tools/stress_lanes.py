@@ -0,0 +1,139 @@
+"""Stress the database lanes with flushes, commands and snapshots at once.
+
+Runs the periodic write-behind flush in a loop while users buffer passive
+gains, apply units of work and take inventory snapshots on their own lanes,
+against throwaway database files. Fails if the lanes stop making progress,
+e.g. on a lock-order deadlock, or if a buffered gain is lost or written
+twice.
+
+e.g.
+    python tools/stress_lanes.py --shards 2 --threads 1 --seconds 10
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '../kantaibot'))
+
+import asyncdb  # noqa: E402
+import database  # noqa: E402
+import imggen  # noqa: E402
+import ship_stats  # noqa: E402
+import userinfo  # noqa: E402
+
+
+def make_user(did):
+    """Create a user with a few ships, the first of them in fleet 1."""
+    ships = [ship_stats.ShipInstance.new(sid, did) for sid in (1, 2, 3)]
+    ids = userinfo.UserInventory(did).add_many(ships)
+    userinfo.UserFleet(1, did, ids[:1]).update()
+    user = userinfo.get_user(did)
+    return (user.fuel, user.ammo)
+
+
+def passive_gain(did):
+    """Buffer one ammo and some flagship EXP, like a message does."""
+    userinfo.pending.add_resources(did, RAmmo=1)
+    fleet = userinfo.UserFleet.instance(1, did)
+    si_flag = userinfo.get_ship_instance(did, fleet.ships[0])
+    userinfo.pending.add_ship_exp(si_flag, 1)
+
+
+async def run_user(did, stop, counts):
+    """Act like one busy user until the stop time."""
+    while (time.monotonic() < stop):
+        await asyncdb.run(did, passive_gain, did)
+        counts[did]['gains'] += 1
+
+        user = await asyncdb.users.get(did)
+        inv = await asyncdb.inventories.get(did)
+        with userinfo.UnitOfWork() as uow:
+            userinfo.require_cooldown(did, 'Last_Drop', 0)
+            userinfo.require_ships(did, [inv.inventory[0].invid])
+            user.mod_fuel(1)
+            inv.inventory[0].add_exp(1)
+            userinfo.set_cooldown(did, 'Last_Drop')
+        if (await asyncdb.apply(did, uow)):
+            counts[did]['applies'] += 1
+
+        await asyncdb.run(did, imggen.InventorySnapshot.take, did,
+                          "Stress#0001", 1)
+
+
+async def run_flushes(stop):
+    """Flush the write-behind buffer as often as possible until stop."""
+    count = 0
+    while (time.monotonic() < stop):
+        await asyncdb.flush()
+        count += 1
+    return count
+
+
+async def stress(dids, seconds):
+    """Run every user and the flush loop, returning the flush count."""
+    stop = time.monotonic() + seconds
+    counts = {did: {'gains': 0, 'applies': 0} for did in dids}
+    results = await asyncio.gather(run_flushes(stop),
+                                   *(run_user(did, stop, counts)
+                                     for did in dids))
+    return results[0], counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--shards", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=1,
+                        help="database lanes, rounded up to a multiple of "
+                             "the shard count")
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--timeout", type=float, default=30,
+                        help="seconds past the end to wait before calling "
+                             "the lanes stuck")
+    args = parser.parse_args()
+
+    # the fonts are found relative to the bot's folder
+    os.chdir(imggen.DIR_PATH)
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = database.shard_paths(os.path.join(tmp, "usersdb.db"),
+                                     args.shards)
+        userinfo.use_database(database.ShardRouter(
+            database.Database(p) for p in paths))
+        userinfo.init_db()
+        asyncdb.lanes = asyncdb.DatabaseLanes(args.threads, args.shards)
+        dids = list(range(1, args.users + 1))
+        start = {did: make_user(did) for did in dids}
+
+        try:
+            flushes, counts = asyncio.run(asyncio.wait_for(
+                stress(dids, args.seconds), args.seconds + args.timeout))
+        except asyncio.TimeoutError:
+            print("FAILED: the lanes stopped making progress")
+            # the stuck lane threads would keep the process alive
+            os._exit(1)
+        userinfo.flush_pending()
+        userinfo.user_cache.clear()
+
+        failed = False
+        for did in dids:
+            user = userinfo.get_user(did)
+            fuel = user.fuel - start[did][0]
+            ammo = user.ammo - start[did][1]
+            if (fuel != counts[did]['applies']
+                    or ammo != counts[did]['gains']):
+                failed = True
+                print("FAILED: user %s has %+d fuel and %+d ammo, expected "
+                      "%+d and %+d" % (did, fuel, ammo,
+                                       counts[did]['applies'],
+                                       counts[did]['gains']))
+        print("%d flushes, %d gains, %d applies on %d lanes" % (
+            flushes, sum(x['gains'] for x in counts.values()),
+            sum(x['applies'] for x in counts.values()),
+            len(asyncdb.lanes.executors)))
+        asyncdb.lanes.shutdown()
+        userinfo.db.close()
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,53 @@
+"""Make every ship's CGs at the sizes the layout draws them at.
+
+Scaled CGs are otherwise made the first time each one is drawn. Run this
+after changing layout.json or the quality profiles so no render has to
+resize a full CG. Missing CGs are downloaded first.
+
+e.g.
+    python tools/warm_cgs.py --profiles fast standard high --prune
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '../kantaibot'))
+
+import assetcache  # noqa: E402
+import imggen  # noqa: E402
+import ship_stats  # noqa: E402
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--profiles", nargs="+",
+                        default=sorted(imggen.CONFIG_DATA['quality_profiles']),
+                        help="quality profiles to make CGs for, "
+                             "defaults to all of them")
+    parser.add_argument("--prune", action="store_true",
+                        help="delete scaled CGs this pass didn't make, e.g. "
+                             "sizes no longer in the layout")
+    args = parser.parse_args()
+
+    # the ship data and fonts are found relative to the bot's folder
+    os.chdir(imggen.DIR_PATH)
+    start = time.perf_counter()
+    made = set()
+    for sid in sorted(ship_stats.SHIP_DATA, key=int):
+        base = ship_stats.ShipBase.instance(int(sid))
+        try:
+            base.get_cg_path(ico=True, wait=True)
+            base.get_cg_path(wait=True)
+        except (OSError, ValueError) as e:
+            print("Skipped ship %s: %s" % (sid, e))
+            continue
+        for profile in args.profiles:
+            made.update(imggen.warm_cgs(base, profile))
+            # only the files are wanted, don't hold every CG in memory
+            assetcache.clear()
+    print("%d scaled CGs in %s (%.1fs)" % (len(made), assetcache.MIP_DIR,
+                                           time.perf_counter() - start))
+    if (args.prune):
+        print("Pruned %d old scaled CGs" % assetcache.prune_mips(made))
@@ -1,5 +1,5 @@
 BEGIN TRANSACTION;
-CREATE TABLE "Users" (
+CREATE TABLE IF NOT EXISTS "Users" (
 	`DiscordID`	INTEGER NOT NULL UNIQUE,
 	`RFuel`	INTEGER NOT NULL DEFAULT 100,
 	`RAmmo`	INTEGER NOT NULL DEFAULT 100,
@@ -15,12 +15,37 @@ CREATE TABLE "Users" (
 	`Fleet_3`	TEXT NOT NULL DEFAULT '',
 	`Fleet_4`	TEXT NOT NULL DEFAULT '',
 	`Last_Training`	INTEGER NOT NULL DEFAULT 0,
+	`Rings`	INTEGER NOT NULL DEFAULT 0,
 	PRIMARY KEY(`DiscordID`)
 );
-CREATE TABLE "INV_BASIC" (
+CREATE TABLE IF NOT EXISTS "INV_BASIC" (
 	`ID`	INTEGER NOT NULL DEFAULT 0 PRIMARY KEY AUTOINCREMENT UNIQUE,
 	`ShipID`	INTEGER NOT NULL,
 	`ShipLevel`	INTEGER NOT NULL DEFAULT 1,
 	`ShipXP`	INTEGER NOT NULL DEFAULT 0
 );
+CREATE TABLE IF NOT EXISTS "Inventory" (
+	`OwnerID`	INTEGER NOT NULL,
+	`ID`	INTEGER NOT NULL,
+	`ShipID`	INTEGER NOT NULL,
+	`ShipLevel`	INTEGER NOT NULL DEFAULT 1,
+	`ShipXP`	INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY(`OwnerID`,`ID`)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS "InventorySeq" (
+	`OwnerID`	INTEGER NOT NULL UNIQUE,
+	`LastID`	INTEGER NOT NULL DEFAULT 0,
+	PRIMARY KEY(`OwnerID`)
+);
+CREATE TABLE IF NOT EXISTS "FleetSlots" (
+	`OwnerID`	INTEGER NOT NULL,
+	`FleetID`	INTEGER NOT NULL,
+	`Position`	INTEGER NOT NULL,
+	`InvID`	INTEGER NOT NULL,
+	PRIMARY KEY(`OwnerID`,`FleetID`,`Position`)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS "FleetSlots_InvID" ON "FleetSlots" (
+	`OwnerID`,
+	`InvID`
+);
 COMMIT;